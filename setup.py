@@ -42,6 +42,8 @@ setup(
     package_data = {
         'CobolSharp': [
             'data/koopa-*.jar',
+            'data/cobolsharp-koopa.jar',
+            'data/KoopaServer.java',
             'templates/*.html',
             'templates/*.css',
             'templates/*.js',
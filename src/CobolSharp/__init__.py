@@ -3,7 +3,8 @@
 
 # syntax and structure must be imported explicitly by user
 
-from .koopa import parse, run_koopa
+from .koopa import parse, parse_many, run_koopa, KoopaServer, ParserError
+from .cache import ParseCache
 from .graph import StmtGraph, CobolStructureGraph, AcyclicStructureGraph, ScopeStructuredGraph
 from .output import Outputter, TextOutputter, HtmlOutputter
 from .format import Pythonish, CSharpish, CodeFormatter
@@ -1,7 +1,9 @@
 # Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
 # Licensed under GPLv3, see file LICENSE in the top directory
 
-from collections import Counter
+from collections import Counter, defaultdict
+import heapq
+import itertools
 import networkx as nx
 from .syntax import *
 from .structure import *
@@ -40,6 +42,57 @@ def out_condition_edges(graph, branch_node):
     return then_edge, else_edge
 
 
+def run_reduction(step):
+    """Run a reduction step to completion and return its result.
+
+    Reductions nest as deep as the branches and loops in the code, so
+    instead of calling each other recursively the steps are generators
+    which yield the sub-steps they depend on.  Those are run on an
+    explicit stack here, and the result of each sub-step is sent back
+    to the step that yielded it.
+    """
+    stack = [step]
+    result = None
+
+    while stack:
+        try:
+            sub_step = stack[-1].send(result)
+        except StopIteration as e:
+            stack.pop()
+            result = e.value
+        else:
+            stack.append(sub_step)
+            result = None
+
+    return result
+
+
+class ScopeIndex(object):
+    """Maps each scope in a graph to its nodes and the number of in
+    edges to them, so a reduction scope can be set up without
+    searching the whole graph.
+    """
+
+    def __init__(self, graph):
+        self._nodes = defaultdict(list)
+        self._in_edge_counts = defaultdict(Counter)
+
+        for node, in_degree in graph.in_degree_iter():
+            self._nodes[node.scope].append(node)
+            if in_degree:
+                self._in_edge_counts[node.scope][node] = in_degree
+
+    def nodes(self, scope_node):
+        """Return a list of the nodes in a scope, in graph order."""
+        return self._nodes.get(scope_node, [])
+
+    def in_edge_counts(self, scope_node):
+        """Return a Counter() mapping the nodes in a scope to the number
+        of edges to them.
+        """
+        return self._in_edge_counts.get(scope_node, Counter())
+
+
 class ReductionScopeBase(object):
     """Keeps track of reductions going on in a graph scope.
 
@@ -47,15 +100,16 @@ class ReductionScopeBase(object):
     created for each nested loop being reduced.
     """
 
-    def __init__(self, graph, scope_node):
+    def __init__(self, graph, scope_index, scope_node):
         self._graph = graph
+        self._scope_index = scope_index
 
-        scope_nodes = set((n for n in graph.nodes_iter() if n.scope is scope_node))
+        scope_nodes = set(scope_index.nodes(scope_node))
 
         self._unreduced_nodes = set((n for n in scope_nodes
                                      if not isinstance(n, JumpNodeBase)))
 
-        self._node_in_edge_counts = Counter((dest for src, dest in self._graph.in_edges_iter(scope_nodes)))
+        self._node_in_edge_counts = scope_index.in_edge_counts(scope_node)
 
 
     @property
@@ -81,7 +135,8 @@ class RootReductionScope(ReductionScopeBase):
 
     def __init__(self, graph, keep_all_cobol_stmts=False, debug=False):
 
-        super(RootReductionScope, self).__init__(graph, None)
+        # The index is shared by all loop scopes created below this one
+        super(RootReductionScope, self).__init__(graph, ScopeIndex(graph), None)
         self._keep_all_cobol_stmts = keep_all_cobol_stmts
         self._debug = debug
 
@@ -114,8 +169,9 @@ class RootReductionScope(ReductionScopeBase):
     def reduce(self):
         """Reduce a ScopeStructuredGraph into a Block and return it.
         """
-        redux = BlockReduction(self._graph, self, start_node=Entry)
-        redux.resolve_tail_nodes(Exit)
+        redux = BlockReduction(self._graph, self)
+        run_reduction(redux.reduce(start_node=Entry))
+        run_reduction(redux.resolve_tail_nodes(Exit))
         return redux.block
 
 
@@ -125,7 +181,7 @@ class LoopReductionScope(ReductionScopeBase):
     """
 
     def __init__(self, parent, loop):
-        super(LoopReductionScope, self).__init__(parent._graph, loop)
+        super(LoopReductionScope, self).__init__(parent._graph, parent._scope_index, loop)
         self._root = parent.root
         self._loop = loop
 
@@ -190,20 +246,23 @@ class ReductionBase(object):
 class BlockReduction(ReductionBase):
     """A reduction of a structured section of the graph into a single block.
 
-    This is a recursive operation that reduces blocks in contained
-    branch or loop statements into their own blocks, which are
-    then folded into this block until nothing more can be reduced.
+    This reduces blocks in contained branch or loop statements into
+    their own blocks, which are then folded into this block until
+    nothing more can be reduced.  The methods that do this return
+    generator steps which must be run with run_reduction().
     """
 
-    def __init__(self, graph, scope, start_edge=None, start_node=None):
-        """If start_edge is not None, start_node must have a single out edge
-        which is the start of the block.  Otherwise start_edge is the
-        starting edge which is used for the traversal.
-        """
-
+    def __init__(self, graph, scope):
         super(BlockReduction, self).__init__(graph, scope)
         self._unresolved_if_redux = None
         self._sub_block_size = 0
+        self._size = None
+
+
+    def reduce(self, start_edge=None, start_node=None):
+        """Step that traverses the graph to build the block, starting
+        with start_edge if it is not None and otherwise at start_node.
+        """
 
         if start_edge is not None:
             src, node, data = start_edge
@@ -237,11 +296,11 @@ class BlockReduction(ReductionBase):
                 self.block.stmts.append(label)
 
             if isinstance(node, Branch):
-                node = self._reduce_if(node)
+                node = yield self._reduce_if(node)
                 skip_node_in_edge_check = True
 
             elif isinstance(node, Loop):
-                node = self._reduce_loop(node)
+                node = yield self._reduce_loop(node)
 
             else:
                 assert node == Entry or isinstance(node, Join)
@@ -256,19 +315,29 @@ class BlockReduction(ReductionBase):
 
     @property
     def size(self):
-        s = len(self._block.stmts) + self._sub_block_size
-        if self._unresolved_if_redux:
-            s += self._unresolved_if_redux.size
-        return s
+        # Cached, since the strategies of every enclosing if ask for
+        # it.  Must be reset whenever the block changes after the
+        # reduction has been constructed.
+        if self._size is None:
+            s = len(self._block.stmts) + self._sub_block_size
+            if self._unresolved_if_redux:
+                s += self._unresolved_if_redux.size
+            self._size = s
+        return self._size
 
 
     def resolve_dest_node(self, node, is_else_branch=False):
+        """Step that resolves the destination node of the block,
+        adding a jump to it unless it is node.
+        """
+        self._size = None
+
         if self._unresolved_if_redux:
             # Cannot form an else-if if there are other statements
             if self.block.stmts:
                 is_else_branch = False
 
-            self._unresolved_if_redux.resolve_branches(node, is_else_branch=is_else_branch)
+            yield self._unresolved_if_redux.resolve_branches(node, is_else_branch=is_else_branch)
             self._block.stmts.extend(self._unresolved_if_redux.block.stmts)
             self._dest_node = self._unresolved_if_redux.dest_node
             self._sub_block_size += self._unresolved_if_redux.size
@@ -302,14 +371,14 @@ class BlockReduction(ReductionBase):
 
 
     def resolve_tail_nodes(self, target_node):
-        """Resolve all tail nodes in the scope for this redux.
+        """Step that resolves all tail nodes in the scope for this redux.
 
         These are nodes that couldn't be resolved in a structured way,
         so each such node will be the target of a goto statement.
         """
 
         if not self._scope.unreduced_nodes:
-            self.resolve_dest_node(target_node)
+            yield self.resolve_dest_node(target_node)
             return
 
         # Since there are tail nodes, this reduction must end with a jump
@@ -318,25 +387,49 @@ class BlockReduction(ReductionBase):
         # TODO: if this does jump to one of the tails, that should be the first
         # to avoid one goto
 
-        self.resolve_dest_node(None)
+        yield self.resolve_dest_node(None)
+
+        # Consume unreduced nodes that are known goto targets, in
+        # source code order.  Reducing a node may add labels to other
+        # nodes, which are then queued too.
+        unreduced_nodes = self._scope.unreduced_nodes
+        node_labels = self._scope.root.node_labels
+        queue = []
+        sequence = itertools.count()
+        self._queue_tail_nodes(queue, sequence, (n for n in unreduced_nodes if n in node_labels))
+        num_labels = len(node_labels.created_nodes)
 
-        # Consume unreduced nodes that are known goto targets
         node_reduxes = {}
-        while self._scope.unreduced_nodes:
-            for node in self._scope.unreduced_nodes:
-                if node in self._scope.root.node_labels:
-                    redux = BlockReduction(self._graph, self._scope, start_node=node)
-                    node_reduxes[node] = redux
-                    redux.resolve_dest_node(None)
-                    break
-            else:
-                assert False, 'There are unreduced nodes without goto labels'
+        while unreduced_nodes:
+            assert queue, 'There are unreduced nodes without goto labels'
+            node = heapq.heappop(queue)[-1]
+
+            # Skip nodes that were reduced as part of an earlier tail
+            if node not in unreduced_nodes:
+                continue
+
+            redux = BlockReduction(self._graph, self._scope)
+            yield redux.reduce(start_node=node)
+            node_reduxes[node] = redux
+            yield redux.resolve_dest_node(None)
+
+            self._queue_tail_nodes(queue, sequence, (n for n in node_labels.created_nodes[num_labels:]
+                                                     if n in unreduced_nodes))
+            num_labels = len(node_labels.created_nodes)
 
         # All nodes processed, add them to this block in source code order
         for node, redux in sorted(node_reduxes.items(),
                                   key=lambda n: n[0].source.from_char):
             self.block.stmts.extend(redux.block.stmts)
 
+        self._size = None
+
+
+    def _queue_tail_nodes(self, queue, sequence, nodes):
+        # The sequence number keeps nodes from being compared
+        for node in nodes:
+            heapq.heappush(queue, (node.source.from_char, next(sequence), node))
+
 
     def _add_statements(self, stmts):
         if not self._scope.root.keep_all_cobol_stmts:
@@ -347,6 +440,7 @@ class BlockReduction(ReductionBase):
 
     def _reduce_if(self, branch):
         if_redux = IfReduction(self._graph, self._scope, branch)
+        yield if_redux.reduce()
 
         # Add branch dest counts from the subblocks into this one
         self._branch_dests.update(if_redux.branch_dests)
@@ -367,7 +461,7 @@ class BlockReduction(ReductionBase):
             del self._branch_dests[n]
 
         target_node = self._select_resolved_target_node(resolved_nodes)
-        if_redux.resolve_branches(target_node)
+        yield if_redux.resolve_branches(target_node)
         self.block.stmts.extend(if_redux.block.stmts)
         self._sub_block_size += if_redux.size
 
@@ -383,8 +477,9 @@ class BlockReduction(ReductionBase):
         else:
             start_edge = self._out_edge(loop)
 
-        redux = BlockReduction(self._graph, loop_scope, start_edge=start_edge)
-        redux.resolve_tail_nodes(loop.continue_loop)
+        redux = BlockReduction(self._graph, loop_scope)
+        yield redux.reduce(start_edge=start_edge)
+        yield redux.resolve_tail_nodes(loop.continue_loop)
 
         if loop.condition:
             self.block.stmts.append(While(loop.stmt.sentence.para,
@@ -455,18 +550,26 @@ class BlockReduction(ReductionBase):
 
 
 class IfReduction(ReductionBase):
-    """Reduce a branch into an If object, recursing down the edges.
+    """Reduce a branch into an If object, reducing each edge into a block.
     """
 
     def __init__(self, graph, scope, branch_node):
         super(IfReduction, self).__init__(graph, scope)
         self._branch_node = branch_node
         self._condition = branch_node.condition
+        self._then = None
+        self._else = None
+
 
-        then_edge, else_edge = self._out_condition_edges(branch_node)
+    def reduce(self):
+        """Step that reduces the then and else blocks.
+        """
+        then_edge, else_edge = self._out_condition_edges(self._branch_node)
 
-        self._then = BlockReduction(self._graph, self._scope, start_edge=then_edge)
-        self._else = BlockReduction(self._graph, self._scope, start_edge=else_edge)
+        self._then = BlockReduction(self._graph, self._scope)
+        yield self._then.reduce(start_edge=then_edge)
+        self._else = BlockReduction(self._graph, self._scope)
+        yield self._else.reduce(start_edge=else_edge)
 
         # Just count the dest nodes, they will be resolved by a parent block
         self._branch_dests.update(self._then.branch_dests)
@@ -482,30 +585,40 @@ class IfReduction(ReductionBase):
 
 
     def resolve_branches(self, target_node, is_else_branch=False):
+        """Step that resolves both branches to target_node and
+        builds the If.
+        """
         assert self._dest_node is None
 
-        self._then.resolve_dest_node(target_node)
-        self._else.resolve_dest_node(target_node, is_else_branch=True)
+        yield self._then.resolve_dest_node(target_node)
+        yield self._else.resolve_dest_node(target_node, is_else_branch=True)
 
         assert self._then.dest_node is None or self._then.dest_node is target_node
         assert self._else.dest_node is None or self._else.dest_node is target_node
 
-        # Determine the least costly reduction of the if statement
-        strategies = [s for s in (s(self._then, self._else, is_else_branch)
-                                  for s in if_reduction_strategies)
+        # Determine the least costly reduction of the if statement.
+        # Each cost is only evaluated once, and the sort is stable on
+        # the strategy order.
+        strategies = [(s.cost, i, s) for i, s in enumerate(
+                          s(self._then, self._else, is_else_branch)
+                          for s in if_reduction_strategies)
                       if s.possible]
-        strategies.sort(key=lambda s: s.cost)
+        strategies.sort()
 
         if self._scope.root.debug:
             self._branch_node.stmt.comment = 'cobolsharp: if reduction strategies:\n{}'.format(
-                '\n'.join(['   {}'.format(r) for r in strategies]))
+                '\n'.join(['   <{} cost {}>'.format(s.__class__.__name__, cost)
+                           for cost, i, s in strategies]))
 
         if strategies:
-            s = strategies[0]
+            s = strategies[0][-1]
         else:
             s = NullIfStrategy(self._then, self._else, is_else_branch)
 
-        s.apply()
+        step = s.apply()
+        if step is not None:
+            yield step
+
         if s.flip:
             self._flip_branches()
 
@@ -513,6 +626,7 @@ class IfReduction(ReductionBase):
             self._dest_node = self._else.dest_node
             tail_stmts = self._else.block.stmts
             self._else._block = Block()
+            self._else._size = None
         else:
             self._dest_node = self._then.dest_node or self._else.dest_node
             tail_stmts = ()
@@ -584,9 +698,10 @@ class IfReductionStrategyBase(object):
         return False
 
     def apply(self):
-        """Apply the strategy to the then/else reduxes.
+        """Apply the strategy to the then/else reduxes, returning a
+        reduction step to run for it or None.
         """
-        pass
+        return None
 
 
 class NullIfStrategy(IfReductionStrategyBase):
@@ -681,7 +796,7 @@ class JumpFromThenStrategy(IfReductionStrategyBase):
 
     def apply(self):
         # Re-resolve forcing in a jump
-        self._then.resolve_dest_node(None)
+        return self._then.resolve_dest_node(None)
 
 
 class JumpFromFlippedElseStrategy(IfReductionStrategyBase):
@@ -699,7 +814,7 @@ class JumpFromFlippedElseStrategy(IfReductionStrategyBase):
 
     def apply(self):
         # Re-resolve forcing in a jump
-        self._else.resolve_dest_node(None)
+        return self._else.resolve_dest_node(None)
 
     @property
     def flip(self):
@@ -719,6 +834,12 @@ if_reduction_strategies = [
 
 
 class NodeLabelDict(dict):
+    def __init__(self):
+        super(NodeLabelDict, self).__init__()
+
+        # Nodes in the order their labels were created
+        self.created_nodes = []
+
     def get_or_create(self, node):
         label = self.get(node)
         if label is not None:
@@ -738,5 +859,6 @@ class NodeLabelDict(dict):
 
         label.scope = node.scope
         self[node] = label
+        self.created_nodes.append(node)
 
         return label
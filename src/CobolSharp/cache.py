@@ -0,0 +1,211 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+"""On-disk cache of Koopa parse results.
+"""
+
+import os
+import gzip
+import hashlib
+import sys
+import tempfile
+
+from .koopa import KOOPA_JAR
+from .syntax import Program, SourceBytes
+from .serialize import FORMAT_VERSION
+
+# Changes when the cached data changes format
+CACHE_VERSION = 2
+CACHE_FORMAT = 'program-{}-{}'.format(FORMAT_VERSION, CACHE_VERSION)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# Stores between full scans of the cache directory, which also pick up
+# entries added by other processes
+PRUNE_INTERVAL = 100
+
+
+def default_cache_dir():
+    """Return the per-user cache directory, following the XDG spec.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cobolsharp')
+
+
+class ParseCache(object):
+    """A content-addressed cache of parsed programs in 'directory',
+    stored with Program.dump() followed by the parser warnings.
+
+    Entries are keyed by a hash of the source code and everything else
+    that affects the parse, so a changed file just misses the cache.
+    The cache is kept below max_size bytes by removing the least
+    recently used entries when new ones are added.  To avoid scanning
+    the whole cache for every new entry, the size is estimated from the
+    entries added since the last scan.  A scan is only done when the
+    estimate is over max_size, or after PRUNE_INTERVAL stores.
+
+    The cache can be shared by several processes.  Until the next scan
+    the estimate doesn't include entries added by other processes, so
+    a shared cache may grow somewhat larger than max_size.
+
+    The cache is only an optimisation, so if it can't be written a
+    warning is printed once and the programs are just not cached.
+    """
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory or default_cache_dir()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        # Estimated cache size, or None before the first scan
+        self._size = None
+        self._stores_since_prune = 0
+        self._store_failed = False
+
+
+    def key(self, code, tabsize):
+        """Return the cache key for the Cobol source code 'code', a
+        string or a SourceBytes.
+
+        The key is computed from the decoded source code, so the file
+        encoding is already accounted for.  A SourceBytes is hashed
+        as it is, together with its encoding, to avoid decoding it.
+        """
+        if isinstance(code, SourceBytes):
+            source_fields = ('bytes', code.encoding)
+        else:
+            source_fields = ('text', )
+
+        h = hashlib.sha256()
+        for field in (CACHE_FORMAT, os.path.basename(KOOPA_JAR), str(tabsize)) + source_fields:
+            h.update(field.encode('utf-8'))
+            h.update(b'\0')
+
+        if isinstance(code, SourceBytes):
+            h.update(code.data)
+        else:
+            h.update(code.encode('utf-8', errors='surrogatepass'))
+        return h.hexdigest()
+
+
+    def load(self, code, code_path, tabsize):
+        """Return the cached Program for the source code 'code',
+        or None if it isn't in the cache.  code_path is set as the
+        program path, since the same code may be in different files.
+
+        The warnings from the parse are written to stderr for
+        code_path, like when the program was parsed.
+        """
+        path = self._entry_path(self.key(code, tabsize))
+
+        try:
+            with gzip.open(path, 'rb') as f:
+                program = Program.load(f)
+                warnings = f.read().decode('utf-8').splitlines()
+        except Exception:
+            # Not cached, or broken somehow in which case it will be
+            # replaced when the code has been parsed again.  Corrupt
+            # data can fail in the gzip or zlib layers or with any
+            # error when the program is loaded, not just FormatError.
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touch(path)
+
+        for warning in warnings:
+            sys.stderr.write('{}: {}\n'.format(code_path, warning))
+
+        program.path = code_path
+        return program
+
+
+    def store(self, code, tabsize, program, warnings=()):
+        """Add the Program parsed from the source code 'code' to the
+        cache, together with the list of parser warnings, and remove
+        old entries if the cache is too big.
+        """
+        try:
+            self._store(code, tabsize, program, warnings)
+        except OSError as e:
+            if not self._store_failed:
+                self._store_failed = True
+                sys.stderr.write('warning: cannot write to parse cache {}: {}\n'.format(
+                    self.directory, e))
+
+
+    def _store(self, code, tabsize, program, warnings):
+        path = self._entry_path(self.key(code, tabsize))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+
+        try:
+            with gzip.open(os.fdopen(fd, 'wb'), 'wb', compresslevel=1) as f:
+                program.dump(f)
+                f.write(''.join(w + '\n' for w in warnings).encode('utf-8'))
+
+            os.replace(tmp_path, path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        self._stores_since_prune += 1
+        if self._size is not None:
+            self._size += os.path.getsize(path)
+
+        if (self._size is None or self._size > self.max_size
+                or self._stores_since_prune >= PRUNE_INTERVAL):
+            self.prune()
+
+
+    def prune(self):
+        """Remove the least recently used entries until the cache is no
+        larger than max_size.
+        """
+        entries = []
+        total = 0
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.gz'):
+                    continue
+
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                # Probably removed by another process
+                pass
+
+            total -= size
+
+        self._size = total
+        self._stores_since_prune = 0
+
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.prog.gz')
+
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
@@ -2,12 +2,21 @@
 # Licensed under GPLv3, see file LICENSE in the top directory
 
 from CobolSharp import *
+from CobolSharp.koopa import map_source, parse_heap_size
+from CobolSharp.parallel import analyze_sections
+from CobolSharp.pipeline import Job, Pipeline, StageStats, write_stats
 from CobolSharp.structure import Method
 from CobolSharp.syntax import PerformSectionStatement
 
 import sys
 import os
 import argparse
+import itertools
+import multiprocessing
+import multiprocessing.util
+import shlex
+import time
+import traceback
 import networkx as nx
 
 OUTPUT_FORMATS = [
@@ -28,106 +37,322 @@ LANGUAGES = {
     'C#': CSharpish,
 }
 
+class CommandError(Exception): pass
+
 def main():
     args = parser.parse_args()
-    for source_path in args.sources:
-        if args.destdir:
-            output_base = os.path.join(args.destdir, os.path.basename(source_path))
+
+    if args.section_jobs > 1:
+        # Worker processes can't start their own workers
+        if args.jobs is not None and args.jobs > 1:
+            parser.error('-j and --section-jobs cannot both be used')
+        jobs = 1
+    else:
+        jobs = min(args.jobs or os.cpu_count() or 1, len(args.sources))
+
+    stats = [StageStats(name) for name in FileProcessor.STAGES]
+    start = time.perf_counter()
+
+    if jobs > 1:
+        # Each worker process runs its own Koopa JVM, and processes
+        # chunks of files in a pipeline like below.  Results are
+        # reported in source file order, with any output from each
+        # file kept together.
+        with multiprocessing.Pool(jobs, init_worker, (args, )) as pool:
+            chunk_results = pool.imap(run_worker, source_chunks(args.sources, jobs))
+            failures = report_results(
+                args, itertools.chain.from_iterable(chunk_results), stats)
+    else:
+        # Run the stages in separate threads, so the JVM can parse the
+        # next file while the current one is analysed and rendered.
+        # The section workers must not be forked while other threads
+        # are running, so don't do that with --section-jobs.
+        processor = FileProcessor(args)
+        pipeline = Pipeline(processor.stages(), threaded=args.section_jobs <= 1)
+        try:
+            file_jobs = pipeline.run(FileJob(source_path) for source_path in args.sources)
+            failures = report_results(
+                args, ((job.source_path, job.stdout.getvalue(), job.stderr.getvalue(),
+                        job.error, None)
+                       for job in file_jobs),
+                stats)
+        finally:
+            processor.close()
+
+        stats = pipeline.stats
+
+    if args.stats:
+        sys.stderr.write('\n')
+        write_stats(stats, time.perf_counter() - start, sys.stderr)
+
+    if failures:
+        sys.stderr.write('\nFailed source files:\n')
+        for source_path in failures:
+            sys.stderr.write('  {}\n'.format(source_path))
+
+        sys.exit('{} of {} source files could not be processed'.format(
+            len(failures), len(args.sources)))
+
+
+def report_results(args, results, stats):
+    """Write the output and errors from 'results', a sequence of
+    (source_path, stdout, stderr, error, stage_stats) tuples.  Any
+    stage_stats that aren't None are added to 'stats'.
+    Returns the list of the source files that failed.
+    """
+    failures = []
+
+    for source_path, stdout, stderr, error, stage_stats in results:
+        sys.stdout.write(stdout)
+        sys.stdout.flush()
+        sys.stderr.write(stderr)
+
+        if error is not None:
+            sys.stderr.write('{}: {}\n'.format(source_path, error))
+            failures.append(source_path)
+
+        if stage_stats is not None:
+            for total, s in zip(stats, stage_stats):
+                total.add(s)
+
+    return failures
+
+
+def exception_message(e):
+    """Return the error message to report for an unexpected exception.
+    The traceback is reported separately with traceback.format_exc().
+    """
+    return '{}: {}'.format(type(e).__name__, e)
+
+
+class FileJob(Job):
+    """A source file passed through the FileProcessor stages."""
+
+    def __init__(self, source_path):
+        super(FileJob, self).__init__()
+        self.source_path = source_path
+        self.program = None
+        self.analysis = None
+
+
+class FileProcessor(object):
+    """Parse and process source files according to the command line
+    arguments, reusing a Koopa JVM unless told otherwise.
+
+    The processing is split into the stages listed in STAGES, which
+    are methods taking a FileJob.  Any exception in a stage only fails
+    that job, so the other files are still processed.
+    """
+
+    STAGES = ['parse', 'analyze', 'render']
+
+    def __init__(self, args):
+        self._args = args
+        self._java_args = dict(java_heap=args.java_heap,
+                               java_opts=shlex.split(args.java_opts or ''),
+                               java_cds=args.java_cds)
+
+        if args.no_koopa_server:
+            self._server = None
+        else:
+            self._server = KoopaServer(**self._java_args)
+
+        if args.no_cache:
+            self._cache = None
         else:
-            output_base = source_path
+            self._cache = ParseCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+
+    def close(self):
+        if self._server:
+            self._server.close()
+
+
+    def stages(self):
+        """Return the stages for a Pipeline."""
+        return [(name, self._job_stage(getattr(self, name))) for name in self.STAGES]
 
-        output_base = os.path.splitext(output_base)[0]
 
-        source_file = open(source_path, 'rt', encoding=args.encoding, newline='')
+    def _job_stage(self, func):
+        def stage(job):
+            try:
+                func(job)
+            except Exception as e:
+                # Keep the traceback, as the message alone doesn't
+                # show where the analysis failed
+                job.stderr.write(traceback.format_exc())
+                job.error = exception_message(e)
+
+        return stage
+
+
+    def parse(self, job):
+        args = self._args
 
         if args.format == 'xml':
-            xml_path = '{}.xml'.format(output_base)
-            run_koopa(source_file, xml_path, tabsize=args.tabsize)
-            print('wrote', xml_path)
+            job.error = write_xml(args, job.source_path, self._server, self._java_args)
+            return
+
+        # Starts a separate JVM for each file if there's no server
+        program = next(parse_many([job.source_path], tabsize=args.tabsize,
+                                  encoding=args.encoding, server=self._server,
+                                  cache=self._cache, **self._java_args))
+
+        if isinstance(program, ParserError):
+            job.error = program
         else:
-            program = parse(source_file, tabsize=args.tabsize)
-            process_program(args, output_base, program)
+            job.program = program
+            job.lines = program.source.table.count_lines()
 
 
-def process_program(args, output_base, program):
-    language = LANGUAGES[args.language]
+    def analyze(self, job):
+        if job.program is not None:
+            job.analysis = analyze_program(
+                self._args, get_output_base(self._args, job.source_path), job.program)
 
-    if args.format == 'code':
-        path = '{}.{}'.format(output_base, language.file_suffix)
-        outputter = TextOutputter(open(path, 'wt', encoding='utf-8'), language)
-    elif args.format == 'html':
-        path = '{}.html'.format(output_base)
-        outputter = HtmlOutputter(program, open(path, 'wt', encoding='utf-8'), language)
-    else:
-        path = None
-        outputter = None
 
-    if outputter:
-        formatter = CodeFormatter(outputter, language)
-    else:
-        formatter = None
-
-    # Map sections to their reachable statment graphs
-    section_stmt_graphs = {}
-    section_scope_graphs = {}
-
-    for section in program.proc_div.sections.values():
-        # Only process selected graph if outputting graphs, otherwise
-        # all are needed to output code in some form
-        if not (not args.section
-                or args.section == section.name
-                or outputter is not None):
-            continue
-
-        if not args.section or args.section == section.name:
-            graph_path = '{}_{}.dot'.format(output_base, section.name)
-        else:
-            graph_path = None
+    def render(self, job):
+        if job.analysis is None:
+            return
+
+        try:
+            render_program(self._args, get_output_base(self._args, job.source_path),
+                           job.program, job.analysis)
+        except CommandError as e:
+            job.error = e
+
+        # Not needed anymore, so don't keep it around until the
+        # results are reported
+        job.program = job.analysis = None
+
+
+#
+# Parallel processing with -j
+#
+
+_worker_processor = None
 
-        full_graph = StmtGraph.from_section(section)
+def init_worker(args):
+    global _worker_processor
+    _worker_processor = FileProcessor(args)
 
-        if args.format == 'full_stmt_graph':
-            if graph_path:
-                nx.nx_pydot.write_dot(full_graph.graph, graph_path)
-                print('wrote', graph_path)
-            continue
+    # Stop the JVM when the worker process exits
+    multiprocessing.util.Finalize(None, _worker_processor.close, exitpriority=10)
 
-        reachable = full_graph.reachable_subgraph()
-        section_stmt_graphs[section] = reachable
 
-        if args.format == 'stmt_graph':
-            if graph_path:
-                nx.nx_pydot.write_dot(reachable.graph, graph_path)
-                print('wrote', graph_path)
-            continue
+# Files passed to a worker process at a time with -j
+MAX_CHUNK_SIZE = 20
+
+def source_chunks(sources, jobs):
+    """Split the list 'sources' into chunks for the worker processes.
+
+    The chunks are big enough for the stages to overlap in each worker,
+    but small enough to give each worker a couple of them to even out
+    the load.
+    """
+    size = max(1, min(MAX_CHUNK_SIZE, len(sources) // (2 * jobs)))
+    return [sources[i : i + size] for i in range(0, len(sources), size)]
+
+
+def run_worker(source_paths):
+    """Process a chunk of source files in a worker process, returning a
+    list of tuples for report_results().  The stages run in threads,
+    so the JVM parses the next file while the current one is analysed.
+    The stage statistics for the chunk are included in the last tuple.
+    """
+    pipeline = Pipeline(_worker_processor.stages())
+    results = []
+
+    try:
+        for job in pipeline.run(FileJob(source_path) for source_path in source_paths):
+            # Exceptions may not be picklable, so just pass on the message
+            error = str(job.error) if job.error is not None else None
+            results.append((job.source_path, job.stdout.getvalue(), job.stderr.getvalue(),
+                            error, None))
+    except Exception as e:
+        # Report it for the rest of the chunk, instead of ending the
+        # whole run.  The traceback is output with the first of them.
+        stderr = traceback.format_exc()
+        for source_path in source_paths[len(results):]:
+            results.append((source_path, '', stderr, exception_message(e), None))
+            stderr = ''
+
+    results[-1] = results[-1][:-1] + (pipeline.stats, )
+    return results
+
+
+def get_output_base(args, source_path):
+    if args.destdir:
+        output_base = os.path.join(args.destdir, os.path.basename(source_path))
+    else:
+        output_base = source_path
+
+    return os.path.splitext(output_base)[0]
 
-        cobol_graph = CobolStructureGraph.from_stmt_graph(reachable)
 
-        if args.format == 'cobol_graph':
-            if graph_path:
-                cobol_graph.write_dot(graph_path)
-                print('wrote', graph_path)
-            continue
+def write_xml(args, source_path, server, java_args):
+    xml_path = '{}.xml'.format(get_output_base(args, source_path))
 
-        dag = AcyclicStructureGraph.from_cobol_graph(cobol_graph)
+    try:
+        source = map_source(source_path, args.encoding)
+        if source is not None:
+            with source:
+                run_koopa(source, xml_path, tabsize=args.tabsize, server=server, **java_args)
+        else:
+            with open(source_path, 'rt', encoding=args.encoding, newline='') as source_file:
+                run_koopa(source_file, xml_path, tabsize=args.tabsize, server=server, **java_args)
+    except ParserError as e:
+        return e
+    except (OSError, UnicodeError) as e:
+        # Same as parse_many(), so one bad file doesn't stop the run
+        return ParserError('{}: {}'.format(source_path, e))
+
+    print('wrote', xml_path)
+    return None
+
+
+def analyze_program(args, output_base, program):
+    """Analyze the sections of the program, writing any graphs
+    requested.
+
+    If code will be output, returns a tuple (section_performs,
+    section_blocks) mapping sections to the sections they perform
+    and to their flattened code blocks.  Otherwise returns None.
+    """
+    flatten = args.format in ('code', 'html')
+
+    # Only process selected graph if outputting graphs, otherwise
+    # all are needed to output code in some form
+    sections = [section for section in program.proc_div.sections.values()
+                if (not args.section
+                    or args.section == section.name
+                    or flatten)]
+
+    section_performs = {}
+    section_blocks = {}
+
+    if args.section_jobs > 1:
+        for section, performed, block in analyze_sections(
+                program, sections, analyze_section_block,
+                (args, output_base, flatten), args.section_jobs):
+            section_performs[section] = performed
+            section_blocks[section] = block
+    else:
+        for section in sections:
+            performed, block = analyze_section_block(section, args, output_base, flatten)
+            section_performs[section] = performed
+            section_blocks[section] = block
 
-        if args.format == 'acyclic_graph':
-            if graph_path:
-                dag.write_dot(graph_path)
-                print('wrote', graph_path)
-            continue
+    if not flatten:
+        return None
 
-        scope_graph = ScopeStructuredGraph.from_acyclic_graph(dag, debug=args.debug)
-        section_scope_graphs[section] = scope_graph
+    return section_performs, section_blocks
 
-        if args.format == 'scope_graph':
-            if graph_path:
-                scope_graph.write_dot(graph_path)
-                print('wrote', graph_path)
-            continue
 
-    if not outputter:
-        return
+def render_program(args, output_base, program, analysis):
+    """Write the code for the program, as analysed by analyze_program()."""
+    section_performs, section_blocks = analysis
+    language = LANGUAGES[args.language]
 
     if args.unused:
         # Include all sections in output
@@ -139,7 +364,7 @@ def process_program(args, output_base, program):
         if args.section:
             first_section = program.proc_div.sections.get(args.section)
             if first_section is None:
-                sys.exit('{}: section not defined: {}'.format(program.path, args.section))
+                raise CommandError('section not defined: {}'.format(args.section))
         else:
             first_section = program.proc_div.first_section
 
@@ -147,27 +372,129 @@ def process_program(args, output_base, program):
         used_sections.add(first_section)
         while queue:
             section = queue.pop()
-            for node in section_stmt_graphs[section].graph:
-                if (isinstance(node, PerformSectionStatement)
-                    and node.section is not None
-                    and node.section not in used_sections):
-                    used_sections.add(node.section)
-                    queue.append(node.section)
-
-    for section in program.proc_div.sections_in_order():
-        if section in used_sections:
-            block = section_scope_graphs[section].flatten_block()
-            formatter.format_method(Method(section, block))
+            for performed in section_performs[section]:
+                if performed not in used_sections:
+                    used_sections.add(performed)
+                    queue.append(performed)
+
+    if args.format == 'code':
+        path = '{}.{}'.format(output_base, language.file_suffix)
+    else:
+        path = '{}.html'.format(output_base)
+
+    with open(path, 'wt', encoding='utf-8') as output_file:
+        if args.format == 'code':
+            outputter = TextOutputter(output_file, language)
         else:
-            print('unused section', section.name)
+            outputter = HtmlOutputter(program, output_file, language)
+
+        formatter = CodeFormatter(outputter, language)
+
+        for section in program.proc_div.sections_in_order():
+            if section in used_sections:
+                formatter.format_method(Method(section, section_blocks[section]))
+            else:
+                print('unused section', section.name)
+
+        outputter.close()
 
-    outputter.close()
     print('wrote', path)
 
+def analyze_section(args, output_base, section):
+    """Run the graph analysis steps on a section, up to the one
+    needed for the output format.  Graphs are written as requested.
+
+    Returns a tuple (reachable, scope_graph) with the StmtGraph of
+    reachable statements and the ScopeStructuredGraph, or None for
+    those that weren't constructed.
+    """
+    if not args.section or args.section == section.name:
+        graph_path = '{}_{}.dot'.format(output_base, section.name)
+    else:
+        graph_path = None
+
+    full_graph = StmtGraph.from_section(section)
+
+    if args.format == 'full_stmt_graph':
+        if graph_path:
+            nx.nx_pydot.write_dot(full_graph.graph, graph_path)
+            print('wrote', graph_path)
+        return None, None
+
+    reachable = full_graph.reachable_subgraph()
+
+    if args.format == 'stmt_graph':
+        if graph_path:
+            nx.nx_pydot.write_dot(reachable.graph, graph_path)
+            print('wrote', graph_path)
+        return reachable, None
+
+    cobol_graph = CobolStructureGraph.from_stmt_graph(reachable)
+
+    if args.format == 'cobol_graph':
+        if graph_path:
+            cobol_graph.write_dot(graph_path)
+            print('wrote', graph_path)
+        return reachable, None
+
+    dag = AcyclicStructureGraph.from_cobol_graph(cobol_graph)
+
+    if args.format == 'acyclic_graph':
+        if graph_path:
+            dag.write_dot(graph_path)
+            print('wrote', graph_path)
+        return reachable, None
+
+    scope_graph = ScopeStructuredGraph.from_acyclic_graph(dag, debug=args.debug)
+
+    if args.format == 'scope_graph':
+        if graph_path:
+            scope_graph.write_dot(graph_path)
+            print('wrote', graph_path)
+
+    return reachable, scope_graph
+
+
+def analyze_section_block(section, args, output_base, flatten):
+    """Analyze a section, returning a tuple (performed_sections,
+    block).  The block is only flattened from the scope graph if
+    'flatten' is true, and otherwise None.
+
+    This is also the worker function for analyze_sections().
+    """
+    reachable, scope_graph = analyze_section(args, output_base, section)
+
+    if reachable is not None:
+        performed = performed_sections(reachable)
+    else:
+        performed = None
+
+    if flatten and scope_graph is not None:
+        block = scope_graph.flatten_block()
+    else:
+        block = None
+
+    return performed, block
+
+
+def performed_sections(stmt_graph):
+    """Return the sections performed by the statements in stmt_graph."""
+    return [node.section for node in stmt_graph
+            if isinstance(node, PerformSectionStatement) and node.section is not None]
+
+
 #
 # Set up the command argument parsing
 #
 
+def java_heap_size(value):
+    try:
+        parse_heap_size(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
 parser = argparse.ArgumentParser(description='Cobol revisualiser')
 parser.add_argument('sources', nargs='+', help='Cobol source files', metavar="COBOL_FILE")
 parser.add_argument('-s', '--section',
@@ -186,3 +513,26 @@ parser.add_argument('-D', '--debug', action='store_true',
                     help='debug mode aiding in inspecting the analysis results')
 parser.add_argument('-u', '--unused', action='store_true',
                     help='include sections not referenced from any reachable code')
+parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                    help='process N source files in parallel (default: number of CPUs)')
+parser.add_argument('--section-jobs', type=int, default=1, metavar='N',
+                    help='analyze the sections of each source file in N parallel processes, '
+                    'which means that files are processed one at a time (default 1)')
+parser.add_argument('--stats', action='store_true',
+                    help='report the time spent in each processing stage')
+parser.add_argument('--no-koopa-server', action='store_true',
+                    help='start a new Koopa JVM for each source file')
+parser.add_argument('--java-heap', type=java_heap_size, default='auto', metavar='SIZE',
+                    help='maximum Koopa JVM heap size, e.g. 2g, or "auto" to size it '
+                    'from the source code (default auto)')
+parser.add_argument('--java-opts', metavar='OPTS',
+                    help='additional Koopa JVM arguments, e.g. --java-opts="-XX:+UseSerialGC"')
+parser.add_argument('--java-cds', metavar='ARCHIVE',
+                    help='use (and create if needed) this class data sharing archive '
+                    'to start the Koopa JVM faster (requires Java 19 or later)')
+parser.add_argument('--cache-dir', metavar='DIR',
+                    help='directory for caching parsed programs (default ~/.cache/cobolsharp)')
+parser.add_argument('--cache-size', type=int, default=1024, metavar='MB',
+                    help='maximum size of the parse cache (default 1024 MB)')
+parser.add_argument('--no-cache', action='store_true',
+                    help='always parse source files, without using the cache')
@@ -0,0 +1,276 @@
+// Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+// Licensed under GPLv3, see file LICENSE in the top directory
+
+package cobolsharp;
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.Reader;
+import java.io.Writer;
+import java.nio.charset.Charset;
+import java.util.Iterator;
+
+import koopa.cobol.parser.ParseResults;
+import koopa.cobol.parser.ParsingCoordinator;
+import koopa.cobol.sources.SourceFormat;
+import koopa.core.parsers.Parse;
+import koopa.core.trees.KoopaTreeBuilder;
+import koopa.core.trees.Tree;
+import koopa.core.trees.XMLSerializer;
+import koopa.core.util.Tuple;
+
+/**
+ * A long-running Koopa parser driven by CobolSharp over stdin/stdout.
+ *
+ * This keeps Koopa loaded and JIT-compiled between programs, instead
+ * of starting a new JVM for each source file like koopa.app.cli.ToXml.
+ *
+ * Each request is a single line of tab-separated fields:
+ *
+ *   parse SOURCE_PATH XML_PATH
+ *   stream SOURCE_NAME LENGTH
+ *
+ * A stream request is followed by LENGTH bytes of ISO-8859-1 source
+ * code, and the XML is sent back in the response instead of being
+ * saved to a file.  SOURCE_NAME is only used in messages.
+ *
+ * The response is a sequence of frames, each a header line with the
+ * frame kind and a payload length, followed by that many bytes:
+ *
+ *   message  UTF-8 text with the Koopa errors and warnings
+ *   xml      the next chunk of the UTF-8 XML document
+ *   ok       end of a successful request (empty)
+ *   error    end of a failed request (empty)
+ *
+ * The XML is sent in chunks as it is serialized, so the client can
+ * parse it while Koopa is still writing it.
+ *
+ * The server exits when stdin is closed.
+ *
+ * Build with:
+ *   javac -source 8 -target 8 -cp koopa-r356.jar -d build KoopaServer.java
+ *   jar cf cobolsharp-koopa.jar -C build .
+ */
+public class KoopaServer {
+    // Sources are saved by CobolSharp as a single-byte encoding so
+    // that character offsets in the XML match the Python string
+    private static final Charset SOURCE_CHARSET = Charset.forName("ISO-8859-1");
+    private static final Charset UTF8 = Charset.forName("UTF-8");
+
+    private static final int XML_CHUNK_SIZE = 64 * 1024;
+
+    private final InputStream in;
+    private final OutputStream out;
+    private final ParsingCoordinator coordinator;
+
+    public KoopaServer(InputStream in, OutputStream out) {
+        this.in = in;
+        this.out = out;
+
+        // Same settings as koopa.app.cli.ToXml by default
+        coordinator = new ParsingCoordinator();
+        coordinator.setFormat(SourceFormat.FIXED);
+        coordinator.setPreprocessing(false);
+    }
+
+    public static void main(String[] args) throws IOException {
+        // Keep stdout for the protocol, and send anything else
+        // that might get printed to stderr instead
+        OutputStream out = new BufferedOutputStream(System.out);
+        System.setOut(System.err);
+
+        new KoopaServer(new BufferedInputStream(System.in), out).serve();
+    }
+
+    public void serve() throws IOException {
+        String request;
+        while ((request = readLine()) != null) {
+            String[] fields = request.split("\t", -1);
+
+            try {
+                if (fields[0].equals("parse") && fields.length == 3) {
+                    parse(new File(fields[1]), new File(fields[2]));
+                } else if (fields[0].equals("stream") && fields.length == 3) {
+                    byte[] code = readBytes(Integer.parseInt(fields[2]));
+                    stream(new File(fields[1]), code);
+                } else {
+                    frame("message", "Unknown request: " + request + "\n");
+                    frame("error", "");
+                }
+            } catch (OutOfMemoryError e) {
+                // The heap is probably unusable now, so report it
+                // and let the client start a fresh server
+                frame("message", "Error: Koopa ran out of memory: " + e.getMessage() + "\n");
+                frame("error", "");
+                out.flush();
+                System.exit(3);
+            } catch (RuntimeException e) {
+                frame("message", "Error: Koopa failed: " + e + "\n");
+                frame("error", "");
+            }
+
+            out.flush();
+        }
+    }
+
+    private void parse(File source, File target) throws IOException {
+        StringBuilder messages = new StringBuilder();
+
+        ParseResults results;
+        Reader reader = new InputStreamReader(new FileInputStream(source), SOURCE_CHARSET);
+        try {
+            results = coordinator.parse(source, reader);
+        } catch (IOException e) {
+            frame("message", "IOException while reading " + source + "\n");
+            frame("error", "");
+            return;
+        } finally {
+            reader.close();
+        }
+
+        if (!report(messages, results, source)) {
+            frame("message", messages.toString());
+            frame("error", "");
+            return;
+        }
+
+        Tree tree = ((KoopaTreeBuilder) results.getParse().getTarget(KoopaTreeBuilder.class)).getTree();
+
+        try {
+            XMLSerializer.serialize(tree, target);
+        } catch (IOException e) {
+            messages.append("IOException while writing " + target + "\n");
+            messages.append(e.getMessage() + "\n");
+            frame("message", messages.toString());
+            frame("error", "");
+            return;
+        }
+
+        frame("message", messages.toString());
+        frame("ok", "");
+    }
+
+    private void stream(File source, byte[] code) throws IOException {
+        StringBuilder messages = new StringBuilder();
+
+        ParseResults results;
+        Reader reader = new InputStreamReader(new ByteArrayInputStream(code), SOURCE_CHARSET);
+        try {
+            results = coordinator.parse(source, reader);
+        } catch (IOException e) {
+            frame("message", "IOException while reading " + source + "\n");
+            frame("error", "");
+            return;
+        }
+
+        boolean ok = report(messages, results, source);
+        frame("message", messages.toString());
+
+        if (!ok) {
+            frame("error", "");
+            return;
+        }
+
+        Tree tree = ((KoopaTreeBuilder) results.getParse().getTarget(KoopaTreeBuilder.class)).getTree();
+        XMLSerializer.serialize(tree, new XMLFrameWriter());
+
+        frame("ok", "");
+    }
+
+    /**
+     * Add Koopa errors and warnings to messages, in the same format
+     * as koopa.app.cli.ToXml.  Returns false if the source could
+     * not be parsed.
+     */
+    private boolean report(StringBuilder messages, ParseResults results, File source) {
+        Parse parse = results.getParse();
+
+        for (Iterator i = parse.getErrors().iterator(); i.hasNext(); ) {
+            Tuple error = (Tuple) i.next();
+            messages.append("Error: " + error.getFirst() + " " + error.getSecond() + "\n");
+        }
+
+        for (Iterator i = parse.getWarnings().iterator(); i.hasNext(); ) {
+            Tuple warning = (Tuple) i.next();
+            messages.append("Warning: " + warning.getFirst() + " " + warning.getSecond() + "\n");
+        }
+
+        if (!results.isValidInput()) {
+            messages.append("Could not parse " + source + "\n");
+            return false;
+        }
+
+        return !parse.hasErrors();
+    }
+
+    private void frame(String kind, String payload) throws IOException {
+        frame(kind, payload.getBytes(UTF8));
+    }
+
+    private void frame(String kind, byte[] payload) throws IOException {
+        out.write((kind + " " + payload.length + "\n").getBytes(UTF8));
+        out.write(payload);
+    }
+
+    private byte[] readBytes(int length) throws IOException {
+        byte[] data = new byte[length];
+        int pos = 0;
+        while (pos < length) {
+            int count = in.read(data, pos, length - pos);
+            if (count < 0) {
+                throw new EOFException();
+            }
+            pos += count;
+        }
+        return data;
+    }
+
+    private String readLine() throws IOException {
+        ByteArrayOutputStream line = new ByteArrayOutputStream();
+        int c;
+        while ((c = in.read()) != '\n') {
+            if (c < 0) {
+                return null;
+            }
+            line.write(c);
+        }
+        return new String(line.toByteArray(), UTF8);
+    }
+
+    /**
+     * Sends everything written to it to the client as xml frames.
+     * Closing it only flushes the last chunk, so the client
+     * connection stays open.
+     */
+    private class XMLFrameWriter extends Writer {
+        private final StringBuilder buffer = new StringBuilder();
+
+        public void write(char[] cbuf, int off, int len) throws IOException {
+            buffer.append(cbuf, off, len);
+            if (buffer.length() >= XML_CHUNK_SIZE) {
+                flush();
+            }
+        }
+
+        public void flush() throws IOException {
+            if (buffer.length() > 0) {
+                frame("xml", buffer.toString());
+                buffer.setLength(0);
+                out.flush();
+            }
+        }
+
+        public void close() throws IOException {
+            flush();
+        }
+    }
+}
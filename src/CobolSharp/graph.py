@@ -1,6 +1,7 @@
 # Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
 # Licensed under GPLv3, see file LICENSE in the top directory
 
+from array import array
 from collections import defaultdict
 
 import networkx as nx
@@ -26,19 +27,45 @@ class StmtGraph(object):
     """Holds a directional graph of statements as nodes including the
     Entry and Exit nodes.
 
-    Conditional edges are labeled with the attribution 'condition',
-    whose value is either True or False.
+    The nodes are numbered by their position in the list 'nodes', and
+    the dict 'ids' maps them back to the numbers.  The edges are held
+    in compressed sparse row arrays indexed by the node numbers: the
+    successors of node i are succ[succ_start[i]:succ_start[i + 1]],
+    and the predecessors are held likewise in pred_start and pred.
+    'ids' and the predecessor arrays are only built when first used.
 
-    If the graph itself needs to be referenced it is held in the
-    object property "graph".
+    Conditional edges are labeled with a condition, which is either
+    True or False.  The array 'conditions' holds the condition of each
+    edge in 'succ', or -1 for unconditional edges.
+
+    A networkx DiGraph of the statements is available in the property
+    "graph", e.g. for writing DOT files.  It is only built when used.
     """
     def __init__(self):
-        self.graph = nx.DiGraph()
+        self.nodes = []
+        self.succ_start = array('i', [0])
+        self.succ = array('i')
+        self.conditions = array('b')
+        self._ids = None
+        self._pred_start = None
+        self._pred = None
+        self._graph = None
+
+        # Edges are collected here until _index_edges() is called
+        self._edge_src = array('i')
+        self._edge_dest = array('i')
+        self._edge_conditions = array('b')
 
     @classmethod
     def from_section(cls, section):
         """Translate a Cobol Section into a statement graph.
+
+        If the parser recorded the statement links of the section,
+        the graph just wraps them.
         """
+        if section.stmt_links is not None:
+            return cls.from_links(section.stmt_links)
+
         graph = cls()
 
         for para in section.paras.values():
@@ -58,30 +85,329 @@ class StmtGraph(object):
                         raise RuntimeError('Unexpected statement type: {}'.format(stmt))
 
         graph._add_edge(Entry, section.get_first_stmt())
+        graph._index_edges()
+
+        return graph
 
+    @classmethod
+    def from_links(cls, links):
+        """Return a statement graph sharing the arrays of a StmtLinks."""
+        graph = cls()
+        graph.nodes = links.nodes
+        graph.succ_start = links.succ_start
+        graph.succ = links.succ
+        graph.conditions = links.conditions
+        del graph._edge_src, graph._edge_dest, graph._edge_conditions
         return graph
 
-    def _add_edge(self, src, dest, **attr):
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = { node: i for i, node in enumerate(self.nodes) }
+        return self._ids
+
+    @property
+    def pred_start(self):
+        if self._pred_start is None:
+            self._index_preds()
+        return self._pred_start
+
+    @property
+    def pred(self):
+        if self._pred is None:
+            self._index_preds()
+        return self._pred
+
+    def _node_id(self, node):
+        ids = self.ids
+        try:
+            return ids[node]
+        except KeyError:
+            i = ids[node] = len(self.nodes)
+            self.nodes.append(node)
+            return i
+
+    def _add_edge(self, src, dest, condition=None):
+        # All edges from a node must be added one after another, so
+        # a duplicate edge is always the previous one.  Like in a
+        # DiGraph it replaces the condition of that edge.
         if dest is None:
             dest = Exit
-        self.graph.add_edge(src, dest, attr)
+
+        src_id = self._node_id(src)
+        dest_id = self._node_id(dest)
+        condition = -1 if condition is None else int(condition)
+
+        edge_src = self._edge_src
+        if edge_src and edge_src[-1] == src_id and self._edge_dest[-1] == dest_id:
+            self._edge_conditions[-1] = condition
+        else:
+            edge_src.append(src_id)
+            self._edge_dest.append(dest_id)
+            self._edge_conditions.append(condition)
+
+    def _index_edges(self):
+        src = self._edge_src
+        dest = self._edge_dest
+        conditions = self._edge_conditions
+        del self._edge_src, self._edge_dest, self._edge_conditions
+
+        self.succ_start, order = _csr_order(len(self.nodes), src)
+        self.succ = array('i', [dest[i] for i in order])
+        self.conditions = array('b', [conditions[i] for i in order])
+
+    def _index_preds(self):
+        succ_start = self.succ_start
+        src = array('i')
+        for i in range(len(self.nodes)):
+            src.extend(array('i', [i]) * (succ_start[i + 1] - succ_start[i]))
+
+        self._pred_start, order = _csr_order(len(self.nodes), self.succ)
+        self._pred = array('i', [src[i] for i in order])
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def stmt_graph(self):
+        """The graph holding the node and edge arrays, i.e. this one,
+        like in ReachableStmtGraph.
+        """
+        return self
+
+    def node_ids(self):
+        """Return the node numbers in graph order."""
+        return range(len(self.nodes))
+
+    def in_degrees(self):
+        """Return an array with the in-degree of each node number."""
+        in_degrees = array('i', [0]) * len(self.nodes)
+        for i in self.succ:
+            in_degrees[i] += 1
+        return in_degrees
+
+    def successors(self, node):
+        i = self.ids[node]
+        nodes = self.nodes
+        return [nodes[j] for j in self.succ[self.succ_start[i] : self.succ_start[i + 1]]]
+
+    def predecessors(self, node):
+        i = self.ids[node]
+        nodes = self.nodes
+        pred_start = self.pred_start
+        return [nodes[j] for j in self.pred[pred_start[i] : pred_start[i + 1]]]
+
+    def in_degree(self, node):
+        i = self.ids[node]
+        pred_start = self.pred_start
+        return pred_start[i + 1] - pred_start[i]
+
+    def out_degree(self, node):
+        i = self.ids[node]
+        return self.succ_start[i + 1] - self.succ_start[i]
+
+    def edges(self):
+        """Generate a tuple (src, dest, condition) for each edge, where
+        condition is True, False or None.
+        """
+        nodes = self.nodes
+        succ_start = self.succ_start
+        for i, src in enumerate(nodes):
+            for j in range(succ_start[i], succ_start[i + 1]):
+                condition = self.conditions[j]
+                yield src, nodes[self.succ[j]], None if condition < 0 else bool(condition)
+
+    @property
+    def graph(self):
+        """A networkx DiGraph of the statements, built when first used."""
+        if self._graph is None:
+            graph = nx.DiGraph()
+            graph.add_nodes_from(self.nodes)
+            for src, dest, condition in self.edges():
+                if condition is None:
+                    graph.add_edge(src, dest)
+                else:
+                    graph.add_edge(src, dest, condition=condition)
+            self._graph = graph
+
+        return self._graph
 
     def reachable_subgraph(self):
-        """Return a new StmtGraph that only contains the nodes reachable from
-        Entry.
+        """Return a ReachableStmtGraph view of the nodes reachable
+        from Entry.
+        """
+        return ReachableStmtGraph(self)
+
+    def _entry_id(self):
+        # from_section() adds Entry last, so this usually doesn't
+        # have to build the ids
+        last = len(self.nodes) - 1
+        if self.nodes[last] is Entry:
+            return last
+        return self.ids[Entry]
+
+
+    def print_stmts(self):
+        stmts = sorted(self.nodes, key = lambda s: s.source.from_char)
+        for stmt in stmts:
+            print(stmt)
+
+
+class ReachableStmtGraph(object):
+    """A view of the nodes in a StmtGraph that are reachable from
+    Entry, with the same queries as a StmtGraph.
+
+    The view shares the nodes and edges of the full graph in
+    'stmt_graph', and only adds arrays with the reachable nodes in
+    depth-first order and their in-degrees within the view.
+    Iterating over the view gives the nodes in the same order as a
+    separate graph built from nx.edge_dfs() would.
+
+    'dead_stmts' is the number of statements that are pruned, since
+    they can't be reached.
+    """
+
+    def __init__(self, stmt_graph):
+        self.stmt_graph = stmt_graph
+        self._graph = None
+
+        nodes = stmt_graph.nodes
+        succ_start = stmt_graph.succ_start
+        succ = stmt_graph.succ
+
+        # Position of each node in the view, or -1 if not reachable
+        position = self._position = array('i', [-1]) * len(nodes)
+        in_degrees = self._in_degrees = array('i', [0]) * len(nodes)
+        order = self._order = array('i')
+        next_edge = array('i', [-1]) * len(nodes)
+
+        entry = stmt_graph._entry_id()
+        position[entry] = 0
+        order.append(entry)
+        stack = [entry]
+
+        # Walk the edges depth first, like nx.edge_dfs()
+        while stack:
+            i = stack[-1]
+            j = next_edge[i]
+            if j < 0:
+                j = succ_start[i]
+
+            if j == succ_start[i + 1]:
+                stack.pop()
+            else:
+                next_edge[i] = j + 1
+                dest = succ[j]
+                in_degrees[dest] += 1
+                if position[dest] < 0:
+                    position[dest] = len(order)
+                    order.append(dest)
+                stack.append(dest)
+
+        self.dead_stmts = sum(1 for i, node in enumerate(nodes)
+                              if position[i] < 0 and node is not Exit)
+
+    def __iter__(self):
+        nodes = self.stmt_graph.nodes
+        return (nodes[i] for i in self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, node):
+        i = self.stmt_graph.ids.get(node)
+        return i is not None and self._position[i] >= 0
+
+    @property
+    def nodes(self):
+        """List of the reachable nodes."""
+        return list(self)
+
+    def node_ids(self):
+        """Return the numbers of the reachable nodes in 'stmt_graph',
+        in graph order.
+        """
+        return self._order
+
+    def in_degrees(self):
+        """Return an array with the in-degree within the view of each
+        node number in 'stmt_graph'.
+        """
+        return self._in_degrees
+
+    def successors(self, node):
+        # All successors of a reachable node are reachable
+        return self.stmt_graph.successors(node)
+
+    def predecessors(self, node):
+        ids = self.stmt_graph.ids
+        position = self._position
+        return [n for n in self.stmt_graph.predecessors(node) if position[ids[n]] >= 0]
+
+    def in_degree(self, node):
+        return self._in_degrees[self.stmt_graph.ids[node]]
+
+    def out_degree(self, node):
+        return self.stmt_graph.out_degree(node)
+
+    def edges(self):
+        """Generate a tuple (src, dest, condition) for each edge, where
+        condition is True, False or None.
+        """
+        graph = self.stmt_graph
+        nodes = graph.nodes
+        succ_start = graph.succ_start
+        for i in self._order:
+            for j in range(succ_start[i], succ_start[i + 1]):
+                condition = graph.conditions[j]
+                yield nodes[i], nodes[graph.succ[j]], None if condition < 0 else bool(condition)
+
+    @property
+    def graph(self):
+        """A networkx DiGraph of the reachable statements, built when
+        first used.  Like the subgraph built from nx.edge_dfs() that
+        this view replaces, the edges have no condition data.
         """
-        sub_graph = StmtGraph()
-        sub_graph.graph.add_edges_from(nx.edge_dfs(self.graph, Entry))
-        return sub_graph
+        if self._graph is None:
+            graph = nx.DiGraph()
+            graph.add_nodes_from(self)
+            graph.add_edges_from((src, dest) for src, dest, condition in self.edges())
+            self._graph = graph
 
+        return self._graph
+
+    def reachable_subgraph(self):
+        return self
 
     def print_stmts(self):
-        stmts = self.graph.nodes()
-        stmts.sort(key = lambda s: s.source.from_char)
+        stmts = sorted(self, key = lambda s: s.source.from_char)
         for stmt in stmts:
             print(stmt)
 
 
+def _csr_order(num_nodes, keys):
+    """Sort edges by the node numbers in 'keys', keeping the order of
+    edges with the same key.  Returns a tuple (start, order), where
+    start is the row index array and order the sorted edge positions.
+    """
+    start = array('i', [0]) * (num_nodes + 1)
+    for key in keys:
+        start[key + 1] += 1
+    for i in range(num_nodes):
+        start[i + 1] += start[i]
+
+    pos = start[:-1]
+    order = array('i', [0]) * len(keys)
+    for i, key in enumerate(keys):
+        order[pos[key]] = i
+        pos[key] += 1
+
+    return start, order
+
+
 class StructureGraphBase(object):
     def __init__(self, debug=False):
         self.graph = nx.MultiDiGraph()
@@ -172,68 +498,95 @@ class CobolStructureGraph(StructureGraphBase):
 
     @classmethod
     def from_stmt_graph(cls, stmt_graph):
+        """Build the graph from a StmtGraph or ReachableStmtGraph.
+
+        Chains of sequential statements are compressed into the edges
+        between the nodes by following the successor arrays of the
+        statement graph, so each statement is only visited once.
+        """
         cobol_graph = cls()
 
+        arrays = stmt_graph.stmt_graph
+        stmts = arrays.nodes
+        in_degrees = stmt_graph.in_degrees()
+
         branch_nodes = []
         join_nodes = []
-        node_stmts = {}
+
+        # The structure node of each statement number, or None for
+        # statements that are only part of a chain
+        node_stmts = [None] * len(stmts)
+        entry = None
 
         # Find all stmts that are branches or joins and wrap them
-        for stmt in stmt_graph.graph:
+        for i in stmt_graph.node_ids():
+            stmt = stmts[i]
             if isinstance(stmt, BranchStatement):
                 n = Branch(stmt)
-                branch_nodes.append(n)
-                node_stmts[stmt] = n
+                branch_nodes.append((i, n))
+                node_stmts[i] = n
 
             elif isinstance(stmt, TerminatingStatement):
-                node_stmts[stmt] = Exit
+                node_stmts[i] = Exit
 
             elif stmt is Exit:
-                node_stmts[Exit] = Exit
+                node_stmts[i] = Exit
+
+            elif stmt is Entry:
+                entry = i
 
-            elif stmt_graph.graph.in_degree(stmt) > 1:
+            elif in_degrees[i] > 1:
                 n = Join(stmt)
-                join_nodes.append(n)
-                node_stmts[stmt] = n
+                join_nodes.append((i, n))
+                node_stmts[i] = n
+
+        succ_start = arrays.succ_start
+        succ = arrays.succ
+        conditions = arrays.conditions
 
         # Add statements from Entry node
-        nbrs = stmt_graph.graph.successors(Entry)
-        assert len(nbrs) == 1
-        cobol_graph._add_branch_edge(stmt_graph, node_stmts, Entry, nbrs[0])
+        assert succ_start[entry + 1] - succ_start[entry] == 1
+        cobol_graph._add_chain_edge(arrays, node_stmts, Entry, [], succ[succ_start[entry]])
 
         # Add statements from each Branch node
-        for node in branch_nodes:
-            cobol_graph._add_branch_edge(stmt_graph, node_stmts, node, node.stmt.true_stmt, condition=True)
-            cobol_graph._add_branch_edge(stmt_graph, node_stmts, node, node.stmt.false_stmt, condition=False)
-
-        # Add statements from all join nodes,
-        for node in join_nodes:
-            # Temporarily drop it to avoid detecting false self-loop
-            del node_stmts[node.stmt]
-            cobol_graph._add_branch_edge(stmt_graph, node_stmts, node, node.stmt)
-            node_stmts[node.stmt] = node
+        for i, node in branch_nodes:
+            # If both branches go to the same statement there is only
+            # a single edge
+            true_id = false_id = None
+            for j in range(succ_start[i], succ_start[i + 1]):
+                if conditions[j]:
+                    true_id = succ[j]
+                else:
+                    false_id = succ[j]
+
+            if true_id is None:
+                true_id = false_id
+
+            cobol_graph._add_chain_edge(arrays, node_stmts, node, [], true_id, condition=True)
+            cobol_graph._add_chain_edge(arrays, node_stmts, node, [], false_id, condition=False)
+
+        # Add statements from all join nodes, which start with the
+        # join statement itself.  If the chain leads back to the join,
+        # it becomes a self-loop.
+        for i, node in join_nodes:
+            cobol_graph._add_chain_edge(arrays, node_stmts, node, [node.stmt], succ[succ_start[i]])
 
         return cobol_graph
 
 
-    def _add_branch_edge(self, stmt_graph, node_stmts, source_node, start_stmt, **attrs):
-        stmt = start_stmt or Exit
-        stmts = []
-        dest_node = None
-
-        while stmt not in node_stmts:
-            stmts.append(stmt)
-            nbrs = stmt_graph.graph.successors(stmt)
-            assert len(nbrs) == 1
-            stmt = nbrs[0]
+    def _add_chain_edge(self, stmt_graph, node_stmts, source_node, stmts, start, **attrs):
+        # Follow the single successor of each chain statement until
+        # reaching a node
+        nodes = stmt_graph.nodes
+        succ_start = stmt_graph.succ_start
+        succ = stmt_graph.succ
 
-            if stmt is start_stmt:
-                # This is a self-loop
-                dest_node = source_node
-                break
-
-        if dest_node is None:
-            dest_node = node_stmts[stmt]
+        i = start
+        dest_node = node_stmts[i]
+        while dest_node is None:
+            stmts.append(nodes[i])
+            i = succ[succ_start[i]]
+            dest_node = node_stmts[i]
 
         attrs['stmts'] = stmts
         self.graph.add_edge(source_node, dest_node, attr_dict=attrs)
@@ -277,18 +630,32 @@ class AcyclicStructureGraph(StructureGraphBase):
         # which can all reach the other ones via some path through the
         # component.
 
-        # Since loops can contain loops, this is done repeatedly until all
-        # loops have been broken.  At this stage single-node loops are ignored,
-        # since nx.strongly_connected_components() returns components also
+        # Loops can contain loops, so this is done one level at a time
+        # until all loops have been broken.  The components of each
+        # level are broken in the order nx.strongly_connected_components()
+        # finds them in the whole graph, since that order decides the
+        # order of the loops.  To avoid searching the whole graph again
+        # for every level, _LoopSearch leaves out the parts of the graph
+        # that can't change that order.
+        #
+        # At this stage single-node loops are ignored, since
+        # nx.strongly_connected_components() returns components also
         # consisting of a single nodes without any self-looping edge.
-        while True:
-            components = [c for c in nx.strongly_connected_components(dag.graph)
-                          if len(c) > 1]
-            if not components:
-                break
-
-            for component in components:
-                dag._break_component_loop(component)
+        search = _LoopSearch(dag.graph)
+        components = search.components()
+
+        if search.complete:
+            while components:
+                loops = [dag._break_component_loop(component)
+                         for component in components]
+                search.break_loops(components, loops)
+                components = search.components()
+        else:
+            components = _graph_loop_components(dag.graph)
+            while components:
+                for component in components:
+                    dag._break_component_loop(component)
+                components = _graph_loop_components(dag.graph)
 
         # Finally find any remaining single-node loops
         for node in list(dag.graph):
@@ -336,6 +703,8 @@ class AcyclicStructureGraph(StructureGraphBase):
             assert isinstance(start_node, (Loop, Branch))
             self.graph.add_edge(loop, start_node, stmts=[])
 
+        return loop
+
 
     def _find_loop_start(self, component):
         # The node with the most in edges from the rest of the graph
@@ -345,6 +714,170 @@ class AcyclicStructureGraph(StructureGraphBase):
             if pred not in component)))
 
 
+def _graph_loop_components(graph):
+    """Return the strongly connected components with more than one
+    node in the whole graph.
+    """
+    return [c for c in nx.strongly_connected_components(graph) if len(c) > 1]
+
+
+class _LoopSearch(object):
+    """Find the strongly connected components with more than one node
+    in a graph, again after each time their loops have been broken, in
+    the same order as nx.strongly_connected_components() would find
+    them in the whole graph.
+
+    That order is decided by a depth-first search from the first node
+    in the graph.  Once the first search is done, the nodes outside the
+    components only affect the order in which the search reaches the
+    components.  Nodes that can't reach any component are dropped, and
+    nodes that can only lead on to a single other node are bypassed, so
+    later searches only visit the components and the nodes where the
+    paths to them fork.
+
+    This relies on all nodes being reachable from the first node, which
+    mustn't be part of a loop, as is the case for the Entry node of a
+    CobolStructureGraph.  After the first search, complete is False if
+    that isn't so and the whole graph must be searched again instead.
+    """
+
+    def __init__(self, graph):
+        self.complete = None
+        self._graph = graph
+        self._dead = set()
+        self._bypass = {}
+        self._order = []
+
+
+    def components(self):
+        """Return the components with more than one node"""
+
+        succ = self._graph.succ
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        order = []
+        components = []
+
+        root = self._resolve(next(iter(self._graph), None))
+        if root is None:
+            self.complete = False
+            return components
+
+        # Iterative Tarjan, since loops may be nested very deep
+        index[root] = lowlink[root] = 0
+        stack.append(root)
+        on_stack.add(root)
+        queue = [(root, iter(succ[root]))]
+
+        while queue:
+            node, succ_iter = queue[-1]
+            for dest in succ_iter:
+                dest = self._resolve(dest)
+                if dest is None:
+                    continue
+
+                if dest not in index:
+                    index[dest] = lowlink[dest] = len(index)
+                    stack.append(dest)
+                    on_stack.add(dest)
+                    queue.append((dest, iter(succ[dest])))
+                    break
+
+                if dest in on_stack and index[dest] < lowlink[node]:
+                    lowlink[node] = index[dest]
+            else:
+                queue.pop()
+                if queue:
+                    parent = queue[-1][0]
+                    if lowlink[node] < lowlink[parent]:
+                        lowlink[parent] = lowlink[node]
+
+                if lowlink[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        order.append(member)
+                        component.add(member)
+                        if member is node:
+                            break
+
+                    if len(component) > 1:
+                        components.append(component)
+
+        if self.complete is None:
+            self.complete = (len(index) == len(self._graph) and
+                             not any(root in c for c in components))
+
+        # Components are found in reverse topological order, so the
+        # nodes can be reduced after their successors
+        self._order = order
+        return components
+
+
+    def break_loops(self, components, loops):
+        """Update the search after the components returned by the
+        last call to components() have been broken into loops.
+        """
+
+        members = set()
+        for component, loop in zip(components, loops):
+            members.update(component)
+
+            # A Join start node is replaced by its Loop node
+            for node in component:
+                if node not in self._graph:
+                    self._bypass[node] = loop
+
+        for loop in loops:
+            self._reduce(loop.continue_loop)
+            self._reduce(loop)
+
+        # The nodes no longer in any component, and the forks left
+        # from earlier searches
+        for node in self._order:
+            if node not in members:
+                self._reduce(node)
+
+
+    def _reduce(self, node):
+        dests = set()
+        for dest in self._graph.succ[node]:
+            dest = self._resolve(dest)
+            if dest is not None and dest is not node:
+                dests.add(dest)
+                if len(dests) > 1:
+                    return
+
+        if dests:
+            self._bypass[node] = dests.pop()
+        else:
+            self._dead.add(node)
+
+
+    def _resolve(self, node):
+        """Return the node that the search should visit instead of
+        node, or None if it can be skipped.
+        """
+
+        bypass = self._bypass
+        if node in bypass:
+            path = []
+            while node in bypass:
+                path.append(node)
+                node = bypass[node]
+
+            for bypassed in path:
+                bypass[bypassed] = node
+
+        if node in self._dead:
+            return None
+
+        return node
+
+
 class ScopeStructuredGraph(StructureGraphBase):
     """An structured graph that has been analysed to isolate scopes
     (i.e. nested loops) by removing cross-scope edges.  The purpose is
@@ -378,6 +911,13 @@ class ScopeStructuredGraph(StructureGraphBase):
         # Map (scope, dest) node -> GotoNode objects
         self._goto_nodes = {}
 
+        # Map scope -> set of nodes in it with edges leaving the scope,
+        # kept up to date by _add_edge() and _remove_node()
+        self._scope_exits = defaultdict(set)
+
+        # Map node -> position in graph, to find edges in graph order
+        self._node_order = {}
+
 
     def flatten_block(self, keep_all_cobol_stmts=False):
         """Translate the graph structure to a Block of CobolStatement or
@@ -393,7 +933,8 @@ class ScopeStructuredGraph(StructureGraphBase):
         scope_graph = cls(debug=debug)
 
         # Copy by way of edges, to avoid getting copies of the node objects
-        scope_graph.graph.add_edges_from(acyclic_graph.graph.edges(keys=True, data=True))
+        for src, dest, key, data in acyclic_graph.graph.edges_iter(keys=True, data=True):
+            scope_graph._add_edge(src, dest, key, data)
 
         # Find nodes that are LoopExits
         for loop in acyclic_graph._loops:
@@ -466,17 +1007,17 @@ class ScopeStructuredGraph(StructureGraphBase):
         loop.loop_exit = loop_exit
 
         # Remove the branch and move the edges to the loop node
-        self.graph.remove_node(branch)
-        self.graph.add_edge(loop, then_node, stmts=then_data['stmts'], condition=True)
-        self.graph.add_edge(loop, loop_exit, stmts=[], condition=False)
+        self._remove_node(branch)
+        self._add_edge(loop, then_node, stmts=then_data['stmts'], condition=True)
+        self._add_edge(loop, loop_exit, stmts=[], condition=False)
 
         # Move any other loop scope edges to the else node to the loop exit node
         for src, dest, key, data in self.graph.in_edges(else_node, keys=True, data=True):
             if src.scope is loop:
                 self.graph.remove_edge(src, dest, key)
-                self.graph.add_edge(src, loop_exit, key, data)
+                self._add_edge(src, loop_exit, key, data)
 
-        self.graph.add_edge(loop_exit, else_node, stmts=[])
+        self._add_edge(loop_exit, else_node, stmts=[])
 
         return True
 
@@ -485,10 +1026,15 @@ class ScopeStructuredGraph(StructureGraphBase):
         # Map from exit nodes to their in edges from this loop scope
         exit_edges = defaultdict(list)
 
-        for edge in self.graph.edges_iter(keys=True, data=True):
-            src, dest, key, data = edge
-            if dest is not Exit and src.scope is loop and dest.scope is loop.scope:
-                exit_edges[dest].append(edge)
+        # Only the nodes with edges leaving the scope need to be
+        # checked, but in graph order to find the edges in the same
+        # order as self.graph.edges_iter()
+        sources = sorted(self._scope_exits[loop], key=self._node_order.__getitem__)
+        for src in sources:
+            for dest, key_data in self.graph.succ[src].items():
+                if dest is not Exit and dest.scope is loop.scope:
+                    for key, data in key_data.items():
+                        exit_edges[dest].append((src, dest, key, data))
 
         if not exit_edges:
             # No loop exits
@@ -517,11 +1063,11 @@ class ScopeStructuredGraph(StructureGraphBase):
         loop_exit.scope = exit_node.scope
         loop.loop_exit = loop_exit
 
-        self.graph.add_edge(loop_exit, exit_node, stmts=[])
+        self._add_edge(loop_exit, exit_node, stmts=[])
 
         for src, dest, key, data in edges:
             self.graph.remove_edge(src, dest, key)
-            self.graph.add_edge(src, loop_exit, key, data)
+            self._add_edge(src, loop_exit, key, data)
 
         if self._debug:
             loop.stmt.comment = 'cobolsharp: loop exit candidates:\n{}'.format(
@@ -538,12 +1084,12 @@ class ScopeStructuredGraph(StructureGraphBase):
         for src, dest, key, data in edges:
             if src is not continue_node.loop and src.scope is not continue_node.loop:
                 self.graph.remove_edge(src, dest, key)
-                self.graph.add_edge(src, continue_node.loop, key, data)
+                self._add_edge(src, continue_node.loop, key, data)
 
         # Remove the continue if it was all turned into gotos
         if self.graph.in_degree(continue_node) == 0:
-            continue_node.loop.continue_node = None
-            self.graph.remove_node(continue_node)
+            continue_node.loop.continue_loop = None
+            self._remove_node(continue_node)
 
 
     def _goto_node(self, src, dest, key, data):
@@ -557,4 +1103,24 @@ class ScopeStructuredGraph(StructureGraphBase):
             self._goto_nodes[(src.scope, dest)] = goto_node
 
         self.graph.remove_edge(src, dest, key)
-        self.graph.add_edge(src, goto_node, key, data)
+        self._add_edge(src, goto_node, key, data)
+
+
+    def _add_edge(self, src, dest, key=None, attr_dict=None, **attrs):
+        """Add an edge to the graph, updating the scope exit index."""
+        for node in (src, dest):
+            if node not in self._node_order:
+                self._node_order[node] = len(self._node_order)
+
+        self.graph.add_edge(src, dest, key, attr_dict, **attrs)
+
+        # Removed edges are left in the index, since they are
+        # filtered out when looking for the exits of a scope
+        if src.scope is not dest.scope:
+            self._scope_exits[src.scope].add(src)
+
+
+    def _remove_node(self, node):
+        """Remove a node from the graph and the scope exit index."""
+        self.graph.remove_node(node)
+        self._scope_exits[node.scope].discard(node)
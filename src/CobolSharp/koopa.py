@@ -7,111 +7,617 @@
 
 # java -cp ~/src/koopa-r356.jar -Dkoopa.xml.include_positioning=true koopa.app.cli.ToXml testsyntax.cbl /tmp/testsyntax.xml
 
+import codecs
+import mmap
 import subprocess
 import os
+import re
+import select
 import sys
+import zipfile
 from pkg_resources import resource_filename
-from tempfile import NamedTemporaryFile
 import xml.etree.ElementTree as ET
 
 from .syntax import *
 
 KOOPA_JAR = 'data/koopa-r356.jar'
+KOOPA_SERVER_JAR = 'data/cobolsharp-koopa.jar'
+
+# Koopa needs roughly 700 bytes of heap per byte of source code to
+# parse without thrashing the garbage collector, so 'auto' heap sizing
+# gives it a bit more than that.
+AUTO_HEAP_MIN_MB = 128
+AUTO_HEAP_PER_SOURCE_BYTE = 1024
+
+# The encoding Koopa reads the source code in, see KoopaServer.stream_xml()
+SOURCE_ENCODING = 'iso8859-1'
+
+# Seconds to wait for any output from the Koopa server before it is
+# assumed to hang.  Koopa is silent while parsing, so this must cover
+# the parse of the largest program.
+KOOPA_TIMEOUT = 600
 
 class ParserError(Exception): pass
 
-def parse(source, java_binary='java', tabsize=4):
+class KoopaProtocolError(Exception):
+    """The Koopa server sent something that isn't a response frame."""
+
+def parse(source, java_binary='java', tabsize=4, server=None,
+          java_heap='auto', java_opts=(), java_cds=None, cache=None):
     """Parse Cobol code in 'source', which must be a text file-like object
-    with a read() method or a string.
+    with a read() method, a string or a SourceBytes.
+
+    If 'server' is a KoopaServer it is used to run Koopa, instead of
+    starting a new JVM.  Otherwise java_heap, java_opts and java_cds
+    are used to start the JVM, see KoopaServer.
+
+    If 'cache' is a ParseCache, Koopa is only run if the code isn't
+    already in the cache.  The warnings from parsing the program are
+    written to stderr again when it is loaded from the cache.
 
     Returns a Program object.
     """
-    return ProgramParser(source, java_binary, tabsize).program
+    code, code_path = read_source(source)
 
+    if cache is not None:
+        program = cache.load(code, code_path, tabsize)
+        if program is not None:
+            return program
 
-def run_koopa(source, output_path, java_binary='java', tabsize=4):
+    if server is None:
+        with KoopaServer(java_binary, java_heap, java_opts, java_cds) as server:
+            parser = ProgramParser(code, code_path, java_binary, tabsize, server)
+    else:
+        parser = ProgramParser(code, code_path, java_binary, tabsize, server)
+
+    if cache is not None:
+        cache.store(code, tabsize, parser.program, parser.warnings)
+
+    return parser.program
+
+
+def parse_many(paths, java_binary='java', tabsize=4, encoding='iso-8859-1', server=None,
+               java_heap='auto', java_opts=(), java_cds=None, cache=None):
+    """Parse the Cobol source files in the list 'paths' with a single
+    Koopa JVM.  If 'server' is a KoopaServer it is used, otherwise a
+    server is started for the batch with java_heap, java_opts and
+    java_cds.  If 'cache' is a ParseCache it is used for all files.
+
+    Generates a Program object for each path, in order.  If a file
+    could not be read or parsed, the ParserError is generated in its
+    place instead, so that one bad file doesn't stop the rest of the
+    batch.
+    """
+    own_server = server is None
+    if own_server:
+        server = KoopaServer(java_binary, java_heap, java_opts, java_cds)
+
+    try:
+        for path in paths:
+            try:
+                source = map_source(path, encoding)
+                if source is not None:
+                    with source:
+                        program = parse(source, java_binary, tabsize, server=server, cache=cache)
+                else:
+                    with open(path, 'rt', encoding=encoding, newline='') as source_file:
+                        program = parse(source_file, java_binary, tabsize, server=server, cache=cache)
+            except ParserError as e:
+                yield e
+            except (OSError, UnicodeError) as e:
+                yield ParserError('{}: {}'.format(path, e))
+            else:
+                yield program
+    finally:
+        if own_server:
+            server.close()
+
+
+def run_koopa(source, output_path, java_binary='java', tabsize=4, server=None,
+              java_heap='auto', java_opts=(), java_cds=None):
     """Run Koopa to parse 'source', either a text file-like object with a
-    read() method or a string, into an XML document saved to
-    output_path.
+    read() method, a string or a SourceBytes, into an XML document
+    saved to output_path.
+
+    If 'server' is a KoopaServer it is used to run Koopa, instead of
+    starting a new JVM with java_heap, java_opts and java_cds.
 
-    Returns the Cobol source code as a string, with expanded tabs.
+    Returns the Cobol source code as a string, or the SourceBytes.
     """
+    if server is None:
+        with KoopaServer(java_binary, java_heap, java_opts, java_cds) as server:
+            return run_koopa(source, output_path, java_binary, tabsize, server)
+
+    code, code_path = read_source(source)
+
+    try:
+        with open(output_path, 'wb') as output_file:
+            stream_xml(code, code_path, output_file.write, java_binary, server)
+    except ParserError:
+        os.remove(output_path)
+        raise
+
+    return code
 
-    if hasattr(source, 'read'):
-        code = source.read()
-        code_path = source.name
+
+def map_source(path, encoding):
+    """Memory-map the Cobol source file 'path' into a SourceBytes, if
+    the file 'encoding' is what Koopa reads.  Then the file contents
+    can be passed on to Koopa as they are, and are only decoded if the
+    program text is needed.
+
+    Returns None if the file must be read as text instead.  The
+    SourceBytes should be closed when the file has been parsed.
+    """
+    try:
+        if codecs.lookup(encoding).name != SOURCE_ENCODING:
+            return None
+    except LookupError:
+        return None
+
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Empty files and pipes can't be mapped
+            data = f.read()
+
+    return SourceBytes(data, encoding, path)
+
+
+def read_source(source):
+    """Read 'source', either a text file-like object with a read() method,
+    a string or a SourceBytes.  Returns a tuple (code, code_path).
+    """
+    if isinstance(source, SourceBytes):
+        return source, source.name or '<bytes>'
+    elif hasattr(source, 'read'):
+        return source.read(), source.name
     elif isinstance(source, str):
-        code = source
-        code_path = '<string>'
+        return source, '<string>'
     else:
-        raise TypeError('source must be a file-like object or a string')
+        raise TypeError('source must be a file-like object, a string or a SourceBytes')
+
+
+def stream_xml(code, code_path, feed, java_binary='java', server=None):
+    """Run Koopa on the Cobol source code in 'code', a string or a
+    SourceBytes, passing
+    the resulting XML document in chunks of bytes to the function
+    'feed' while Koopa is writing it.  code_path is only used in error
+    messages.
+
+    If 'server' is a KoopaServer it is used to run Koopa, instead of
+    starting a new JVM.
+
+    Raises ParserError if the code could not be parsed.
+    """
+    if server is None:
+        with KoopaServer(java_binary) as server:
+            return stream_xml(code, code_path, feed, java_binary, server)
+
+    ok, messages = server.stream_xml(code, code_path, feed)
+
+    # Koopa doesn't flag all parse errors as failures...
+    if not ok or 'Error:' in messages:
+        raise ParserError(messages)
+
+
+def java_command(java_binary, main_class, *args, heap_mb=None, java_opts=(), java_cds=None):
+    """Return the command line to run 'main_class' with Koopa on the class path.
+
+    heap_mb sets the maximum heap size in megabytes, and java_opts are
+    additional JVM arguments.  If java_cds is set it is the path of a
+    class data sharing archive, which is created by the JVM if it is
+    missing or out of date (requires Java 19 or later).
+    """
+    koopa_jar = resource_filename('CobolSharp', KOOPA_JAR)
+    if java_cds is not None:
+        koopa_jar = cds_koopa_jar(koopa_jar, java_cds)
+
+    classpath = os.pathsep.join((koopa_jar, resource_filename('CobolSharp', KOOPA_SERVER_JAR)))
+
+    cmd = [java_binary, '-cp', classpath]
+
+    if heap_mb is not None:
+        cmd.append('-Xmx{}m'.format(heap_mb))
+
+    if java_cds is not None:
+        cmd.extend(('-XX:SharedArchiveFile={}'.format(java_cds), '-XX:+AutoCreateSharedArchive'))
+
+    cmd.extend(java_opts)
+    cmd.extend(('-Dkoopa.xml.include_positioning=true', main_class))
+    cmd.extend(args)
+    return tuple(cmd)
+
+
+def cds_koopa_jar(koopa_jar, java_cds):
+    """Return the path to a copy of koopa_jar stored next to the class
+    data sharing archive java_cds, creating it if needed.
+
+    The Koopa jar manifest puts its own directory on the class path,
+    and the JVM refuses to archive classes when a non-empty directory
+    is on the class path.  The copy is identical except for that.
+    """
+    copy_path = os.path.splitext(java_cds)[0] + '-' + os.path.basename(koopa_jar)
 
-    source_file = None
     try:
-        # Regardless of source encoding, save as a single-byte encoding since Cobol parsing
-        # should only need ascii chars.  Saving as UTF-8 or similar means that the character
-        # ranges reported by koopa will be offset from the data in self._code, breaking extracting
-        # symbols etc.
+        if os.path.getmtime(copy_path) >= os.path.getmtime(koopa_jar):
+            return copy_path
+    except OSError:
+        pass
 
-        # But save as iso-8859-1, to keep more national chars in comments.
-        # TODO: use input file encoding if it is single-byte.
+    tmp_path = copy_path + '.tmp'
+    with zipfile.ZipFile(koopa_jar) as src, zipfile.ZipFile(tmp_path, 'w') as dest:
+        for info in src.infolist():
+            data = src.read(info)
+            if info.filename == 'META-INF/MANIFEST.MF':
+                data = re.sub(br'(?m)^Class-Path: *\.\r?\n', b'', data)
+            dest.writestr(info, data)
 
-        # Since NamedTemporaryFile doesn't support specifying encoding error handling,
-        # encode the bytes ourselves to replace non-ascii with ? to preserve char counts.
+    os.replace(tmp_path, copy_path)
+    return copy_path
 
-        source_file = NamedTemporaryFile(mode='wb', suffix='.cbl', delete=False)
-        source_file.write(code.encode('iso-8859-1', errors='replace'))
-        source_file.close()
 
-        jar = resource_filename('CobolSharp', KOOPA_JAR)
+def parse_heap_size(value):
+    """Parse a JVM heap size like '512m' or '2g' into megabytes.  Returns
+    'auto' unchanged, and None for None.
 
-        # TODO: add command arg to control heap size
-        cmd = (java_binary, '-cp', jar, '-Xms500m', '-Dkoopa.xml.include_positioning=true',
-               'koopa.app.cli.ToXml', source_file.name, output_path)
+    Raises ValueError if the size is not understood.
+    """
+    if value is None or value == 'auto':
+        return value
+
+    m = re.match(r'^(\d+)([kmg]?)$', value.strip().lower())
+    if not m:
+        raise ValueError('bad heap size: {}'.format(value))
+
+    size, unit = int(m.group(1)), m.group(2)
+    if unit == 'g':
+        return size * 1024
+    elif unit == 'm':
+        return size
+    elif unit == 'k':
+        return max(1, size // 1024)
+    else:
+        return max(1, size // (1024 * 1024))
 
-        process = subprocess.Popen(cmd,
-                                   stdin=subprocess.DEVNULL,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   universal_newlines=True)
 
-        stdout, stderr = process.communicate()
+def auto_heap_size(source_bytes):
+    """Return the heap size in megabytes needed to parse source_bytes of
+    Cobol code, rounded up to a power of two so that a server doesn't
+    have to be restarted for every slightly larger program.
+    """
+    needed = -(-source_bytes * AUTO_HEAP_PER_SOURCE_BYTE // (1024 * 1024))
+    heap_mb = AUTO_HEAP_MIN_MB
+    while heap_mb < needed:
+        heap_mb *= 2
+    return heap_mb
 
-        # Doesn't seem to return an error exit code on parse errors...
-        if process.returncode != 0 or 'Error:' in stdout:
-            msg = stdout.replace(source_file.name, code_path)
-            msg = msg.replace(os.path.basename(source_file.name), code_path)
-            raise ParserError(msg)
 
-        return code
-    
-    finally:
-        if source_file:
-            os.remove(source_file.name)
+class KoopaServer(object):
+    """A long-running Koopa JVM that parses one program at a time.
 
+    Starting a JVM and warming up Koopa takes much longer than
+    parsing a typical program, so use a single server when parsing
+    many programs.  The JVM is started on first use, and restarted if
+    it dies.
 
-class ProgramParser(object):
-    def __init__(self, source, java_binary, tabsize):
-        self._perform_stmts = []
+    Call close() when done, or use the server as a context manager.
+
+    java_heap is the maximum JVM heap size, either in the JVM format
+    (e.g. '2g') or 'auto' to size it from the source code.  An 'auto'
+    server is restarted with a larger heap when a bigger program
+    comes along, or if Koopa runs out of memory.  If java_heap is None
+    the JVM default is used.
+
+    java_opts is a sequence of additional JVM arguments, and java_cds
+    the path to a class data sharing archive (see java_command()).
+
+    If the server doesn't send anything for 'timeout' seconds it is
+    killed, and the request fails with a ParserError.  The next
+    request starts a new server.  None waits forever.
+    """
+
+    MAIN_CLASS = 'cobolsharp.KoopaServer'
+
+    FRAME_KINDS = ('message', 'xml', 'ok', 'error')
+
+    def __init__(self, java_binary='java', java_heap='auto', java_opts=(), java_cds=None,
+                 timeout=KOOPA_TIMEOUT):
+        self._java_binary = java_binary
+        self._java_opts = tuple(java_opts)
+        self._java_cds = java_cds
+        self._auto_heap = java_heap == 'auto'
+        self._heap_mb = None if self._auto_heap else parse_heap_size(java_heap)
+        self._timeout = timeout
+        self._process = None
+        self._output = bytearray()
+        self._xml_received = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the JVM, if it is running."""
+        process = self._process
+        self._process = None
+
+        if process is not None:
+            # The server exits when stdin is closed
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
 
-        if hasattr(source, 'name'):
-            self._source_path = source.name
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+            process.stdout.close()
+
+
+    def to_xml(self, source_path, output_path):
+        """Parse the Cobol code in the file source_path into an XML
+        document saved to output_path.
+
+        Returns a tuple (ok, messages), where messages is the Koopa
+        output in the same format as when running it as a command.
+        """
+        if not (is_request_field(source_path) and is_request_field(output_path)):
+            # The paths can't be sent in a request, so pass the
+            # code and the XML through this process instead
+            try:
+                with open(source_path, 'rb') as source_file:
+                    data = source_file.read()
+                with open(output_path, 'wb') as output_file:
+                    return self._stream_bytes(data, source_path, output_file.write)
+            except OSError as e:
+                return False, '{}\n'.format(e)
+
+        try:
+            source_bytes = os.path.getsize(source_path)
+        except OSError:
+            # Let Koopa report the problem
+            source_bytes = 0
+
+        return self._sized_request(source_bytes, ('parse', source_path, output_path))
+
+
+    def stream_xml(self, code, source_name, feed):
+        """Parse the Cobol code in 'code', a string or a SourceBytes,
+        passing the resulting XML document in chunks of bytes to the function 'feed'
+        as they are received from Koopa.  source_name is only used in
+        messages.
+
+        Returns a tuple (ok, messages) like to_xml().
+        """
+
+        # Regardless of source encoding, pass it as a single-byte encoding since Cobol parsing
+        # should only need ascii chars.  Passing UTF-8 or similar means that the character
+        # ranges reported by koopa will be offset from the data in code, breaking extracting
+        # symbols etc.
+
+        # But use iso-8859-1, to keep more national chars in comments, and replace
+        # anything else with ? to preserve char counts.
+        # A SourceBytes is already in that encoding, see map_source().
+
+        if isinstance(code, SourceBytes):
+            data = code.data
         else:
-            self._source_path = '<string>'
+            data = code.encode(SOURCE_ENCODING, errors='replace')
+        return self._stream_bytes(data, source_name, feed)
+
+
+    def _stream_bytes(self, data, source_name, feed):
+        # The name is only used in messages, so it is enough to
+        # escape the characters that would break the request line
+        source_name = source_name.replace('\t', '\\t').replace('\n', '\\n')
+        return self._sized_request(len(data), ('stream', source_name, str(len(data))), data, feed)
+
+
+    def _sized_request(self, source_bytes, fields, payload=b'', feed=None):
+        if not self._auto_heap:
+            return self._request(fields, payload, feed)
+
+        heap_mb = auto_heap_size(source_bytes)
+        if self._heap_mb is None or heap_mb > self._heap_mb:
+            self._kill()
+            self._heap_mb = heap_mb
+
+        ok, messages = self._request(fields, payload, feed)
+
+        # The estimate isn't exact, so try once more with a bigger
+        # heap.  The server has already exited after running out.
+        if not ok and not self._xml_received and 'ran out of memory' in messages:
+            self._kill()
+            self._heap_mb *= 2
+            ok, messages = self._request(fields, payload, feed)
+
+        return ok, messages
 
-        # Just grab a temp file name for the results
-        result_file = NamedTemporaryFile(mode='wb', suffix='.xml', delete=False)
-        result_file.close()
 
+    def _request(self, fields, payload=b'', feed=None):
+        if not all(is_request_field(field) for field in fields):
+            raise ValueError('cannot send request fields with tabs or newlines: {!r}'.format(fields))
+
+        # If the JVM has died, restart it and try once more, unless
+        # it already had started sending the XML
+        self._xml_received = False
+
+        for attempt in range(2):
+            if self._process is None or self._process.poll() is not None:
+                self._start()
+
+            try:
+                self._process.stdin.write('\t'.join(fields).encode('utf-8') + b'\n')
+                self._process.stdin.write(payload)
+                self._process.stdin.flush()
+                return self._read_response(feed)
+            except TimeoutError:
+                # Don't wait for a hung JVM a second time
+                self._kill()
+                raise ParserError('Koopa server did not respond in {} seconds'.format(self._timeout))
+            except KoopaProtocolError as e:
+                # The output is out of step with the requests, probably
+                # because the JVM itself writes to stdout (e.g. with
+                # -verbose:gc), so a new JVM would most likely do the
+                # same.  Start over with the next request anyway.
+                self._kill()
+                raise ParserError('Koopa server sent an invalid response: {}'.format(e))
+            except (OSError, EOFError) as e:
+                returncode = self._kill()
+                error = e
+
+            if self._xml_received:
+                break
+
+        raise ParserError('Koopa server died (exit code {}): {}'.format(returncode, error))
+
+
+    def _read_response(self, feed):
+        messages = []
+        while True:
+            kind, data = self._read_frame()
+            if kind == 'message':
+                messages.append(data.decode('utf-8'))
+            elif kind == 'xml' and feed is not None:
+                self._xml_received = True
+                try:
+                    feed(data)
+                except Exception:
+                    self._skip_response()
+                    raise
+            elif kind in ('ok', 'error'):
+                return kind == 'ok', ''.join(messages)
+            else:
+                raise EOFError('unexpected response from Koopa server: {}'.format(kind))
+
+
+    def _skip_response(self):
+        # Read the rest of the response, so that the next request
+        # doesn't get it.  If that fails, start over with a new server.
         try:
-            self._code = run_koopa(source, result_file.name, java_binary=java_binary, tabsize=tabsize)
-            parser = ET.XMLParser(target=CommentTreeBuilder())
-            self._tree = ET.parse(result_file.name, parser=parser)
-        finally:
-            if result_file:
-                os.remove(result_file.name)
+            while self._read_frame()[0] not in ('ok', 'error'):
+                pass
+        except (OSError, EOFError, KoopaProtocolError):
+            self._kill()
+
+
+    def _read_frame(self):
+        output = self._output
+
+        end = output.find(b'\n')
+        while end < 0:
+            self._read_output()
+            end = output.find(b'\n')
+
+        header = output[:end].decode('utf-8', errors='replace')
+        try:
+            kind, length = header.split()
+            length = int(length)
+        except ValueError:
+            kind = length = None
+
+        if kind not in self.FRAME_KINDS or length < 0:
+            raise KoopaProtocolError('bad frame header: {!r}'.format(header[:200]))
 
-        self._parse()
+        del output[:end + 1]
+
+        while len(output) < length:
+            self._read_output()
+
+        data = bytes(output[:length])
+        del output[:length]
+        return kind, data
+
+
+    def _read_output(self):
+        # Read from the pipe directly rather than through the file
+        # object, so that select() sees all data that hasn't been read
+        fd = self._process.stdout.fileno()
+        if self._timeout is not None:
+            readable, _, _ = select.select([fd], [], [], self._timeout)
+            if not readable:
+                raise TimeoutError()
+
+        data = os.read(fd, 1024 * 1024)
+        if not data:
+            raise EOFError('Koopa server closed its output')
+
+        self._output += data
+
+
+    def _start(self):
+        self._kill()
+        cmd = java_command(self._java_binary, self.MAIN_CLASS,
+                           heap_mb=self._heap_mb,
+                           java_opts=self._java_opts,
+                           java_cds=self._java_cds)
+        self._process = subprocess.Popen(cmd,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+
+
+    def _kill(self):
+        process = self._process
+        self._process = None
+        self._output.clear()
+
+        if process is None:
+            return None
+
+        if process.poll() is None:
+            process.kill()
+
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+        process.stdout.close()
+        return process.wait()
+
+
+def is_request_field(value):
+    """Return True if 'value' can be sent as a field in a request line
+    to the Koopa server.
+    """
+    return '\t' not in value and '\n' not in value
+
+
+class ProgramParser(object):
+    """Translate the Koopa XML into a Program while it is being parsed.
+
+    Each section is translated as soon as its XML element is complete,
+    and then dropped from the XML tree (see ProgramTreeBuilder), so
+    the full tree is never held in memory.
+
+    Warnings are written to stderr, and also listed in 'warnings'
+    without the source path.
+    """
+
+    def __init__(self, code, source_path, java_binary, tabsize, server=None):
+        self._perform_stmts = []
+        self._main_section_done = False
+        self.program = None
+        self.warnings = []
+
+        self._code = code
+        self._source_path = source_path
+        self._sources = SourceTable(code)
+
+        # Parse the XML while Koopa is still writing it
+        parser = ET.XMLParser(target=ProgramTreeBuilder(self))
+        stream_xml(self._code, self._source_path, parser.feed, java_binary, server)
+        parser.close()
+
+        if self.program is None:
+            raise ParserError('{}: no procedure division'.format(self._source_path))
 
 
     def _warn(self, element_or_source, msg):
@@ -120,21 +626,44 @@ class ProgramParser(object):
         else:
             line = element_or_source.get('from-line')
 
-        sys.stderr.write('{}: line {}: {}\n'.format(self._source_path, line, msg))
-
+        warning = 'line {}: {}'.format(line, msg)
+        self.warnings.append(warning)
+        sys.stderr.write('{}: {}\n'.format(self._source_path, warning))
 
-    def _parse(self):
-        unit_el = self._tree.find('compilationGroup')
-        proc_div_el = unit_el.find('.//procedureDivision')
 
+    def _start_procedure_division(self, unit_el, proc_div_el):
         proc_div = ProcedureDivision(self._source(proc_div_el))
-
         self.program = Program(self._source(unit_el), self._source_path, proc_div)
 
-        section_els = proc_div_el.findall('section')
 
+    def _end_section(self, proc_div_el, section_el):
+        self._parse_main_section(proc_div_el)
+        self._add_section(section_el, self._parse_section(section_el))
+
+
+    def _end_procedure_division(self, proc_div_el):
+        self._parse_main_section(proc_div_el)
+
+        # Resolve section references
+        proc_div = self.program.proc_div
+        for stmt in self._perform_stmts:
+            ref_section = proc_div.sections.get(stmt.section_name)
+            if ref_section:
+                stmt.section = ref_section
+                stmt.sentence.para.section.used_sections.add(ref_section)
+                ref_section.xref_stmts.append(stmt)
+            else:
+                self._warn(stmt.source, 'reference to undefined section: {}'.format(stmt.section_name))
+
+
+    def _parse_main_section(self, proc_div_el):
         # Construct a default main section if there's loose paragraphs
-        # or sentences at the start
+        # or sentences at the start.  These are all before the first
+        # section, so this is done when that section is complete.
+
+        if self._main_section_done:
+            return
+        self._main_section_done = True
 
         main_sentence_els = proc_div_el.findall('sentence')
         main_para_els = proc_div_el.findall('paragraph')
@@ -143,30 +672,21 @@ class ProgramParser(object):
             main_para_els.insert(0, self._virtual_element('paragraph', main_sentence_els))
 
         if main_para_els:
-            section_els.insert(0, self._virtual_element('tag', main_para_els))
+            el = self._virtual_element('tag', main_para_els)
+            self._add_section(el, self._parse_section(el))
 
-        section = None
-        for el in section_els:
-            section = self._parse_section(el)
-            if section.name in proc_div.sections:
-                self._warn(el, 'duplicate section: {}'.format(section.name))
-                section.name += '__dup{}'.format(id(section))
 
-            proc_div.sections[section.name] = section
+    def _add_section(self, el, section):
+        proc_div = self.program.proc_div
 
-            if proc_div.first_section is None:
-                proc_div.first_section = section
+        if section.name in proc_div.sections:
+            self._warn(el, 'duplicate section: {}'.format(section.name))
+            section.name += '__dup{}'.format(id(section))
 
+        proc_div.sections[section.name] = section
 
-        # Resolve section references
-        for stmt in self._perform_stmts:
-            ref_section = proc_div.sections.get(stmt.section_name)
-            if ref_section:
-                stmt.section = ref_section
-                stmt.sentence.para.section.used_sections.add(ref_section)
-                ref_section.xref_stmts.append(stmt)
-            else:
-                self._warn(stmt.source, 'reference to undefined section: {}'.format(stmt.section_name))
+        if proc_div.first_section is None:
+            proc_div.first_section = section
 
 
     def _parse_section(self, section_el):
@@ -185,6 +705,7 @@ class ProgramParser(object):
             section.comment = comment_el.text.rstrip()
 
         self._goto_stmts = []
+        self._links = StmtLinks()
 
         para_els = section_el.findall('paragraph')
         para_els.reverse()
@@ -215,9 +736,14 @@ class ProgramParser(object):
                     stmt.source.from_line, stmt.para_name))
 
             stmt.next_stmt = target_para.get_first_stmt()
+            self._links.set_next(stmt)
 
         self._goto_stmts = []
 
+        self._links.finish(section.get_first_stmt())
+        section.stmt_links = self._links
+        self._links = None
+
         return section
 
 
@@ -290,6 +816,7 @@ class ProgramParser(object):
     def _unparsed_stmt(self, stmt_el, sentence, next_stmt):
         stmt = UnparsedStatement(self._source(stmt_el), sentence)
         stmt.next_stmt = next_stmt
+        self._links.add(stmt, next_stmt)
         return stmt
 
 
@@ -313,11 +840,16 @@ class ProgramParser(object):
             raise ParserError('line {}: unsupported exit statement'.format(
                 stmt_el.get('from-line')))
 
+        if stmt is not None:
+            self._links.add(stmt, None)
+
         return stmt
 
 
     def _parse_stmt_gobackStatement(self, el, sentence, next_stmt):
-        return GobackStatement(self._source(el), sentence)
+        stmt = GobackStatement(self._source(el), sentence)
+        self._links.add(stmt, None)
+        return stmt
 
 
     def _parse_stmt_goToStatement(self, goto_el, sentence, next_stmt):
@@ -327,6 +859,9 @@ class ProgramParser(object):
         stmt = GoToStatement(self._source(goto_el), sentence, proc_name)
         self._goto_stmts.append(stmt)
 
+        # The edge is updated when the target is resolved
+        self._links.add(stmt, None)
+
         return stmt
 
 
@@ -348,12 +883,14 @@ class ProgramParser(object):
         stmt.true_stmt = self._parse_stmts(
             then_el.findall('./nestedStatements/statement'), sentence, next_stmt)
 
+        self._links.add_branch(stmt)
         return stmt
 
 
     def _parse_stmt_moveStatement(self, move_el, sentence, next_stmt):
         stmt = MoveStatement(self._source(move_el), sentence)
         stmt.next_stmt = next_stmt
+        self._links.add(stmt, next_stmt)
         return stmt
 
 
@@ -363,6 +900,7 @@ class ProgramParser(object):
         if sentence.next_sentence:
             stmt.next_stmt = sentence.next_sentence.first_stmt
 
+        self._links.add(stmt, stmt.next_stmt)
         return stmt
 
 
@@ -378,6 +916,7 @@ class ProgramParser(object):
         stmt = PerformSectionStatement(self._source(perform_el), sentence, proc_name)
         stmt.next_stmt = next_stmt
         self._perform_stmts.append(stmt)
+        self._links.add(stmt, next_stmt)
 
         return stmt
 
@@ -397,13 +936,13 @@ class ProgramParser(object):
 
 
     def _source(self, element):
-        return Source(self._code,
-                      int(element.get('from')) - 1,
-                      int(element.get('to')) - 1,
-                      int(element.get('from-line')),
-                      int(element.get('to-line')),
-                      int(element.get('from-column')) - 1,
-                      int(element.get('to-column')) - 1)
+        get = element.get
+        return self._sources.add(int(get('from')) - 1,
+                                 int(get('to')) - 1,
+                                 int(get('from-line')),
+                                 int(get('to-line')),
+                                 int(get('from-column')) - 1,
+                                 int(get('to-column')) - 1)
 
 
 class CommentTreeBuilder(ET.TreeBuilder):
@@ -420,7 +959,7 @@ class CommentTreeBuilder(ET.TreeBuilder):
             self._comments.append(data)
 
     def start(self, tag, attrs):
-        super().start(tag, attrs)
+        el = super().start(tag, attrs)
 
         # Start collecting comments now
         if tag == 'procedureDivision':
@@ -434,3 +973,71 @@ class CommentTreeBuilder(ET.TreeBuilder):
                     self.data('\n')
                 super().end('_comment')
                 self._comments = []
+
+        return el
+
+
+class ProgramTreeBuilder(CommentTreeBuilder):
+    """Build the XML tree, but only keep the part of it that the
+    ProgramParser hasn't processed yet.
+
+    The compilation group and the first procedure division are passed
+    to the parser when they start, and each section in the procedure
+    division when it is complete.  Complete sections, and any complete
+    elements outside the procedure division, are then dropped from the
+    tree.  Peak memory use is thus bounded by the largest section
+    rather than the whole program.
+    """
+
+    def __init__(self, program_parser):
+        super().__init__()
+        self._program_parser = program_parser
+
+        # Stack of currently open elements
+        self._elements = []
+
+        self._unit_el = None
+        self._proc_div_el = None
+        self._proc_div_depth = None
+
+    def start(self, tag, attrs):
+        el = super().start(tag, attrs)
+        self._elements.append(el)
+
+        if tag == 'compilationGroup' and self._unit_el is None:
+            self._unit_el = el
+
+        elif tag == 'procedureDivision' and self._proc_div_depth is None:
+            self._proc_div_el = el
+            self._proc_div_depth = len(self._elements)
+            self._program_parser._start_procedure_division(self._unit_el, el)
+
+        return el
+
+    def end(self, tag):
+        el = super().end(tag)
+        self._elements.pop()
+
+        if el is self._proc_div_el:
+            self._program_parser._end_procedure_division(el)
+            self._proc_div_el = None
+
+        elif self._proc_div_el is not None:
+            if len(self._elements) > self._proc_div_depth:
+                # Keep building the current section
+                return el
+
+            if tag == 'section':
+                self._program_parser._end_section(self._proc_div_el, el)
+
+                # The section, and any loose paragraphs or other
+                # elements before it, have now been processed
+                del self._proc_div_el[:]
+
+            return el
+
+        # Not needed anymore, so drop it from the parent
+        if self._elements:
+            del self._elements[-1][-1]
+
+        return el
@@ -89,7 +89,8 @@ class Outputter(object):
 
 
 class TextOutputter(Outputter):
-    """Output formatted code as a text source file.
+    """Output formatted code as a text source file.  close() closes
+    output_file.
     """
 
     LINK_COLUMN = 60
@@ -98,6 +99,9 @@ class TextOutputter(Outputter):
         super(TextOutputter, self).__init__(language)
         self._file = output_file
 
+    def close(self):
+        self._file.close()
+
     def _output_line(self, line):
         indent = ' ' * self.INDENT_SPACES * line.indent
 
@@ -133,6 +137,7 @@ class TextOutputter(Outputter):
 
 class HtmlOutputter(Outputter):
     """Output formatted code together with original Cobol as an HTML page.
+    The page is written to output_file by close(), which then closes it.
     """
 
     def __init__(self, cobol_program, output_file, language):
@@ -140,9 +145,11 @@ class HtmlOutputter(Outputter):
         self._file = output_file
         self._program = cobol_program
 
-        self._cobol_lines = [CobolLine(i + 1, line)
-                             for i, line
-                             in enumerate(cobol_program.source.text.split('\n'))]
+        # The last output line referring to each Cobol line, and the
+        # sections and paragraphs starting on them, by line number
+        self._line_outputs = {}
+        self._line_sections = {}
+        self._line_paras = {}
 
         self._items = []
         self._blocks = []
@@ -152,7 +159,7 @@ class HtmlOutputter(Outputter):
         template = template_env.get_template('main.html')
         template.stream(
             program_path=os.path.basename(self._program.path),
-            cobol_lines=self._cobol_lines,
+            cobol_lines=self._cobol_lines(),
             items=self._items,
             comment_format=self._lang.comment_format,
             bottom_fold_button=not not self._lang.close_block,
@@ -164,11 +171,30 @@ class HtmlOutputter(Outputter):
             StartBlock=StartBlock,
             EndBlock=EndBlock,
         ).dump(self._file)
+        self._file.close()
 
-        self._cobol_lines = None
+        self._line_outputs = self._line_sections = self._line_paras = None
         self._items = None
 
 
+    def _cobol_lines(self):
+        line_outputs = self._line_outputs
+        line_sections = self._line_sections
+        line_paras = self._line_paras
+
+        for number, text in enumerate(self._program.line_index.lines(), 1):
+            cobol_line = CobolLine(number, text)
+
+            output_line = line_outputs.get(number)
+            if output_line is not None:
+                cobol_line.used = True
+                cobol_line.output_line = output_line
+                cobol_line.section = line_sections.get(number)
+                cobol_line.para = line_paras.get(number)
+
+            yield cobol_line
+
+
     def start_block(self, line):
         block = StartBlock(line)
         self._items.append(block)
@@ -192,22 +218,18 @@ class HtmlOutputter(Outputter):
 
         # Cross-reference usages
         if line.source:
-            for i in range(line.source.from_line - 1, line.source.to_line):
-                cobol_line = self._cobol_lines[i]
-                cobol_line.used = True
-                cobol_line.output_line = line
+            for number in range(line.source.from_line, line.source.to_line + 1):
+                self._line_outputs[number] = line
 
         if line.href_section:
-            cobol_line = self._cobol_lines[line.href_section.source.from_line - 1]
-            cobol_line.used = True
-            cobol_line.section = line.href_section
-            cobol_line.output_line = line
+            number = line.href_section.source.from_line
+            self._line_outputs[number] = line
+            self._line_sections[number] = line.href_section
 
         if line.href_para:
-            cobol_line = self._cobol_lines[line.href_para.source.from_line - 1]
-            cobol_line.used = True
-            cobol_line.para = line.href_para
-            cobol_line.output_line = line
+            number = line.href_para.source.from_line
+            self._line_outputs[number] = line
+            self._line_paras[number] = line.href_para
 
 
 def link(link_type, link_id):
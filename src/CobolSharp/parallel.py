@@ -0,0 +1,280 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+"""Analyze the sections of a program in parallel worker processes.
+
+The program is passed to the workers with Program.dump(), and each
+worker loads its own copy.  The results refer to sections, paragraphs
+and statements by their position in ProgramObjects, which is the same
+in the original program and the copies, so they can be translated
+back into the objects of the original program.
+"""
+
+import io
+import contextlib
+import multiprocessing
+import sys
+
+from .syntax import *
+from .structure import *
+from .serialize import ProgramObjects
+
+
+def analyze_sections(program, sections, func, func_args, jobs):
+    """Call func(section, *func_args) for each section in 'sections'
+    in 'jobs' worker processes.  func must be a module-level function
+    that returns a tuple (performed_sections, block), where block is
+    a structure.Block or None.
+
+    Generates a tuple (section, performed_sections, block) for each
+    section, in order, with the objects translated back into the
+    original program.  Anything printed by func is passed on, and
+    changes to statement comments (as done in debug mode) are
+    applied to the original program.
+    """
+    data = io.BytesIO()
+    program.dump(data)
+
+    objects = ProgramObjects(program)
+    section_index = objects.index()[0]
+
+    with multiprocessing.Pool(jobs, _init_worker, (data.getvalue(), func, func_args)) as pool:
+        tasks = [section_index[section] for section in sections]
+        for section, result in zip(sections, pool.imap(_run_worker, tasks)):
+            stdout, stderr, performed, block, comments = result
+
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+
+            for i, comment in comments:
+                objects.stmts[i].comment = comment
+
+            yield (section,
+                   [objects.sections[i] for i in performed],
+                   BlockDecoder(objects, program.source.table).decode(block))
+
+
+class BlockEncoder(object):
+    """Encode a structure.Block into a tuple of blocks that refer to
+    program objects by their position in ProgramObjects.  'index' is
+    the result of ProgramObjects.index().
+
+    Each encoded block is a tuple of statements, and nested blocks
+    are referred to by their position in the outer tuple, so deeply
+    nested code doesn't recurse.  The top block is the first one.
+
+    Labels are numbered per encoder, so use a new BlockEncoder and
+    BlockDecoder for each block.
+    """
+
+    def __init__(self, index):
+        self._sections, self._paras, self._sentences, self._stmts = index
+        self._labels = {}
+
+    def encode(self, block):
+        if block is None:
+            return None
+
+        self._blocks = [block]
+        encoded = []
+
+        # Nested blocks are appended to _blocks by _block() as they
+        # are found, so this also encodes them
+        while len(encoded) < len(self._blocks):
+            block = self._blocks[len(encoded)]
+            encoded.append(tuple(self._encode_stmt(stmt) for stmt in block.stmts))
+
+        del self._blocks
+        return tuple(encoded)
+
+    def _encode_stmt(self, stmt):
+        if isinstance(stmt, CobolStatement):
+            return ('stmt', self._stmts[stmt])
+
+        elif isinstance(stmt, If):
+            return ('if', self._stmts[stmt.cobol_stmt], self._condition(stmt.condition),
+                    self._block(stmt.then_block), self._block(stmt.else_block))
+
+        elif isinstance(stmt, While):
+            return ('while', self._para(stmt.cobol_para), self._block(stmt.block),
+                    self._stmts[stmt.cobol_branch_stmt], self._condition(stmt.condition))
+
+        elif isinstance(stmt, Forever):
+            return ('forever', self._para(stmt.cobol_para), self._block(stmt.block))
+
+        elif isinstance(stmt, GotoLabel):
+            return ('label', self._label(stmt))
+
+        elif isinstance(stmt, Goto):
+            return ('goto', self._label(stmt.label))
+
+        elif isinstance(stmt, Return):
+            return ('return', )
+
+        elif isinstance(stmt, Break):
+            return ('break', )
+
+        elif isinstance(stmt, Continue):
+            return ('continue', )
+
+        else:
+            raise TypeError('cannot encode {}'.format(stmt))
+
+    def _block(self, block):
+        if block is None:
+            return -1
+
+        self._blocks.append(block)
+        return len(self._blocks) - 1
+
+    def _para(self, para):
+        return self._paras[para] if para is not None else -1
+
+    def _label(self, label):
+        # Goto and GotoLabel share the label object
+        try:
+            return self._labels[label]
+        except KeyError:
+            encoded = self._labels[label] = (len(self._labels), label.name, self._para(label.cobol_para))
+            return encoded
+
+    def _condition(self, condition):
+        if condition is None:
+            return None
+
+        return (condition.source.index, condition.inverted)
+
+
+class BlockDecoder(object):
+    """Decode the output of BlockEncoder using the ProgramObjects and
+    SourceTable of a program.
+    """
+
+    def __init__(self, objects, table):
+        self._objects = objects
+        self._table = table
+        self._labels = {}
+
+    def decode(self, encoded):
+        if encoded is None:
+            return None
+
+        # Create all blocks first, so the statements can refer to
+        # nested blocks without recursing
+        self._blocks = [Block() for _ in encoded]
+        for block, items in zip(self._blocks, encoded):
+            block.stmts = [self._decode_stmt(item) for item in items]
+
+        top = self._blocks[0]
+        del self._blocks
+        return top
+
+    def _decode_stmt(self, item):
+        kind = item[0]
+        stmts = self._objects.stmts
+
+        if kind == 'stmt':
+            return stmts[item[1]]
+
+        elif kind == 'if':
+            return If(stmts[item[1]], self._condition(item[2]),
+                      self._block(item[3]), self._block(item[4]))
+
+        elif kind == 'while':
+            return While(self._para(item[1]), self._block(item[2]),
+                         stmts[item[3]], self._condition(item[4]))
+
+        elif kind == 'forever':
+            return Forever(self._para(item[1]), self._block(item[2]))
+
+        elif kind == 'label':
+            return self._label(item[1])
+
+        elif kind == 'goto':
+            return Goto(self._label(item[1]))
+
+        elif kind == 'return':
+            return Return()
+
+        elif kind == 'break':
+            return Break()
+
+        elif kind == 'continue':
+            return Continue()
+
+        else:
+            raise ValueError('cannot decode {}'.format(kind))
+
+    def _block(self, i):
+        return self._blocks[i] if i >= 0 else None
+
+    def _para(self, i):
+        return self._objects.paras[i] if i >= 0 else None
+
+    def _label(self, encoded):
+        number, name, para = encoded
+        try:
+            return self._labels[number]
+        except KeyError:
+            label = self._labels[number] = GotoLabel(name, self._para(para))
+            return label
+
+    def _condition(self, encoded):
+        if encoded is None:
+            return None
+
+        index, inverted = encoded
+        return ConditionExpression(Source(self._table, index), inverted)
+
+
+#
+# Worker process
+#
+
+_worker = None
+
+class _Worker(object):
+    def __init__(self, program_data, func, func_args):
+        self.program = Program.load(io.BytesIO(program_data))
+        self.objects = ProgramObjects(self.program)
+        self.index = self.objects.index()
+        self.func = func
+        self.func_args = func_args
+
+        # The statements of each section, to find comments that are
+        # changed by the analysis
+        self.section_stmts = {}
+        for i, stmt in enumerate(self.objects.stmts):
+            section = stmt.sentence.para.section
+            self.section_stmts.setdefault(section, []).append(i)
+
+    def run(self, section_index):
+        section = self.objects.sections[section_index]
+        stmts = self.objects.stmts
+        stmt_indices = self.section_stmts.get(section, [])
+        comments = [stmts[i].comment for i in stmt_indices]
+
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            performed, block = self.func(section, *self.func_args)
+
+        sections = self.index[0]
+        changed_comments = [(i, stmts[i].comment)
+                            for i, comment in zip(stmt_indices, comments)
+                            if stmts[i].comment != comment]
+
+        return (stdout.getvalue(), stderr.getvalue(),
+                [sections[s] for s in performed or ()],
+                BlockEncoder(self.index).encode(block),
+                changed_comments)
+
+
+def _init_worker(program_data, func, func_args):
+    global _worker
+    _worker = _Worker(program_data, func, func_args)
+
+
+def _run_worker(section_index):
+    return _worker.run(section_index)
@@ -0,0 +1,257 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+"""Run jobs through a sequence of processing stages.
+
+Each stage runs in its own thread, connected to the next one by a
+bounded queue.  This lets e.g. the Koopa JVM parse the next source file
+while Python is busy analysing the previous one, without parsed
+programs piling up in memory if the later stages are slower.
+"""
+
+import contextlib
+import io
+import queue
+import sys
+import threading
+import time
+
+
+class Job(object):
+    """A unit of work passed through the pipeline stages.
+
+    Output printed while a stage processes the job is collected in
+    'stdout' and 'stderr'.  If a stage sets 'error', the job is passed
+    through the remaining stages without processing.  'lines' is the
+    number of source lines, used in the stage statistics.
+    """
+
+    def __init__(self):
+        self.error = None
+        self.exception = None
+        self.lines = 0
+        self.stdout = io.StringIO()
+        self.stderr = io.StringIO()
+
+
+class StageStats(object):
+    """Number of jobs and source lines processed by a stage, and the
+    time spent processing them.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.jobs = 0
+        self.lines = 0
+        self.seconds = 0.0
+
+    def add(self, other):
+        self.jobs += other.jobs
+        self.lines += other.lines
+        self.seconds += other.seconds
+
+    def jobs_per_second(self):
+        return self.jobs / self.seconds if self.seconds else 0.0
+
+    def lines_per_second(self):
+        return self.lines / self.seconds if self.seconds else 0.0
+
+
+def write_stats(stats, elapsed, fp):
+    """Write a table of the StageStats in 'stats' to fp."""
+    fp.write('{:<10} {:>6} {:>9} {:>9} {:>8} {:>9}\n'.format(
+        'stage', 'files', 'lines', 'busy (s)', 'files/s', 'lines/s'))
+
+    for s in stats:
+        fp.write('{:<10} {:>6} {:>9} {:>9.2f} {:>8.1f} {:>9.0f}\n'.format(
+            s.name, s.jobs, s.lines, s.seconds, s.jobs_per_second(), s.lines_per_second()))
+
+    fp.write('elapsed {:.2f} s\n'.format(elapsed))
+
+
+class Pipeline(object):
+    """Pass jobs through 'stages', a list of (name, func) tuples where
+    func(job) processes a Job in place.
+
+    If 'threaded' is false, the stages are run one after another for
+    each job in the calling thread.  This gives the same result, which
+    is useful when the stages themselves start worker processes.
+    """
+
+    def __init__(self, stages, threaded=True, queue_size=2):
+        self.stages = stages
+        self.threaded = threaded
+        self.queue_size = queue_size
+        self.stats = [StageStats(name) for name, func in stages]
+        self.elapsed = 0.0
+
+    def run(self, jobs):
+        """Generate the jobs in the same order as in 'jobs', after
+        they have been through all stages.  Any unexpected exception
+        in a stage is raised here.
+        """
+        start = time.perf_counter()
+
+        if self.threaded:
+            results = self._run_threads(jobs)
+        else:
+            results = self._run_sequential(jobs)
+
+        with _thread_output():
+            try:
+                for job in results:
+                    if job.exception is not None:
+                        raise job.exception
+                    yield job
+            finally:
+                results.close()
+                self.elapsed += time.perf_counter() - start
+
+
+    def _run_sequential(self, jobs):
+        for job in jobs:
+            for (name, func), stats in zip(self.stages, self.stats):
+                self._run_stage(func, stats, job)
+            yield job
+
+
+    def _run_threads(self, jobs):
+        stop = threading.Event()
+        queues = [queue.Queue(self.queue_size) for stage in self.stages]
+        done = queue.Queue(self.queue_size)
+        threads = []
+
+        feeder = threading.Thread(target=self._feed, args=(jobs, queues[0], stop))
+        threads.append(feeder)
+
+        for i, ((name, func), stats) in enumerate(zip(self.stages, self.stats)):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else done
+            threads.append(threading.Thread(
+                target=self._stage_thread, name='pipeline-' + name,
+                args=(func, stats, queues[i], out_queue, stop)))
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                job = done.get()
+                if job is None:
+                    break
+                yield job
+        finally:
+            # Let the stages finish their current jobs before returning,
+            # so nothing is still running when the caller cleans up
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
+    def _feed(self, jobs, out_queue, stop):
+        for job in jobs:
+            if not _put(out_queue, job, stop):
+                return
+        _put(out_queue, None, stop)
+
+
+    def _stage_thread(self, func, stats, in_queue, out_queue, stop):
+        while not stop.is_set():
+            try:
+                job = in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            if job is not None:
+                self._run_stage(func, stats, job)
+
+            if not _put(out_queue, job, stop) or job is None:
+                return
+
+
+    def _run_stage(self, func, stats, job):
+        if job.error is not None or job.exception is not None:
+            return
+
+        start = time.perf_counter()
+
+        with _capture(job.stdout, job.stderr):
+            try:
+                func(job)
+            except Exception as e:
+                job.exception = e
+
+        stats.jobs += 1
+        stats.lines += job.lines
+        stats.seconds += time.perf_counter() - start
+
+
+def _put(out_queue, item, stop):
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+class _ThreadOutput(object):
+    """Replacement for sys.stdout or sys.stderr that writes to the
+    buffer set for the current thread by _capture(), or the original
+    stream if there is none.  contextlib.redirect_stdout() can't be
+    used, since it would redirect the output of all threads.
+    """
+
+    def __init__(self, stream, attr):
+        self._stream = stream
+        self._attr = attr
+
+    def _target(self):
+        return getattr(_local, self._attr, None) or self._stream
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+_local = threading.local()
+_install_lock = threading.Lock()
+_install_count = 0
+_saved_streams = None
+
+@contextlib.contextmanager
+def _thread_output():
+    global _install_count, _saved_streams
+
+    with _install_lock:
+        if _install_count == 0:
+            _saved_streams = sys.stdout, sys.stderr
+            sys.stdout = _ThreadOutput(sys.stdout, 'stdout')
+            sys.stderr = _ThreadOutput(sys.stderr, 'stderr')
+        _install_count += 1
+
+    try:
+        yield
+    finally:
+        with _install_lock:
+            _install_count -= 1
+            if _install_count == 0:
+                sys.stdout, sys.stderr = _saved_streams
+
+
+@contextlib.contextmanager
+def _capture(stdout, stderr):
+    saved = getattr(_local, 'stdout', None), getattr(_local, 'stderr', None)
+    _local.stdout = stdout
+    _local.stderr = stderr
+    try:
+        yield
+    finally:
+        _local.stdout, _local.stderr = saved
@@ -0,0 +1,500 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+"""Compact binary serialization of Program objects.
+
+The program is written as a table of strings, the columns of the
+SourceTable, and a flat array of 32-bit integers.  All objects are
+numbered per type, and references between them (next_stmt,
+true_stmt, section etc) are stored as these numbers, with -1 for
+None.  Source objects are stored as their index in the SourceTable.
+The statement links that the parser records for each section (see
+StmtLinks) are stored as their arrays, with the statements numbered
+in the same way.
+
+The first string is the program source text.  If it has not been
+decoded yet (see SourceBytes) it is stored as the original bytes, and
+the header refers to the string with its encoding.
+
+Use Program.dump() and Program.load() rather than this module
+directly.
+"""
+
+import struct
+import sys
+from array import array
+from itertools import islice
+
+from .syntax import *
+
+MAGIC = b'CSPROG\r\n'
+FORMAT_VERSION = 4
+
+HEADER = struct.Struct('<8sIIIIi')
+
+# Statement classes, numbered by their position.  Only add new
+# classes at the end, or bump FORMAT_VERSION.
+STMT_CLASSES = [
+    UnparsedStatement,
+    MoveStatement,
+    NextSentenceStatement,
+    GoToStatement,
+    PerformSectionStatement,
+    BranchStatement,
+    ExitSectionStatement,
+    GobackStatement,
+    ExitProgramStatement,
+    StopRunStatement,
+]
+
+STMT_CLASS_INDEX = { cls: i for i, cls in enumerate(STMT_CLASSES) }
+
+class FormatError(Exception): pass
+
+
+def dump_program(program, fp):
+    """Write 'program' to the binary file-like object fp."""
+    ProgramWriter(program).write(fp)
+
+
+def load_program(fp):
+    """Read a Program written by dump_program() from the binary
+    file-like object fp.
+
+    Raises FormatError if the data is not a dumped program, or in
+    an unsupported version of the format.
+    """
+    return ProgramReader(fp).program
+
+
+class ProgramObjects(object):
+    """Lists of all sections, paragraphs, sentences and statements in
+    a program, in the order they are serialized.  Since the order
+    survives a dump and load, object positions in these lists can be
+    used to refer to the same objects in a loaded copy of the program.
+    """
+
+    def __init__(self, program):
+        self.sections = list(program.proc_div.sections.values())
+        self.paras = [p for s in self.sections for p in s.paras.values()]
+        self.sentences = [st for p in self.paras for st in p.sentences]
+        self.stmts = self._collect_stmts(self.sentences)
+
+
+    def index(self):
+        """Return dicts mapping the objects to their positions, as a
+        tuple (sections, paras, sentences, stmts).
+        """
+        return tuple({ obj: i for i, obj in enumerate(objects) }
+                     for objects in (self.sections, self.paras, self.sentences, self.stmts))
+
+
+    def _collect_stmts(self, sentences):
+        # Nested statements are only reachable through the branches,
+        # so follow all links from the sentence statements
+        stmts = []
+        seen = set()
+
+        for sentence in sentences:
+            queue = list(reversed(sentence.stmts))
+            if sentence.first_stmt is not None:
+                queue.insert(0, sentence.first_stmt)
+
+            while queue:
+                stmt = queue.pop()
+                if stmt is None or stmt in seen:
+                    continue
+
+                seen.add(stmt)
+                stmts.append(stmt)
+
+                if isinstance(stmt, BranchStatement):
+                    queue.append(stmt.false_stmt)
+                    queue.append(stmt.true_stmt)
+                elif isinstance(stmt, SequentialStatement):
+                    queue.append(stmt.next_stmt)
+
+        return stmts
+
+
+class ProgramWriter(object):
+    def __init__(self, program):
+        self._strings = []
+        self._string_index = {}
+        self._ints = array('i')
+
+        self._table = table = program.source.table
+        source_bytes = table.source_bytes
+        if source_bytes is not None:
+            self._strings.append(source_bytes.data)
+            self._text_encoding = self._str(source_bytes.encoding)
+        else:
+            self._str(table.text)
+            self._text_encoding = -1
+
+        proc_div = program.proc_div
+        objects = ProgramObjects(program)
+        sections = objects.sections
+        paras = objects.paras
+        sentences = objects.sentences
+        stmts = objects.stmts
+
+        self._sections, self._paras, self._sentences, self._stmts = objects.index()
+
+        # Objects, in the order they will be created when loaded
+        self._source(program.source)
+        self._ints.append(self._str(program.path))
+        self._source(proc_div.source)
+
+        ints = self._ints
+        ints.append(len(sections))
+        for section in sections:
+            ints.append(self._str(section.name))
+            self._source(section.source)
+            ints.append(self._str(section.comment))
+            ints.append(len(section.paras))
+
+            for para in section.paras.values():
+                ints.append(self._str(para.name))
+                self._source(para.source)
+                ints.append(len(para.sentences))
+
+                for sentence in para.sentences:
+                    self._source(sentence.source)
+
+        ints.append(len(stmts))
+        for stmt in stmts:
+            self._write_stmt(stmt)
+
+        # Links between the objects
+        ints.append(self._sections.get(proc_div.first_section, -1))
+
+        for section in sections:
+            ints.append(self._ref(self._paras, section.first_para))
+            self._refs(self._stmts, section.xref_stmts)
+            self._refs(self._sections, sorted(section.used_sections, key=self._sections.get))
+            self._write_links(section.stmt_links)
+
+        for para in paras:
+            ints.append(self._ref(self._sentences, para.first_sentence))
+            ints.append(self._ref(self._paras, para.next_para))
+
+        for sentence in sentences:
+            ints.append(self._ref(self._stmts, sentence.first_stmt))
+            ints.append(self._ref(self._sentences, sentence.next_sentence))
+            self._refs(self._stmts, sentence.stmts)
+
+
+    def write(self, fp):
+        encoded = [s.encode('utf-8', errors='surrogatepass') if isinstance(s, str) else s
+                   for s in self._strings]
+        lengths = array('i', [len(e) for e in encoded])
+        ints = self._ints
+
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+            ints = array('i', ints)
+            ints.byteswap()
+
+        table = self._table
+        columns = array('i')
+        for column in SourceTable.COLUMNS:
+            columns.extend(getattr(table, column))
+
+        if sys.byteorder == 'big':
+            columns.byteswap()
+
+        fp.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(encoded), len(table), len(ints),
+                             self._text_encoding))
+        fp.write(lengths.tobytes())
+        fp.write(encoded[0])
+        fp.write(b''.join(encoded[1:]))
+        fp.write(columns.tobytes())
+        fp.write(ints.tobytes())
+
+
+    def _write_stmt(self, stmt):
+        ints = self._ints
+        cls = type(stmt)
+
+        try:
+            ints.append(STMT_CLASS_INDEX[cls])
+        except KeyError:
+            raise TypeError('cannot serialize statement class {}'.format(cls.__name__))
+
+        ints.append(self._sentences[stmt.sentence])
+        self._source(stmt.source)
+        ints.append(self._str(stmt.comment))
+
+        if cls is BranchStatement:
+            ints.append(self._ref(self._stmts, stmt.true_stmt))
+            ints.append(self._ref(self._stmts, stmt.false_stmt))
+            self._source(stmt.condition.source)
+            ints.append(int(stmt.condition.inverted))
+
+        elif issubclass(cls, SequentialStatement):
+            ints.append(self._ref(self._stmts, stmt.next_stmt))
+
+            if cls is GoToStatement:
+                ints.append(self._str(stmt.para_name))
+            elif cls is PerformSectionStatement:
+                ints.append(self._str(stmt.section_name))
+                ints.append(self._ref(self._sections, stmt.section))
+
+
+    def _write_links(self, links):
+        ints = self._ints
+        if links is None:
+            ints.append(-1)
+            return
+
+        # The nodes are always Exit, the statements and Entry
+        self._refs(self._stmts, links.nodes[1:-1])
+        ints.extend(links.succ_start)
+        ints.append(len(links.succ))
+        ints.extend(links.succ)
+        ints.extend(links.conditions.tolist())
+
+
+    def _ref(self, index, obj):
+        if obj is None:
+            return -1
+        return index[obj]
+
+
+    def _refs(self, index, objects):
+        self._ints.append(len(objects))
+        self._ints.extend(index[obj] for obj in objects)
+
+
+    def _str(self, s):
+        if s is None:
+            return -1
+
+        try:
+            return self._string_index[s]
+        except KeyError:
+            i = self._string_index[s] = len(self._strings)
+            self._strings.append(s)
+            return i
+
+
+    def _source(self, source):
+        if source.table is not self._table:
+            raise ValueError('source object does not refer to the program source table')
+
+        self._ints.append(source.index)
+
+
+class ProgramReader(object):
+    def __init__(self, fp):
+        header = fp.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise FormatError('truncated program data')
+
+        magic, version, num_strings, num_sources, num_ints, text_encoding = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise FormatError('not a serialized program')
+        if version != FORMAT_VERSION:
+            raise FormatError('unsupported program format version: {}'.format(version))
+
+        lengths = self._read_array(fp, num_strings)
+        data = fp.read(sum(lengths))
+        if len(data) != sum(lengths):
+            raise FormatError('truncated program data')
+
+        if not -1 <= text_encoding < num_strings or text_encoding == 0:
+            raise FormatError('corrupt program data')
+
+        strings = []
+        pos = 0
+        for i, length in enumerate(lengths):
+            if i == 0 and text_encoding > 0:
+                # Undecoded source text
+                strings.append(data[pos : pos + length])
+            else:
+                strings.append(data[pos : pos + length].decode('utf-8', errors='surrogatepass'))
+            pos += length
+
+        self._strings = strings
+        if text_encoding > 0:
+            self._table = SourceTable(SourceBytes(strings[0], strings[text_encoding]))
+        else:
+            self._table = SourceTable(strings[0])
+        self._num_sources = num_sources
+
+        columns = self._read_array(fp, num_sources * len(SourceTable.COLUMNS))
+        for i, column in enumerate(SourceTable.COLUMNS):
+            setattr(self._table, column, columns[i * num_sources : (i + 1) * num_sources])
+
+        self._ints = iter(self._read_array(fp, num_ints))
+
+        try:
+            self.program = self._read_program()
+        except (StopIteration, IndexError):
+            raise FormatError('corrupt program data')
+
+
+    def _read_array(self, fp, count):
+        ints = array('i')
+        data = fp.read(count * ints.itemsize)
+        if len(data) != count * ints.itemsize:
+            raise FormatError('truncated program data')
+
+        ints.frombytes(data)
+        if sys.byteorder == 'big':
+            ints.byteswap()
+
+        return ints
+
+
+    def _read_program(self):
+        ints = self._ints
+        source = self._source
+
+        program_source = source()
+        path = self._str(next(ints))
+        proc_div = ProcedureDivision(source())
+        program = Program(program_source, path, proc_div)
+
+        sections = []
+        paras = []
+        sentences = []
+
+        for i in range(next(ints)):
+            section = Section(self._str(next(ints)), source())
+            section.comment = self._str(next(ints))
+            sections.append(section)
+            proc_div.sections[section.name] = section
+
+            for j in range(next(ints)):
+                para = Paragraph(self._str(next(ints)), source(), section)
+                paras.append(para)
+                section.paras[para.name] = para
+
+                for k in range(next(ints)):
+                    sentence = Sentence(source(), para)
+                    sentences.append(sentence)
+                    para.sentences.append(sentence)
+
+        stmts = []
+        links = []
+        for i in range(next(ints)):
+            cls = STMT_CLASSES[next(ints)]
+            sentence = sentences[next(ints)]
+            stmt_source = source()
+            comment = self._str(next(ints))
+
+            if cls is BranchStatement:
+                stmt = BranchStatement(stmt_source, sentence)
+                links.append((stmt, next(ints), next(ints)))
+                stmt.condition = ConditionExpression(source(), bool(next(ints)))
+
+            elif issubclass(cls, SequentialStatement):
+                next_index = next(ints)
+
+                if cls is GoToStatement:
+                    stmt = GoToStatement(stmt_source, sentence, self._str(next(ints)))
+                elif cls is PerformSectionStatement:
+                    stmt = PerformSectionStatement(stmt_source, sentence, self._str(next(ints)))
+                    section_index = next(ints)
+                    if section_index >= 0:
+                        stmt.section = sections[section_index]
+                else:
+                    stmt = cls(stmt_source, sentence)
+
+                links.append((stmt, next_index, None))
+
+            else:
+                stmt = cls(stmt_source, sentence)
+
+            stmt.comment = comment
+            stmts.append(stmt)
+
+        # Now all objects exist, so the references can be resolved
+        for stmt, a, b in links:
+            if b is None:
+                stmt.next_stmt = stmts[a] if a >= 0 else None
+            else:
+                stmt.true_stmt = stmts[a] if a >= 0 else None
+                stmt.false_stmt = stmts[b] if b >= 0 else None
+
+        first_section = next(ints)
+        if first_section >= 0:
+            proc_div.first_section = sections[first_section]
+
+        for section in sections:
+            section.first_para = self._ref(paras, next(ints))
+            section.xref_stmts = self._refs(stmts)
+            section.used_sections = set(self._refs(sections))
+            section.stmt_links = self._read_links(stmts)
+
+        for para in paras:
+            para.first_sentence = self._ref(sentences, next(ints))
+            para.next_para = self._ref(paras, next(ints))
+
+        for sentence in sentences:
+            sentence.first_stmt = self._ref(stmts, next(ints))
+            sentence.next_sentence = self._ref(sentences, next(ints))
+            sentence.stmts = self._refs(stmts)
+
+        return program
+
+
+    def _read_links(self, stmts):
+        ints = self._ints
+        num_stmts = next(ints)
+        if num_stmts < 0:
+            return None
+
+        links = StmtLinks()
+        links.nodes = [Exit]
+        links.nodes.extend(stmts[next(ints)] for i in range(num_stmts))
+        links.nodes.append(Entry)
+        links.succ_start = self._read_ints('i', len(links.nodes) + 1)
+        num_edges = next(ints)
+        links.succ = self._read_ints('i', num_edges)
+        links.conditions = self._read_ints('b', num_edges)
+        links._ids = None
+
+        if (links.succ_start[-1] != num_edges or
+            any(not 0 <= i < len(links.nodes) for i in links.succ)):
+            raise FormatError('corrupt program data')
+
+        return links
+
+
+    def _read_ints(self, typecode, count):
+        if count < 0:
+            raise FormatError('corrupt program data')
+
+        try:
+            values = array(typecode, islice(self._ints, count))
+        except OverflowError:
+            raise FormatError('corrupt program data')
+
+        if len(values) != count:
+            raise FormatError('truncated program data')
+
+        return values
+
+
+    def _source(self):
+        index = next(self._ints)
+        if not 0 <= index < self._num_sources:
+            raise FormatError('corrupt program data')
+
+        return Source(self._table, index)
+
+
+    def _str(self, i):
+        return self._strings[i] if i >= 0 else None
+
+
+    def _ref(self, objects, i):
+        return objects[i] if i >= 0 else None
+
+
+    def _refs(self, objects):
+        ints = self._ints
+        return [objects[next(ints)] for i in range(next(ints))]
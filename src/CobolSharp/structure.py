@@ -4,6 +4,8 @@
 class NodeBase(object):
     """Base class for all nodes in the structure graphs."""
 
+    __slots__ = ('scope', 'source')
+
     def __init__(self):
         self.scope = None
         self.source = None
@@ -20,7 +22,7 @@ class JumpNodeBase(NodeBase):
     (i.e. something that cannot be expressed in Jackson Structured
     Processing diagrams).
     """
-    pass
+    __slots__ = ()
 
 
 class _DummySource(object):
@@ -28,6 +30,10 @@ class _DummySource(object):
     def __init__(self, from_char):
         self.from_char = from_char
 
+# _Entry and _Exit don't use __slots__, since NodeBase.__init__()
+# sets an instance attribute 'source' which needs an instance __dict__
+# next to the class attribute.
+
 class _Entry(NodeBase):
     """Singleton used as the entry node in all graphs."""
 
@@ -53,6 +59,8 @@ Exit = _Exit()
 class Branch(NodeBase):
     """A node that branches to then/else edges in structured graph."""
 
+    __slots__ = ('stmt', 'condition')
+
     def __init__(self, stmt):
         super(Branch, self).__init__()
         self.stmt = stmt
@@ -66,6 +74,8 @@ class Branch(NodeBase):
 class Join(NodeBase):
     """A node where a number of edges join in a structured, but doesn't branch out again."""
 
+    __slots__ = ('stmt', )
+
     def __init__(self, stmt):
         super(Join, self).__init__()
         self.stmt = stmt
@@ -83,6 +93,8 @@ class Loop(NodeBase):
     statement following the loop.
     """
 
+    __slots__ = ('stmt', 'condition', 'continue_loop', 'loop_exit')
+
     def __init__(self, stmt):
         self.stmt = stmt
         self.source = stmt.source
@@ -97,6 +109,8 @@ class Loop(NodeBase):
 class LoopExit(JumpNodeBase):
     """End of a loop in a structured graph"""
 
+    __slots__ = ('loop', )
+
     def __init__(self, loop):
         super(LoopExit, self).__init__()
         self.loop = loop
@@ -108,6 +122,8 @@ class LoopExit(JumpNodeBase):
 class ContinueLoop(JumpNodeBase):
     """Continue to the start of a loop in an structured graph."""
 
+    __slots__ = ('loop', )
+
     def __init__(self, loop):
         super(ContinueLoop, self).__init__()
         self.loop = loop
@@ -120,6 +136,8 @@ class ContinueLoop(JumpNodeBase):
 class GotoNode(JumpNodeBase):
     """Jump to a node in a structured graph."""
 
+    __slots__ = ('node', )
+
     def __init__(self, node):
         super(GotoNode, self).__init__()
         self.node = node
@@ -168,6 +186,9 @@ class Forever(object):
 
 class While(NodeBase):
     """Code structure: a while loop with a condition."""
+
+    __slots__ = ('cobol_para', 'block', 'cobol_branch_stmt', 'condition')
+
     def __init__(self, cobol_para, block, cobol_branch_stmt, condition):
         super(While, self).__init__()
         self.cobol_para = cobol_para
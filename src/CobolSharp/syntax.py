@@ -1,29 +1,343 @@
 # Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
 # Licensed under GPLv3, see file LICENSE in the top directory
 
-class Source(object):
-    def __init__(self, text, from_char, to_char, from_line, to_line, from_column, to_column):
+from array import array
+from bisect import bisect_left, bisect_right
+import mmap
+
+from .structure import Entry, Exit
+
+
+class SourceBytes(object):
+    """Source code kept as bytes until needed, e.g. a memory mapped
+    file.  Every byte must decode to a single char with 'encoding',
+    so that char offsets and byte offsets are the same.  'name' is
+    the file path, if any.
+
+    A memory map should be closed when the file has been parsed, see
+    close(), since a file truncated while mapped crashes the process.
+    """
+
+    def __init__(self, data, encoding, name=None):
+        self.data = data
+        self.encoding = encoding
+        self.name = name
+
+    def __len__(self):
+        return len(self.data)
+
+    def decode(self):
+        return str(self.data, self.encoding)
+
+    def close(self):
+        """Copy a memory-mapped file into bytes and close the map, so
+        the source stays usable without depending on the file.
+        """
+        if isinstance(self.data, mmap.mmap):
+            data = self.data
+            self.data = data[:]
+            data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SourceTable(object):
+    """The positions in the source code 'text' of all Source objects
+    in a program.  Instead of storing the positions in each Source,
+    they are kept in parallel integer arrays with one entry per
+    source: from_char, to_char, from_line, to_line, from_column and
+    to_column.
+
+    The text of each source, without any CR, is only extracted once
+    when first needed and then cached.
+
+    'text' can also be a SourceBytes, which is then only decoded when
+    the text is first needed.
+    """
+
+    COLUMNS = ('from_char', 'to_char', 'from_line', 'to_line', 'from_column', 'to_column')
+
+    def __init__(self, text):
         self.text = text
-        self.from_char = from_char
-        self.to_char = to_char
-        self.from_line = from_line
-        self.to_line = to_line
-        self.from_column = from_column
-        self.to_column = to_column
+        self.from_char = array('i')
+        self.to_char = array('i')
+        self.from_line = array('i')
+        self.to_line = array('i')
+        self.from_column = array('i')
+        self.to_column = array('i')
+
+        self._strings = {}
+        self._clean_text = None
+        self._cr_offsets = None
+
+    def __len__(self):
+        return len(self.from_char)
+
+    @property
+    def text(self):
+        if self._text is None and self.source_bytes is not None:
+            self._text = self.source_bytes.decode()
+            self.source_bytes = None
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        if isinstance(text, SourceBytes):
+            self._text = None
+            self.source_bytes = text
+        else:
+            self._text = text
+            self.source_bytes = None
+
+    def count_lines(self):
+        """Return the number of LF in the text, without decoding it."""
+        if self.source_bytes is None:
+            return self._text.count('\n')
+
+        data = self.source_bytes.data
+        count = 0
+        pos = data.find(b'\n')
+        while pos >= 0:
+            count += 1
+            pos = data.find(b'\n', pos + 1)
+        return count
+
+    def add(self, from_char, to_char, from_line, to_line, from_column, to_column):
+        """Add a source code position and return a Source for it."""
+        index = len(self.from_char)
+        self.from_char.append(from_char)
+        self.to_char.append(to_char)
+        self.from_line.append(from_line)
+        self.to_line.append(to_line)
+        self.from_column.append(from_column)
+        self.to_column.append(to_column)
+        return Source(self, index)
+
+    def source_str(self, index):
+        """Return the text of the source at 'index', without any CR."""
+        try:
+            return self._strings[index]
+        except KeyError:
+            pass
+
+        if self._clean_text is None:
+            self._remove_cr()
+
+        # The char offsets refer to the original text, so skip the
+        # number of CR removed before them
+        from_char = self.from_char[index]
+        to_char = self.to_char[index] + 1
+        cr_offsets = self._cr_offsets
+        if cr_offsets:
+            from_char -= bisect_left(cr_offsets, from_char)
+            to_char -= bisect_left(cr_offsets, to_char)
+
+        s = self._strings[index] = self._clean_text[from_char : to_char]
+        return s
+
+    def _remove_cr(self):
+        # CR could not be dropped when reading the source text since
+        # that would upset the character offsets reported by koopa
+        text = self.text
+        pos = text.find('\r')
+        if pos >= 0:
+            cr_offsets = self._cr_offsets = array('i')
+            while pos >= 0:
+                cr_offsets.append(pos)
+                pos = text.find('\r', pos + 1)
+
+            self._clean_text = text.replace('\r', '')
+        else:
+            self._clean_text = text
+
+
+class LineIndex(object):
+    """The start offsets of each line in a source code text, for
+    looking up lines by number or char offset.  Lines are numbered
+    from 1, like in Koopa.  Line separators are not included in the
+    line text, but a CR before them is.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.starts = starts = array('i', [0])
+
+        pos = text.find('\n')
+        while pos >= 0:
+            starts.append(pos + 1)
+            pos = text.find('\n', pos + 1)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def line_at(self, char):
+        """Return the number of the line containing the char offset."""
+        return bisect_right(self.starts, char)
+
+    def line_start(self, line):
+        """Return the char offset of the start of the line."""
+        return self.starts[line - 1]
+
+    def line_end(self, line):
+        """Return the char offset just after the end of the line,
+        excluding the line separator.
+        """
+        if line < len(self.starts):
+            return self.starts[line] - 1
+        return len(self.text)
+
+    def line(self, line):
+        """Return the text of a line."""
+        return self.text[self.line_start(line) : self.line_end(line)]
+
+    def lines(self, first=1, last=None):
+        """Generate the text of the lines from first to last, inclusive."""
+        if last is None:
+            last = len(self.starts)
+
+        for line in range(first, last + 1):
+            yield self.line(line)
+
+
+class Source(object):
+    """A position in the source code, stored in a SourceTable."""
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def text(self):
+        return self.table.text
+
+    @property
+    def from_char(self):
+        return self.table.from_char[self.index]
+
+    @property
+    def to_char(self):
+        return self.table.to_char[self.index]
+
+    @property
+    def from_line(self):
+        return self.table.from_line[self.index]
+
+    @property
+    def to_line(self):
+        return self.table.to_line[self.index]
+
+    @property
+    def from_column(self):
+        return self.table.from_column[self.index]
+
+    @property
+    def to_column(self):
+        return self.table.to_column[self.index]
 
     def __str__(self):
-        # Drop any CR in the source (could not be done when reading the source text
-        #  since that would upset the character offsets reported by koopa)
-        return self.text[self.from_char : self.to_char + 1].replace('\r', '')
+        return self.table.source_str(self.index)
 
     def __repr__(self):
         return '<Source char {0.from_char}-{0.to_char}, line {0.from_line}-{0.to_line}, column {0.from_column}-{0.to_column}>'.format(self)
 
+class StmtLinks(object):
+    """The statement graph of a section, recorded by the parser while
+    it links the statements, so that StmtGraph.from_section() doesn't
+    have to walk the section again.
+
+    'nodes' holds Exit, the statements and finally Entry, numbered
+    by their position.  The successors of node i are
+    succ[succ_start[i]:succ_start[i + 1]], and 'conditions' holds the
+    condition of each edge: 1 for True, 0 for False and -1 for
+    unconditional edges.
+
+    Statements must be added after their successors, which is the
+    order the parser creates them in.
+    """
+
+    __slots__ = ('nodes', 'succ_start', 'succ', 'conditions', '_ids')
+
+    def __init__(self):
+        self.nodes = [Exit]
+        self.succ_start = array('i', [0, 0])
+        self.succ = array('i')
+        self.conditions = array('b')
+        self._ids = { Exit: 0 }
+
+    def add(self, stmt, next_stmt):
+        """Add a statement with a single edge to next_stmt, or Exit if None."""
+        self.succ.append(self._ids[next_stmt] if next_stmt is not None else 0)
+        self.conditions.append(-1)
+        self._add_node(stmt)
+
+    def add_branch(self, stmt):
+        """Add a BranchStatement with edges to its true and false statements."""
+        ids = self._ids
+        true_id = ids[stmt.true_stmt] if stmt.true_stmt is not None else 0
+        false_id = ids[stmt.false_stmt] if stmt.false_stmt is not None else 0
+
+        # Like in a DiGraph, a single edge if both go to the same statement
+        if true_id != false_id:
+            self.succ.append(true_id)
+            self.conditions.append(1)
+
+        self.succ.append(false_id)
+        self.conditions.append(0)
+        self._add_node(stmt)
+
+    def set_next(self, stmt):
+        """Update the edge of a statement that was added before its
+        next_stmt was known, as for GO TO.
+        """
+        i = self._ids[stmt]
+        next_stmt = stmt.next_stmt
+        self.succ[self.succ_start[i]] = self._ids[next_stmt] if next_stmt is not None else 0
+
+    def finish(self, first_stmt):
+        """Add Entry with an edge to first_stmt, or Exit if None."""
+        self.add(Entry, first_stmt)
+        self._ids = None
+
+    def _add_node(self, node):
+        self._ids[node] = len(self.nodes)
+        self.nodes.append(node)
+        self.succ_start.append(len(self.succ))
+
+
 class Program(object):
     def __init__(self, source, path, proc_div):
         self.source = source
         self.path = path
         self.proc_div = proc_div
+        self._line_index = None
+
+    @property
+    def line_index(self):
+        """A LineIndex for the program source code, built when first used."""
+        if self._line_index is None:
+            self._line_index = LineIndex(self.source.text)
+        return self._line_index
+
+    def dump(self, fp):
+        """Write the program in a compact binary format to the file-like
+        object fp, which must be opened in binary mode.
+        """
+        from .serialize import dump_program
+        dump_program(self, fp)
+
+    @staticmethod
+    def load(fp):
+        """Read a program written by Program.dump() from the binary
+        file-like object fp.
+        """
+        from .serialize import load_program
+        return load_program(fp)
 
     def __str__(self):
         return str(self.proc_div)
@@ -43,6 +357,9 @@ class ProcedureDivision(object):
 
 
 class Section(object):
+    __slots__ = ('name', 'source', 'comment', 'first_para', 'paras',
+                 'xref_stmts', 'used_sections', 'stmt_links')
+
     def __init__(self, name, source):
         self.name = name
         self.source = source
@@ -52,6 +369,9 @@ class Section(object):
         self.xref_stmts = []
         self.used_sections = set()
 
+        # StmtLinks from the parser, if any
+        self.stmt_links = None
+
     def get_first_stmt(self):
         if self.first_para:
             return self.first_para.get_first_stmt()
@@ -75,6 +395,8 @@ class Section(object):
 
 
 class Paragraph(object):
+    __slots__ = ('name', 'source', 'section', 'first_sentence', 'sentences', 'next_para')
+
     def __init__(self, name, source, section):
         self.name = name
         self.source = source
@@ -111,6 +433,8 @@ class Paragraph(object):
 
 
 class Sentence(object):
+    __slots__ = ('source', 'para', 'first_stmt', 'stmts', 'next_sentence')
+
     def __init__(self, source, para):
         self.source = source
         self.para = para
@@ -126,6 +450,8 @@ class Sentence(object):
 
 
 class CobolStatement(object):
+    __slots__ = ('source', 'sentence', 'comment')
+
     def __init__(self, source, sentence):
         self.source = source
         self.sentence = sentence
@@ -148,6 +474,8 @@ class CobolStatement(object):
 
 
 class ConditionExpression(object):
+    __slots__ = ('source', 'inverted')
+
     def __init__(self, source, inverted=False):
         self.source = source
         self.inverted = inverted
@@ -167,6 +495,8 @@ class ConditionExpression(object):
 
 
 class BranchStatement(CobolStatement):
+    __slots__ = ('condition', 'true_stmt', 'false_stmt')
+
     def __init__(self, source, sentence):
         super(BranchStatement, self).__init__(source, sentence)
         self.condition = None
@@ -189,6 +519,8 @@ class BranchStatement(CobolStatement):
 
 
 class SequentialStatement(CobolStatement):
+    __slots__ = ('next_stmt', )
+
     def __init__(self, source, sentence):
         super(SequentialStatement, self).__init__(source, sentence)
         self.next_stmt = None
@@ -203,39 +535,43 @@ class SequentialStatement(CobolStatement):
 
 
 class GoToStatement(SequentialStatement):
+    __slots__ = ('para_name', )
+
     def __init__(self, source, sentence, para_name):
         super(GoToStatement, self).__init__(source, sentence)
         self.para_name = para_name
 
 
 class NextSentenceStatement(SequentialStatement):
-    pass
+    __slots__ = ()
 
 class MoveStatement(SequentialStatement):
-    pass
+    __slots__ = ()
 
 class PerformSectionStatement(SequentialStatement):
+    __slots__ = ('section_name', 'section')
+
     def __init__(self, source, sentence, section_name):
         super(PerformSectionStatement, self).__init__(source, sentence)
         self.section_name = section_name
         self.section = None
 
 class UnparsedStatement(SequentialStatement):
-    pass
+    __slots__ = ()
 
 
 class TerminatingStatement(CobolStatement):
-    pass
+    __slots__ = ()
 
 class ExitSectionStatement(TerminatingStatement):
-    pass
+    __slots__ = ()
 
 class GobackStatement(TerminatingStatement):
-    pass
+    __slots__ = ()
 
 class ExitProgramStatement(TerminatingStatement):
-    pass
+    __slots__ = ()
 
 class StopRunStatement(TerminatingStatement):
-    pass
+    __slots__ = ()
 
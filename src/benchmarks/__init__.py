@@ -0,0 +1,8 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+"""Benchmarks, run from the src directory with e.g.:
+
+    python -m benchmarks.memory
+    python -m benchmarks.scaling
+"""
@@ -0,0 +1,88 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+"""Measure the memory used per statement by the program model and the
+structure graphs.
+
+Usage: python -m benchmarks.memory [-n STATEMENTS] [COBOL_FILE]
+
+Without a COBOL_FILE, a synthetic program is built instead of
+parsing one with Koopa.
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from CobolSharp import *
+from CobolSharp.serialize import ProgramObjects
+
+from tests.synthetic import build_program
+
+
+def load_program(args):
+    if args.source:
+        with open(args.source, 'rt', encoding='iso-8859-1', newline='') as f:
+            code = f.read()
+
+        # Parse once into a throwaway cache, and measure the program
+        # loaded from it, so that Koopa and the XML aren't counted
+        with tempfile.TemporaryDirectory() as cache_dir:
+            program = parse(code, cache=ParseCache(cache_dir))
+            tracemalloc.start()
+            program = parse(code, cache=ParseCache(cache_dir))
+    else:
+        tracemalloc.start()
+        program = build_program(args.statements)
+
+    return program
+
+
+def analyze(program):
+    blocks = []
+    for section in program.proc_div.sections.values():
+        reachable = StmtGraph.from_section(section).reachable_subgraph()
+        cobol_graph = CobolStructureGraph.from_stmt_graph(reachable)
+        dag = AcyclicStructureGraph.from_cobol_graph(cobol_graph)
+        scope_graph = ScopeStructuredGraph.from_acyclic_graph(dag)
+        blocks.append(scope_graph.flatten_block())
+
+    return blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--statements', type=int, default=50000,
+                        help='statements in the synthetic program (default 50000)')
+    parser.add_argument('source', nargs='?', metavar='COBOL_FILE',
+                        help='measure this program instead of a synthetic one')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    program = load_program(args)
+    elapsed = time.perf_counter() - start
+
+    # Don't count the source code text, which is needed anyway
+    model_bytes = tracemalloc.get_traced_memory()[0] - sys.getsizeof(program.source.text)
+    num_stmts = len(ProgramObjects(program).stmts)
+
+    # Restart to only trace the analysis
+    tracemalloc.stop()
+    tracemalloc.start()
+    analyze_start = time.perf_counter()
+    analyze(program)
+    analyze_elapsed = time.perf_counter() - analyze_start
+    analyze_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print('statements:              {}'.format(num_stmts))
+    print('program model:           {:.1f} MB, {:.0f} bytes/statement, {:.2f} s'.format(
+        model_bytes / 1e6, model_bytes / num_stmts, elapsed))
+    print('analysis peak:           {:.1f} MB, {:.0f} bytes/statement, {:.2f} s'.format(
+        analyze_peak / 1e6, analyze_peak / num_stmts, analyze_elapsed))
+
+
+if __name__ == '__main__':
+    main()
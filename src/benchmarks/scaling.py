@@ -0,0 +1,123 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+"""Measure how the analysis steps scale with the size of a section.
+
+Usage: python -m benchmarks.scaling [-n STATEMENTS] [--loops LOOPS [--nesting DEPTH] | --else-if DEPTH] [--gc]
+
+A synthetic section is built with 1/8, 1/4, 1/2 and all of the
+statements, and each step is timed.  The time per statement stays
+roughly the same for a step that scales linearly.
+
+With --loops, each paragraph of 30 statements is a loop, and the
+largest section has LOOPS loops instead of STATEMENTS statements.
+With --nesting, the loops are nested DEPTH deep in groups of sibling
+loop nests.
+
+With --else-if, the section is a single IF/ELSE IF chain, with DEPTH
+IF statements in the largest section.
+
+The garbage collector is paused while timing, unless --gc is given,
+since its full collections take longer the more objects there are
+and would hide how the steps themselves scale.
+"""
+
+import argparse
+import gc
+import time
+
+from CobolSharp import *
+
+from tests.synthetic import ProgramBuilder, build_program
+
+
+def build_section(num_stmts, loops=False, nesting=1):
+    """Return a single section with about num_stmts statements, with
+    a loop in each paragraph if loops is true, nested nesting deep.
+    """
+    program = build_program(num_stmts, paras_per_section=max(1, num_stmts // 30),
+                            loops=loops, nesting=nesting)
+    return program.proc_div.sections['s0']
+
+
+def build_else_if_section(depth):
+    """Return a section with an IF/ELSE IF chain of depth IF statements."""
+    builder = ProgramBuilder()
+    builder.section('s0')
+    builder.else_if(depth)
+    builder.move()
+    return builder.build().proc_div.sections['s0']
+
+
+def time_steps(section):
+    """Run the steps on section, returning a list of (step, seconds)."""
+    times = []
+
+    start = time.perf_counter()
+    reachable = StmtGraph.from_section(section).reachable_subgraph()
+    times.append(('stmt graph', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    cobol_graph = CobolStructureGraph.from_stmt_graph(reachable)
+    times.append(('cobol graph', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    dag = AcyclicStructureGraph.from_cobol_graph(cobol_graph)
+    times.append(('acyclic graph', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    scope_graph = ScopeStructuredGraph.from_acyclic_graph(dag)
+    times.append(('scope graph', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    scope_graph.flatten_block()
+    times.append(('flatten', time.perf_counter() - start))
+
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--statements', type=int, default=100000,
+                        help='statements in the largest section (default 100000)')
+    parser.add_argument('--loops', type=int,
+                        help='make each paragraph a loop, with LOOPS in the largest section')
+    parser.add_argument('--nesting', type=int, default=1, metavar='DEPTH',
+                        help='nest the loops DEPTH deep (default 1)')
+    parser.add_argument('--else-if', type=int, metavar='DEPTH',
+                        help='time an IF/ELSE IF chain, DEPTH deep in the largest section')
+    parser.add_argument('--gc', action='store_true',
+                        help='keep the garbage collector running while timing')
+    args = parser.parse_args()
+
+    if args.loops:
+        args.statements = args.loops * 30
+
+    print('{:>10} {:<13} {:>9} {:>12}'.format('statements', 'step', 'time (s)', 'us/statement'))
+
+    for fraction in (8, 4, 2, 1):
+        if args.else_if:
+            section = build_else_if_section(args.else_if // fraction)
+        else:
+            section = build_section(args.statements // fraction, loops=bool(args.loops),
+                                    nesting=args.nesting)
+        num_stmts = sum(len(sentence.stmts)
+                        for para in section.paras.values()
+                        for sentence in para.sentences)
+
+        gc.collect()
+        if not args.gc:
+            gc.disable()
+
+        try:
+            times = time_steps(section)
+        finally:
+            gc.enable()
+
+        for step, seconds in times:
+            print('{:>10} {:<13} {:>9.3f} {:>12.2f}'.format(
+                num_stmts, step, seconds, seconds * 1e6 / num_stmts))
+
+
+if __name__ == '__main__':
+    main()
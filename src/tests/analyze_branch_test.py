@@ -3,10 +3,16 @@
 
 import pytest
 
+from CobolSharp import *
 from CobolSharp.syntax import *
 from CobolSharp.structure import *
 
-from .conftest import ExpectedBlock
+from CobolSharp.parallel import BlockEncoder, BlockDecoder
+from CobolSharp.serialize import ProgramObjects
+
+from .synthetic import ProgramBuilder
+
+from .conftest import ExpectedBlock, structure_graphs
 
 
 def test_single_if(cobol_block):
@@ -146,6 +152,74 @@ def test_reduced_crossed_if_branches(cobol_block):
     ).assert_block(cobol_block)
 
 
+def test_tail_nodes_labelled_while_reducing_tails(cobol_block):
+    """
+           if b > 0
+               if b > 1
+                   perform b-plus
+                   go to inner-true
+               else
+                   go to inner-false
+           else
+               if b < -1
+                   perform b-minus
+                   go to inner-true
+               else
+                   go to inner-false.
+
+       inner-true.
+           perform inner-true
+           go to second.
+
+       inner-false.
+           perform inner-false
+           go to second.
+
+       second.
+           if b > 0
+               perform second-plus
+               go to second-true
+           else
+               go to second-false.
+
+       second-true.
+           perform second-true
+           exit program.
+
+       second-false.
+           perform second-false
+           exit program.
+"""
+    inner_false_label = GotoLabel('inner-false', None)
+    second_label = GotoLabel('second', None)
+
+    # The second label is only created when the inner-false tail is
+    # reduced, but is still added in source code order
+    ExpectedBlock(
+        If(None, ConditionExpression(None, False),
+           ExpectedBlock(If(None, ConditionExpression(None, False),
+                            ExpectedBlock(PerformSectionStatement(None, None, 'b-plus')),
+                            ExpectedBlock(Goto(inner_false_label)))),
+           ExpectedBlock(If(None, ConditionExpression(None, False),
+                            ExpectedBlock(PerformSectionStatement(None, None, 'b-minus')),
+                            ExpectedBlock(Goto(inner_false_label))))),
+
+        PerformSectionStatement(None, None, 'inner-true'),
+        Goto(second_label),
+
+        inner_false_label,
+        PerformSectionStatement(None, None, 'inner-false'),
+        Goto(second_label),
+
+        second_label,
+        If(None, ConditionExpression(None, False),
+           ExpectedBlock(PerformSectionStatement(None, None, 'second-plus'),
+                         PerformSectionStatement(None, None, 'second-true')),
+           ExpectedBlock(PerformSectionStatement(None, None, 'second-false'))),
+        Return(),
+    ).assert_block(cobol_block)
+
+
 def test_remove_else_when_then_returns(cobol_block):
     """
            if b > 0
@@ -231,3 +305,99 @@ def test_remove_long_then_block_when_else_returns(cobol_block):
         PerformSectionStatement(None, None, 'inner-true'),
     ).assert_block(cobol_block)
 
+
+def synthetic_program(add_stmts):
+    # Deeper nesting than the recursion limit, and than Koopa can
+    # parse, so the program is built directly
+    builder = ProgramBuilder()
+    builder.section('test')
+    add_stmts(builder)
+    builder.move()
+    return builder.build()
+
+
+def synthetic_block(add_stmts, program=None):
+    if program is None:
+        program = synthetic_program(add_stmts)
+
+    section = program.proc_div.sections['test']
+    dag, scope_graph = structure_graphs(StmtGraph.from_section(section))
+    return scope_graph.flatten_block()
+
+
+def test_deeply_nested_if():
+    depth = 5000
+    block = synthetic_block(lambda builder: builder.nested_if(depth))
+
+    # The outer ifs are cheaper as jumps past the inner statement,
+    # so only the innermost ones are kept nested.  The blocks are
+    # walked here, since ExpectedBlock would recurse.
+    *jumps, nested, label, move = block.stmts
+    assert isinstance(label, GotoLabel)
+    assert isinstance(move, MoveStatement)
+
+    for stmt in jumps:
+        assert isinstance(stmt, If)
+        assert stmt.condition.inverted
+        assert len(stmt.then_block.stmts) == 1
+        assert stmt.then_block.stmts[0].label is label
+        assert stmt.else_block.stmts == []
+
+    stmt = nested
+    levels = len(jumps)
+    while isinstance(stmt, If):
+        assert not stmt.condition.inverted
+        assert stmt.else_block.stmts == []
+        assert len(stmt.then_block.stmts) == 1
+        stmt = stmt.then_block.stmts[0]
+        levels += 1
+
+    assert isinstance(stmt, MoveStatement)
+    assert levels == depth
+
+
+def test_deep_else_if_chain():
+    depth = 5000
+    block = synthetic_block(lambda builder: builder.else_if(depth))
+
+    assert len(block.stmts) == 2
+    assert isinstance(block.stmts[1], MoveStatement)
+
+    stmt = block.stmts[0]
+    for i in range(depth):
+        assert isinstance(stmt, If)
+        assert not stmt.condition.inverted
+        assert len(stmt.then_block.stmts) == 1
+        assert isinstance(stmt.then_block.stmts[0], MoveStatement)
+
+        else_stmts = stmt.else_block.stmts
+        assert len(else_stmts) == (1 if i < depth - 1 else 0)
+        stmt = else_stmts[0] if else_stmts else None
+
+
+def test_deep_else_if_chain_encoding():
+    depth = 5000
+    program = synthetic_program(lambda builder: builder.else_if(depth))
+    block = synthetic_block(None, program)
+
+    # As used by --section-jobs, but decoded into the same program
+    objects = ProgramObjects(program)
+    encoded = BlockEncoder(objects.index()).encode(block)
+    decoded = BlockDecoder(objects, program.source.table).decode(encoded)
+
+    pairs = [(block, decoded)]
+    while pairs:
+        expected, actual = pairs.pop()
+        assert isinstance(actual, Block)
+        assert len(actual.stmts) == len(expected.stmts)
+
+        for expected_stmt, stmt in zip(expected.stmts, actual.stmts):
+            if isinstance(expected_stmt, If):
+                assert isinstance(stmt, If)
+                assert stmt.cobol_stmt is expected_stmt.cobol_stmt
+                assert stmt.condition.source.index == expected_stmt.condition.source.index
+                assert stmt.condition.inverted == expected_stmt.condition.inverted
+                pairs.append((expected_stmt.then_block, stmt.then_block))
+                pairs.append((expected_stmt.else_block, stmt.else_block))
+            else:
+                assert stmt is expected_stmt
@@ -0,0 +1,182 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+import os
+
+import pytest
+
+from CobolSharp import *
+from CobolSharp import cache as cache_module
+from CobolSharp.syntax import SourceBytes
+
+from .koopa_server_test import good_code, bad_code
+
+
+@pytest.fixture(scope='function')
+def cache(tmpdir):
+    return ParseCache(str(tmpdir.join('cache')))
+
+
+def cache_files(cache):
+    return [os.path.join(dirpath, f)
+            for dirpath, dirnames, filenames in os.walk(cache.directory)
+            for f in filenames]
+
+
+def test_cache_hit_skips_koopa(cache):
+    program = parse(good_code, cache=cache)
+    assert cache.misses == 1
+    assert len(cache_files(cache)) == 1
+
+    with KoopaServer() as server:
+        program2 = parse(good_code, server=server, cache=cache)
+
+        # The JVM was never started
+        assert server._process is None
+
+    assert cache.hits == 1
+    assert sorted(program2.proc_div.sections) == sorted(program.proc_div.sections)
+    assert str(program2) == str(program)
+
+
+def test_cache_key():
+    cache = ParseCache('unused')
+
+    assert cache.key(good_code, 4) == cache.key(good_code, 4)
+    assert cache.key(good_code, 4) != cache.key(good_code, 8)
+    assert cache.key(good_code, 4) != cache.key(good_code + ' ', 4)
+
+    data = good_code.encode('iso-8859-1')
+    assert cache.key(SourceBytes(data, 'iso-8859-1'), 4) == cache.key(SourceBytes(data, 'iso-8859-1'), 4)
+    assert cache.key(SourceBytes(data, 'iso-8859-1'), 4) != cache.key(SourceBytes(data, 'cp437'), 4)
+    assert cache.key(SourceBytes(data, 'iso-8859-1'), 4) != cache.key(good_code, 4)
+
+
+def test_cache_does_not_store_errors(cache):
+    with pytest.raises(ParserError):
+        parse(bad_code, cache=cache)
+
+    assert cache_files(cache) == []
+
+
+def test_cache_prune(cache):
+    for i in range(3):
+        parse(good_code + '      * {}\n'.format(i), cache=cache)
+
+    paths = sorted(cache_files(cache), key=os.path.getmtime)
+    assert len(paths) == 3
+
+    # Make the first one most recently used
+    for n, path in enumerate(paths):
+        os.utime(path, (1000 + n, 1000 + n))
+
+    parse(good_code + '      * 0\n', cache=cache)
+    assert cache.hits == 1
+
+    cache.max_size = os.path.getsize(paths[0]) + os.path.getsize(paths[2])
+    cache.prune()
+
+    assert sorted(cache_files(cache)) == sorted([paths[0], paths[2]])
+
+
+def test_cache_store_scans_rarely(cache, monkeypatch):
+    program = parse(good_code)
+
+    scans = []
+    prune = cache.prune
+    monkeypatch.setattr(cache, 'prune', lambda: scans.append(1) or prune())
+    monkeypatch.setattr(cache_module, 'PRUNE_INTERVAL', 5)
+
+    # The first store scans the cache, and then every fifth
+    for i in range(12):
+        cache.store(good_code + '      * {}\n'.format(i), 4, program)
+
+    assert len(scans) == 3
+    assert cache._size == sum(os.path.getsize(p) for p in cache_files(cache))
+
+    # Going over max_size scans right away
+    cache.max_size = cache._size + 1
+    cache.store(good_code + '      * 12\n', 4, program)
+
+    assert len(scans) == 4
+    assert len(cache_files(cache)) < 13
+    assert sum(os.path.getsize(p) for p in cache_files(cache)) <= cache.max_size
+
+
+def test_cache_hit_sets_path(cache, tmpdir):
+    path = tmpdir.join('copy.cbl')
+    path.write(good_code)
+
+    parse(good_code, cache=cache)
+    with open(str(path), 'rt', newline='') as f:
+        program = parse(f, cache=cache)
+
+    assert cache.hits == 1
+    assert program.path == str(path)
+
+
+def test_cache_replaces_broken_entry(cache):
+    parse(good_code, cache=cache)
+    path, = cache_files(cache)
+
+    with open(path, 'wb') as f:
+        f.write(b'garbage')
+
+    program = parse(good_code, cache=cache)
+    assert cache.hits == 0
+    assert 'a' in program.proc_div.sections
+
+    parse(good_code, cache=cache)
+    assert cache.hits == 1
+
+
+def test_cache_replaces_corrupt_entry(cache):
+    parse(good_code, cache=cache)
+    path, = cache_files(cache)
+
+    # Flip bytes in the compressed data, after the gzip header
+    with open(path, 'r+b') as f:
+        data = bytearray(f.read())
+        for pos in range(20, len(data) - 8):
+            data[pos] ^= 0xff
+        f.seek(0)
+        f.write(data)
+
+    program = parse(good_code, cache=cache)
+    assert cache.hits == 0
+    assert 'a' in program.proc_div.sections
+
+    parse(good_code, cache=cache)
+    assert cache.hits == 1
+
+
+def test_cache_unwritable(tmpdir, capsys):
+    # A file where the cache directory should be
+    tmpdir.join('file').write('')
+    cache = ParseCache(str(tmpdir.join('file', 'cache')))
+
+    for i in range(2):
+        program = parse(good_code, cache=cache)
+        assert 'a' in program.proc_div.sections
+
+    out, err = capsys.readouterr()
+    assert err.count('cannot write to parse cache') == 1
+
+
+def test_cache_hit_repeats_warnings(cache, tmpdir, capsys):
+    code = good_code.replace('perform a.', 'perform nowhere.')
+
+    paths = []
+    for name in ('a.cbl', 'b.cbl'):
+        path = tmpdir.join(name)
+        path.write(code)
+        paths.append(str(path))
+
+        with open(str(path), 'rt', newline='') as f:
+            parse(f, cache=cache)
+
+    assert cache.hits == 1
+
+    out, err = capsys.readouterr()
+    assert err.splitlines() == ['{}: line 10: reference to undefined section: nowhere'.format(p)
+                                for p in paths]
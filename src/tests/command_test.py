@@ -0,0 +1,172 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+import os
+import sys
+
+import pytest
+
+from CobolSharp import command
+
+from .koopa_server_test import good_code, bad_code
+
+
+def run_command(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['cobolsharp'] + [str(a) for a in args])
+    command.main()
+
+
+@pytest.fixture(scope='function')
+def sources(tmpdir):
+    paths = []
+    for name, code in (('a.cbl', good_code), ('b.cbl', bad_code),
+                       ('c.cbl', good_code), ('d.cbl', good_code)):
+        path = tmpdir.join(name)
+        path.write(code)
+        paths.append(str(path))
+
+    return paths
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_jobs(monkeypatch, capsys, tmpdir, sources, jobs):
+    destdir = tmpdir.mkdir('out')
+
+    with pytest.raises(SystemExit) as excinfo:
+        run_command(monkeypatch, '-j', jobs, '--no-cache', '-f', 'code', '-d', destdir, *sources)
+
+    assert str(excinfo.value) == '1 of 4 source files could not be processed'
+
+    out, err = capsys.readouterr()
+    assert out.splitlines() == ['wrote {}'.format(destdir.join(name))
+                                for name in ('a.cs', 'c.cs', 'd.cs')]
+
+    assert '{}: '.format(sources[1]) in err
+    assert err.endswith('Failed source files:\n  {}\n'.format(sources[1]))
+
+    assert sorted(f.basename for f in destdir.listdir()) == ['a.cs', 'c.cs', 'd.cs']
+
+
+def test_jobs_undefined_section(monkeypatch, capsys, tmpdir, sources):
+    destdir = tmpdir.mkdir('out')
+
+    with pytest.raises(SystemExit) as excinfo:
+        run_command(monkeypatch, '-j', 2, '--no-cache', '-s', 'foo', '-d', destdir,
+                    sources[0], sources[2])
+
+    assert str(excinfo.value) == '2 of 2 source files could not be processed'
+
+    out, err = capsys.readouterr()
+    assert '{}: section not defined: foo'.format(sources[0]) in err
+    assert '{}: section not defined: foo'.format(sources[2]) in err
+
+
+def test_section_jobs(monkeypatch, capsys, tmpdir):
+    source = os.path.join(os.path.dirname(__file__), '..', '..', 'test', 'loops.cbl')
+
+    outputs = []
+    for jobs in (1, 2):
+        destdir = tmpdir.mkdir('out{}'.format(jobs))
+        run_command(monkeypatch, '--section-jobs', jobs, '--no-cache', '-u', '-D',
+                    '-f', 'code', '-d', destdir, source)
+        outputs.append(destdir.join('loops.cs').read())
+
+    capsys.readouterr()
+    assert outputs[0] == outputs[1]
+    assert 'cobolsharp: if reduction strategies' in outputs[0]
+
+
+def test_html_files_complete(monkeypatch, capsys, tmpdir):
+    test_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'test')
+    sources = [os.path.join(test_dir, name) for name in ('crossedbranches.cbl', 'loops.cbl')]
+
+    run_command(monkeypatch, '--no-cache', '-d', tmpdir, *sources)
+    capsys.readouterr()
+
+    for name in ('crossedbranches.html', 'loops.html'):
+        assert tmpdir.join(name).read().rstrip().endswith('</html>')
+
+
+def test_section_jobs_excludes_jobs(monkeypatch, capsys, sources):
+    with pytest.raises(SystemExit):
+        run_command(monkeypatch, '-j', 2, '--section-jobs', 2, *sources)
+
+    out, err = capsys.readouterr()
+    assert '-j and --section-jobs cannot both be used' in err
+
+
+def test_stats(monkeypatch, capsys, tmpdir, sources):
+    run_command(monkeypatch, '--stats', '--no-cache', '-f', 'code', '-d', tmpdir, sources[0])
+
+    out, err = capsys.readouterr()
+    lines = err.splitlines()
+    assert lines[-5].split()[0] == 'stage'
+    assert [line.split()[:2] for line in lines[-4:-1]] == [
+        ['parse', '1'], ['analyze', '1'], ['render', '1']]
+    assert lines[-1].startswith('elapsed ')
+
+
+def test_xml_missing_file(monkeypatch, capsys, tmpdir, sources):
+    destdir = tmpdir.mkdir('out')
+    missing = str(tmpdir.join('missing.cbl'))
+
+    with pytest.raises(SystemExit) as excinfo:
+        run_command(monkeypatch, '-j', 1, '-f', 'xml', '-d', destdir, sources[0], missing)
+
+    assert str(excinfo.value) == '1 of 2 source files could not be processed'
+
+    out, err = capsys.readouterr()
+    assert out.splitlines() == ['wrote {}'.format(destdir.join('a.xml'))]
+    assert err.endswith('Failed source files:\n  {}\n'.format(missing))
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_jobs_unexpected_error(monkeypatch, capsys, tmpdir, sources, jobs):
+    destdir = tmpdir.mkdir('out')
+    analyze_program = command.analyze_program
+
+    def broken_analyze_program(args, output_base, program):
+        assert not output_base.endswith('c'), 'broken analysis'
+        return analyze_program(args, output_base, program)
+
+    monkeypatch.setattr(command, 'analyze_program', broken_analyze_program)
+
+    with pytest.raises(SystemExit) as excinfo:
+        run_command(monkeypatch, '-j', jobs, '--no-cache', '-f', 'code', '-d', destdir, *sources)
+
+    assert str(excinfo.value) == '2 of 4 source files could not be processed'
+
+    out, err = capsys.readouterr()
+    assert '{}: AssertionError: broken analysis'.format(sources[2]) in err
+
+    # The traceback shows where the stage failed
+    assert 'Traceback (most recent call last):' in err
+    assert "in broken_analyze_program\n    assert not output_base.endswith('c')" in err
+    assert err.endswith('Failed source files:\n  {}\n  {}\n'.format(sources[1], sources[2]))
+    assert sorted(f.basename for f in destdir.listdir()) == ['a.cs', 'd.cs']
+
+
+def test_source_chunks():
+    sources = ['{}.cbl'.format(i) for i in range(100)]
+
+    chunks = command.source_chunks(sources, 2)
+    assert [len(c) for c in chunks] == [command.MAX_CHUNK_SIZE] * 5
+    assert sum(chunks, []) == sources
+
+    assert [len(c) for c in command.source_chunks(sources[:10], 2)] == [2] * 5
+    assert command.source_chunks(sources[:3], 4) == [[s] for s in sources[:3]]
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_jobs_stats(monkeypatch, capsys, tmpdir, sources, jobs):
+    with pytest.raises(SystemExit):
+        run_command(monkeypatch, '-j', jobs, '--stats', '--no-cache', '-f', 'code',
+                    '-d', tmpdir, *sources)
+
+    out, err = capsys.readouterr()
+    lines = err.splitlines()
+    start = lines.index(next(line for line in lines if line.startswith('stage ')))
+
+    # The failed file is only counted by the parse stage
+    assert [line.split()[:2] for line in lines[start + 1 : start + 4]] == [
+        ['parse', '4'], ['analyze', '3'], ['render', '3']]
@@ -9,17 +9,30 @@ from CobolSharp import *
 from CobolSharp.structure import *
 from CobolSharp.syntax import *
 
-program_code_prefix = """
+# Program up to the procedure division, for tests with their own sections
+program_header = """
        identification division.
        program-id. test.
        environment division.
        data division.
        working-storage section.
        procedure division.
+"""
+
+program_code_prefix = program_header + """\
        test section.
 """
 
 
+def structure_graphs(stmt_graph):
+    """Return the AcyclicStructureGraph and the ScopeStructuredGraph of
+    the reachable statements in a StmtGraph.
+    """
+    cobol_graph = CobolStructureGraph.from_stmt_graph(stmt_graph.reachable_subgraph())
+    dag = AcyclicStructureGraph.from_cobol_graph(cobol_graph)
+    return dag, ScopeStructuredGraph.from_acyclic_graph(dag)
+
+
 @pytest.fixture(scope='function')
 def cobol_stmt_graph(request):
     """Return a StmtGraph of reachable statements of the Cobol code in the
@@ -0,0 +1,297 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+import pytest
+import networkx as nx
+
+from CobolSharp import *
+from CobolSharp.syntax import *
+from CobolSharp.structure import *
+from CobolSharp.analyze import ScopeIndex
+
+from .conftest import program_code_prefix, structure_graphs
+from .synthetic import build_program
+
+
+def section_graph(code):
+    program = parse(program_code_prefix + code)
+    return StmtGraph.from_section(program.proc_div.sections['test'])
+
+
+def stmt_by_name(graph, name):
+    for node in graph.nodes:
+        if getattr(node, 'section_name', None) == name:
+            return node
+
+
+def test_stmt_graph_edges():
+    graph = section_graph("""
+           if a = 1
+               perform first
+           end-if.
+           perform second.
+           exit.
+""")
+    branch = graph.successors(Entry)[0]
+    perform_first = stmt_by_name(graph, 'first')
+    perform_second = stmt_by_name(graph, 'second')
+
+    assert isinstance(branch, BranchStatement)
+    assert graph.successors(branch) == [perform_first, perform_second]
+    assert sorted(graph.predecessors(perform_second)) == [branch, perform_first]
+    assert graph.in_degree(perform_second) == 2
+    assert graph.out_degree(branch) == 2
+    assert graph.successors(perform_second) == [Exit]
+    assert graph.predecessors(Entry) == []
+
+    edges = list(graph.edges())
+    assert len(edges) == 5
+    assert (branch, perform_first, True) in edges
+    assert (branch, perform_second, False) in edges
+    assert (perform_first, perform_second, None) in edges
+
+
+def test_stmt_graph_from_parser_links():
+    code = """
+           if a = 1
+               go to b
+           end-if.
+           perform first.
+       b.
+           if a = 2
+               next sentence
+           else
+               perform second
+           end-if.
+           exit.
+"""
+    program = parse(program_code_prefix + code)
+    section = program.proc_div.sections['test']
+    assert section.stmt_links is not None
+
+    graph = StmtGraph.from_section(section)
+    assert graph.succ is section.stmt_links.succ
+
+    # Same edges as when walking the statements of the section
+    section.stmt_links = None
+    walked = StmtGraph.from_section(section)
+    assert walked.succ is not graph.succ
+    assert sorted(graph.edges(), key=repr) == sorted(walked.edges(), key=repr)
+
+    reachable = graph.reachable_subgraph()
+    walked_reachable = walked.reachable_subgraph()
+    assert reachable.nodes == walked_reachable.nodes
+    assert list(reachable.edges()) == list(walked_reachable.edges())
+
+
+def test_reachable_subgraph():
+    graph = section_graph("""
+           go to b.
+       a.
+           perform first.
+       b.
+           perform second.
+           exit.
+""")
+    reachable = graph.reachable_subgraph()
+
+    assert len(graph.nodes) == 5
+    assert len(reachable.nodes) == 4
+    assert reachable.nodes[0] is Entry
+    assert isinstance(reachable.nodes[1], GoToStatement)
+    assert [n.section_name for n in reachable.nodes if isinstance(n, PerformSectionStatement)] == ['second']
+
+    # The view shares the full graph, and counts the pruned statement
+    assert reachable.stmt_graph is graph
+    assert reachable.dead_stmts == 1
+    assert stmt_by_name(graph, 'first') not in reachable
+    assert stmt_by_name(graph, 'second') in reachable
+    assert reachable.in_degree(stmt_by_name(graph, 'second')) == 1
+    assert graph.in_degree(stmt_by_name(graph, 'second')) == 2
+
+
+def test_stmt_graph_networkx_view():
+    graph = section_graph("""
+           if a = 1
+               perform first
+           end-if.
+           exit.
+""")
+    nx_graph = graph.graph
+    assert graph.graph is nx_graph
+    assert list(nx_graph) == graph.nodes
+
+    branch = graph.successors(Entry)[0]
+    assert nx_graph[branch][graph.successors(branch)[0]] == {'condition': True}
+    assert nx_graph.in_degree(Exit) == graph.in_degree(Exit)
+
+    # The reachable graph is written as stmt_graph DOT files, which
+    # have always been the edges from nx.edge_dfs() without any labels
+    reachable = graph.reachable_subgraph().graph
+    dfs_graph = nx.DiGraph()
+    dfs_graph.add_edges_from(nx.edge_dfs(nx_graph, Entry))
+    assert list(reachable) == list(dfs_graph)
+    assert list(reachable.edges(data=True)) == list(dfs_graph.edges(data=True))
+
+
+def test_cobol_graph_self_loop():
+    graph = section_graph("""
+       a.
+           perform first.
+           go to a.
+""")
+    cobol_graph = CobolStructureGraph.from_stmt_graph(graph.reachable_subgraph())
+    perform_first = stmt_by_name(graph, 'first')
+
+    edges = list(cobol_graph.graph.edges(data=True))
+    assert len(edges) == 2
+
+    src, join, data = edges[0]
+    assert src is Entry
+    assert isinstance(join, Join) and join.stmt is perform_first
+    assert data['stmts'] == []
+
+    # The chain from the join starts with the join statement and
+    # leads back to it
+    src, dest, data = edges[1]
+    assert src is join and dest is join
+    assert data['stmts'][0] is perform_first
+    assert isinstance(data['stmts'][1], GoToStatement)
+
+
+nested_loops_code = """
+       a.
+           perform first.
+       b.
+           perform second.
+           if x = 1
+               go to b
+           end-if.
+           if x = 2
+               go to a
+           end-if.
+           exit.
+"""
+
+
+def test_acyclic_graph_nested_loops():
+    graph = section_graph(nested_loops_code)
+    dag, scope_graph = structure_graphs(graph)
+
+    assert nx.is_directed_acyclic_graph(dag.graph)
+
+    # The outer loop is broken first
+    outer, inner = dag._loops
+    assert outer.stmt is stmt_by_name(graph, 'first')
+    assert outer.scope is None
+    assert inner.stmt is stmt_by_name(graph, 'second')
+    assert inner.scope is outer
+
+    branches = sorted((n for n in dag.graph if isinstance(n, Branch)),
+                      key=lambda n: n.source.from_char)
+    assert [b.scope for b in branches] == [inner, outer]
+
+
+# Two loops with nested loops, where the loops in the second one are
+# found before those in the first one once the outer loops are broken
+sibling_nested_loops_code = """
+       a.
+           if x = 1
+               go to c
+           end-if.
+           move 1 to y.
+       b.
+           move 2 to y.
+           if x = 2
+               go to b
+           end-if.
+           if x = 3
+               go to a
+           end-if.
+           go to e.
+       c.
+           move 3 to y.
+       d.
+           move 4 to y.
+           if x = 4
+               go to d
+           end-if.
+           if x = 5
+               go to c
+           end-if.
+       e.
+           exit.
+"""
+
+
+def loop_tree(dag):
+    return [(loop.stmt, loop.scope and loop.scope.stmt) for loop in dag._loops]
+
+
+def old_loop_tree(cobol_graph):
+    # The original algorithm, searching the whole graph again for each
+    # level of nested loops
+    dag = AcyclicStructureGraph()
+    dag.graph.add_edges_from(cobol_graph.graph.edges(keys=True, data=True))
+
+    while True:
+        components = [c for c in nx.strongly_connected_components(dag.graph)
+                      if len(c) > 1]
+        if not components:
+            break
+
+        for component in components:
+            dag._break_component_loop(component)
+
+    return loop_tree(dag)
+
+
+@pytest.mark.parametrize('code', [nested_loops_code, sibling_nested_loops_code],
+                         ids=['nested', 'sibling'])
+def test_acyclic_graph_loop_order(code):
+    graph = section_graph(code).reachable_subgraph()
+    dag = AcyclicStructureGraph.from_cobol_graph(CobolStructureGraph.from_stmt_graph(graph))
+
+    assert loop_tree(dag) == old_loop_tree(CobolStructureGraph.from_stmt_graph(graph))
+
+
+def test_acyclic_graph_sibling_nests_loop_order():
+    program = build_program(200, stmts_per_para=5, paras_per_section=40,
+                            loops=True, nesting=4)
+    graph = StmtGraph.from_section(program.proc_div.sections['s0']).reachable_subgraph()
+    dag = AcyclicStructureGraph.from_cobol_graph(CobolStructureGraph.from_stmt_graph(graph))
+
+    assert len(dag._loops) == 40
+    assert loop_tree(dag) == old_loop_tree(CobolStructureGraph.from_stmt_graph(graph))
+
+
+def test_scope_graph_exit_index():
+    graph = section_graph(nested_loops_code)
+    dag, scope_graph = structure_graphs(graph)
+
+    # The outer loop only leaves the section
+    outer, inner = dag._loops
+    assert outer.loop_exit is None
+    assert isinstance(inner.loop_exit, LoopExit)
+
+    # The index is still complete after the edges have been rewritten
+    for src, dest in scope_graph.graph.edges_iter():
+        if src.scope is not dest.scope:
+            assert src in scope_graph._scope_exits[src.scope]
+
+
+def test_scope_index():
+    graph = section_graph(nested_loops_code)
+    dag, scope_graph = structure_graphs(graph)
+    index = ScopeIndex(scope_graph.graph)
+
+    for scope in [None] + dag._loops:
+        nodes = [n for n in scope_graph.graph if n.scope is scope]
+        assert nodes
+        assert index.nodes(scope) == nodes
+
+        counts = index.in_edge_counts(scope)
+        for node in nodes:
+            assert counts[node] == scope_graph.graph.in_degree(node)
+
+    assert index.nodes(Loop(stmt_by_name(graph, 'first'))) == []
@@ -0,0 +1,323 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+import os
+import sys
+import zipfile
+
+import pytest
+
+from CobolSharp import *
+from CobolSharp import koopa, syntax
+
+from .conftest import program_code_prefix
+
+good_code = program_code_prefix + """
+           perform a.
+           exit.
+       a section.
+           exit.
+"""
+
+bad_code = program_code_prefix + """
+           foo bar baz.
+"""
+
+
+@pytest.fixture(scope='module')
+def server():
+    with KoopaServer() as server:
+        yield server
+
+
+def test_server_reuses_jvm(server):
+    program = parse(good_code, server=server)
+    pid = server._process.pid
+
+    program2 = parse(good_code, server=server)
+    assert server._process.pid == pid
+
+    assert sorted(program.proc_div.sections) == ['a', 'test']
+    assert sorted(program2.proc_div.sections) == ['a', 'test']
+
+
+def test_server_parser_error(server):
+    with pytest.raises(ParserError) as excinfo:
+        parse(bad_code, server=server)
+
+    assert 'Error:' in str(excinfo.value)
+    assert '<string>' in str(excinfo.value)
+
+    # The server is still usable
+    program = parse(good_code, server=server)
+    assert 'a' in program.proc_div.sections
+
+
+def test_server_restarts_after_crash(server):
+    parse(good_code, server=server)
+    server._process.kill()
+    server._process.wait()
+
+    program = parse(good_code, server=server)
+    assert 'a' in program.proc_div.sections
+
+
+def test_parse_many(tmpdir):
+    paths = []
+    for name, code in (('a.cbl', good_code), ('b.cbl', bad_code), ('c.cbl', good_code)):
+        path = tmpdir.join(name)
+        path.write(code)
+        paths.append(str(path))
+
+    paths.append(str(tmpdir.join('missing.cbl')))
+
+    results = list(parse_many(paths))
+    assert len(results) == 4
+
+    assert isinstance(results[0], syntax.Program)
+    assert results[0].path == paths[0]
+
+    assert isinstance(results[1], ParserError)
+    assert 'b.cbl' in str(results[1])
+
+    assert isinstance(results[2], syntax.Program)
+    assert results[2].path == paths[2]
+
+    assert isinstance(results[3], ParserError)
+    assert 'missing.cbl' in str(results[3])
+
+
+def test_map_source(tmpdir, server):
+    path = tmpdir.join('a.cbl')
+    path.write_binary((good_code + '      * r\xe4ksm\xf6rg\xe5s\n').encode('iso-8859-1'))
+
+    source = koopa.map_source(str(path), 'latin-1')
+    assert isinstance(source, syntax.SourceBytes)
+    assert source.name == str(path)
+
+    program = parse(source, server=server)
+    assert program.path == str(path)
+    assert sorted(program.proc_div.sections) == ['a', 'test']
+
+    # The source isn't decoded until the text is needed
+    table = program.source.table
+    assert table.source_bytes is source
+    assert str(program) == str(parse(good_code, server=server))
+    assert table.source_bytes is source
+
+    assert program.source.text.endswith('r\xe4ksm\xf6rg\xe5s\n')
+    assert table.source_bytes is None
+
+    # Other encodings are read as text
+    assert koopa.map_source(str(path), 'utf-8') is None
+    assert koopa.map_source(str(path), 'no-such-encoding') is None
+
+
+def test_map_source_close(tmpdir, server):
+    path = tmpdir.join('a.cbl')
+    path.write(good_code)
+
+    source = koopa.map_source(str(path), 'iso-8859-1')
+    with source:
+        program = parse(source, server=server)
+    assert isinstance(source.data, bytes)
+    assert program.source.table.source_bytes is source
+    assert program.source.text == good_code
+
+    # parse_many() closes the map, so the file can change under the program
+    program, = parse_many([str(path)], server=server)
+    path.write('')
+    assert program.source.table.source_bytes.data == good_code.encode('iso-8859-1')
+    assert program.source.text == good_code
+
+
+def test_map_empty_source(tmpdir):
+    path = tmpdir.join('empty.cbl')
+    path.write('')
+
+    source = koopa.map_source(str(path), 'iso-8859-1')
+    assert len(source) == 0
+    assert source.decode() == ''
+
+
+def test_stream_xml_in_chunks(server):
+    code = program_code_prefix + ''.join(
+        '           perform a{}.\n'.format(i) for i in range(500))
+
+    chunks = []
+    ok, messages = server.stream_xml(code, 'big.cbl', chunks.append)
+
+    assert ok
+    assert 'Error:' not in messages
+    assert len(chunks) > 1
+    assert b''.join(chunks).rstrip().endswith(b'</koopa>')
+
+
+def test_server_after_failed_program(server):
+    # Fails at the end of the first section, with more XML still to come
+    failing_code = program_code_prefix + '           go to nowhere.\n' + ''.join(
+        '       p{0}.\n           display "{0}".\n'.format(i) for i in range(3000))
+
+    with pytest.raises(ParserError):
+        parse(failing_code, server=server)
+
+    for name in ('alpha', 'beta'):
+        code = program_code_prefix + """
+           perform {0}.
+       {0} section.
+           exit.
+""".format(name)
+        program = parse(code, server=server)
+        assert sorted(program.proc_div.sections) == [name, 'test']
+
+
+def test_request_names_with_tabs_and_newlines(server, tmpdir):
+    ok, messages = server.stream_xml(good_code, 'a\tb\nc.cbl', lambda data: None)
+    assert ok
+
+    # The paths can't be sent to Koopa, but the file is still parsed
+    source_path = tmpdir.join('a\tb.cbl')
+    source_path.write(good_code)
+    xml_path = tmpdir.join('a\nb.xml')
+
+    ok, messages = server.to_xml(str(source_path), str(xml_path))
+    assert ok
+    assert xml_path.read_binary().rstrip().endswith(b'</koopa>')
+
+    # And the server is still in sync
+    program = parse(good_code, server=server)
+    assert 'a' in program.proc_div.sections
+
+
+def test_server_timeout():
+    with KoopaServer(timeout=0.001) as server:
+        # Koopa can't start in that time
+        with pytest.raises(ParserError) as excinfo:
+            parse(good_code, server=server)
+
+        assert 'did not respond' in str(excinfo.value)
+        assert server._process is None
+
+        # The next request starts a new server
+        server._timeout = None
+        program = parse(good_code, server=server)
+        assert 'a' in program.proc_div.sections
+
+
+fake_java = """#!{python}
+import os, sys
+
+# Like the JVM writing to stdout, but only the first time
+if not os.path.exists({marker!r}):
+    open({marker!r}, 'w').close()
+    sys.stdout.buffer.write(b'[0.005s][info][gc] Using G1\\n')
+
+def frame(kind, data):
+    sys.stdout.buffer.write('{{}} {{}}\\n'.format(kind, len(data)).encode() + data)
+
+for line in sys.stdin.buffer:
+    kind, name, length = line.decode().rstrip('\\n').split('\\t')
+    sys.stdin.buffer.read(int(length))
+    frame('xml', b'<koopa/>')
+    frame('ok', b'')
+    sys.stdout.flush()
+"""
+
+def test_server_bad_frame_header(tmpdir):
+    java = tmpdir.join('java')
+    java.write(fake_java.format(python=sys.executable, marker=str(tmpdir.join('started'))))
+    java.chmod(0o755)
+
+    with KoopaServer(java_binary=str(java), java_heap=None) as server:
+        with pytest.raises(ParserError) as excinfo:
+            server.stream_xml(good_code, 'a.cbl', lambda data: None)
+
+        assert 'invalid response' in str(excinfo.value)
+        assert server._process is None
+        assert not server._output
+
+        # The next request starts a new server
+        chunks = []
+        ok, messages = server.stream_xml(good_code, 'a.cbl', chunks.append)
+        assert ok
+        assert chunks == [b'<koopa/>']
+
+
+def test_run_koopa_removes_xml_on_error(server, tmpdir):
+    xml_path = tmpdir.join('bad.xml')
+
+    with pytest.raises(ParserError):
+        run_koopa(bad_code, str(xml_path), server=server)
+
+    assert not xml_path.exists()
+
+
+def test_parse_heap_size():
+    assert koopa.parse_heap_size('auto') == 'auto'
+    assert koopa.parse_heap_size('512m') == 512
+    assert koopa.parse_heap_size('2G') == 2048
+    assert koopa.parse_heap_size('1048576k') == 1024
+
+    with pytest.raises(ValueError):
+        koopa.parse_heap_size('lots')
+
+
+def test_auto_heap_size():
+    assert koopa.auto_heap_size(0) == koopa.AUTO_HEAP_MIN_MB
+    assert koopa.auto_heap_size(1024 * 1024) == 1024
+    assert koopa.auto_heap_size(1024 * 1024 + 1) == 2048
+
+
+def test_java_command_options(tmpdir):
+    cds = str(tmpdir.join('koopa.jsa'))
+    cmd = koopa.java_command('java', 'Main', 'arg', heap_mb=256,
+                             java_opts=('-XX:+UseSerialGC',), java_cds=cds)
+
+    assert cmd[0] == 'java'
+    assert cmd[-2:] == ('Main', 'arg')
+    assert '-Xmx256m' in cmd
+    assert '-XX:+UseSerialGC' in cmd
+    assert '-XX:SharedArchiveFile={}'.format(cds) in cmd
+
+
+def test_server_auto_heap_grows():
+    with KoopaServer(java_heap='auto') as server:
+        parse(good_code, server=server)
+        pid = server._process.pid
+        assert server._heap_mb == koopa.AUTO_HEAP_MIN_MB
+
+        # A big program needs a new JVM with more heap
+        big_code = good_code + ' ' * (koopa.AUTO_HEAP_MIN_MB * 1024 * 1024
+                                      // koopa.AUTO_HEAP_PER_SOURCE_BYTE)
+        parse(big_code, server=server)
+        assert server._heap_mb == 2 * koopa.AUTO_HEAP_MIN_MB
+        assert server._process.pid != pid
+        pid = server._process.pid
+
+        # But it is kept for smaller programs
+        parse(good_code, server=server)
+        assert server._process.pid == pid
+
+
+def test_server_fixed_heap():
+    with KoopaServer(java_heap='64m') as server:
+        program = parse(good_code, server=server)
+        assert 'a' in program.proc_div.sections
+        assert server._heap_mb == 64
+
+
+def test_cds_koopa_jar(tmpdir):
+    cds = str(tmpdir.join('koopa.jsa'))
+    cmd = koopa.java_command('java', 'Main', java_cds=cds)
+
+    classpath = cmd[cmd.index('-cp') + 1].split(os.pathsep)
+    jar_copy = classpath[0]
+    assert os.path.dirname(jar_copy) == str(tmpdir)
+
+    with zipfile.ZipFile(jar_copy) as jar:
+        assert b'Class-Path' not in jar.read('META-INF/MANIFEST.MF')
+
+    # The copy is reused
+    mtime = os.path.getmtime(jar_copy)
+    koopa.java_command('java', 'Main', java_cds=cds)
+    assert os.path.getmtime(jar_copy) == mtime
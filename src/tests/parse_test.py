@@ -0,0 +1,150 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+import pytest
+
+from CobolSharp import *
+from CobolSharp.syntax import *
+
+from .conftest import program_header
+
+
+def test_sections():
+    program = parse(program_header + """
+       first section.
+      * Call the second one
+           perform second.
+           exit.
+       second section.
+           exit.
+""")
+    proc_div = program.proc_div
+
+    assert list(proc_div.sections) == ['first', 'second']
+    assert proc_div.first_section is proc_div.sections['first']
+
+    stmt = proc_div.sections['first'].get_first_stmt()
+    assert isinstance(stmt, PerformSectionStatement)
+    assert stmt.section is proc_div.sections['second']
+    assert stmt.comment.strip() == 'Call the second one'
+    assert proc_div.sections['second'].xref_stmts == [stmt]
+
+
+def test_loose_paragraphs_in_main_section():
+    program = parse(program_header + """
+           perform first.
+       start-para.
+           perform first.
+           stop run.
+       first section.
+           exit.
+""")
+    proc_div = program.proc_div
+
+    assert list(proc_div.sections) == ['__main', 'first']
+    main = proc_div.first_section
+    assert main is proc_div.sections['__main']
+    assert [p.name for p in main.paras_in_order()] == [None, 'start-para']
+
+    stmt = main.get_first_stmt()
+    assert stmt.section is proc_div.sections['first']
+    assert stmt.next_stmt.section is proc_div.sections['first']
+    assert stmt.next_stmt.next_stmt.next_stmt is None
+
+
+def test_duplicate_section():
+    program = parse(program_header + """
+       first section.
+           exit.
+       first section.
+           exit.
+""")
+    names = [s.name for s in program.proc_div.sections_in_order()]
+    assert names[0] == 'first'
+    assert names[1].startswith('first__dup')
+
+
+def test_source_table():
+    program = parse(program_header + """
+       first section.
+           perform second.
+       second section.
+           exit.
+""")
+    table = program.source.table
+    assert table.text == program.source.text
+
+    stmt = program.proc_div.sections['first'].get_first_stmt()
+    assert stmt.source.table is table
+    assert str(stmt.source) == 'perform second'
+    assert (stmt.source.from_line, stmt.source.to_line) == (10, 10)
+    assert table.from_line[stmt.source.index] == 10
+
+
+def test_source_str_without_cr():
+    table = SourceTable('ab\r\ncd\r\n\r\nef\r\n')
+    sources = [table.add(0, 4, 1, 2, 0, 1),
+               table.add(3, 5, 2, 2, 0, 1),
+               table.add(4, 11, 2, 4, 0, 1),
+               table.add(0, 13, 1, 4, 0, 2)]
+
+    assert [str(s) for s in sources] == ['ab\nc', '\ncd', 'cd\n\nef', 'ab\ncd\n\nef\n']
+    for s in sources:
+        assert str(s) == table.text[s.from_char : s.to_char + 1].replace('\r', '')
+
+    # The text is only extracted once
+    assert str(sources[2]) is str(sources[2])
+
+
+def test_crlf_source():
+    code = program_header + """
+       first section.
+           move 1
+             to a.
+"""
+    program = parse(code.replace('\n', '\r\n'))
+
+    stmt = program.proc_div.sections['first'].get_first_stmt()
+    assert str(stmt.source) == 'move 1\n             to a'
+
+
+def test_source_bytes_count_lines():
+    text = 'a\r\nb\n\nc'
+    assert SourceTable(text).count_lines() == 3
+
+    table = SourceTable(SourceBytes(text.encode('ascii'), 'ascii'))
+    assert table.count_lines() == 3
+    assert table.source_bytes is not None
+
+    assert table.text == text
+    assert table.source_bytes is None
+
+
+def test_line_index():
+    index = LineIndex('ab\ncd\r\n\nef')
+    assert len(index) == 4
+    assert list(index.lines()) == 'ab\ncd\r\n\nef'.split('\n')
+    assert list(index.lines(2, 3)) == ['cd\r', '']
+
+    assert [index.line_at(c) for c in range(10)] == [1, 1, 1, 2, 2, 2, 2, 3, 4, 4]
+    assert (index.line_start(2), index.line_end(2)) == (3, 6)
+    assert index.line(4) == 'ef'
+
+    # A final line separator starts an empty line
+    index = LineIndex('ab\n')
+    assert list(index.lines()) == ['ab', '']
+
+
+def test_program_line_index():
+    program = parse(program_header + """
+       first section.
+           perform second.
+       second section.
+           exit.
+""")
+    stmt = program.proc_div.sections['first'].get_first_stmt()
+    index = program.line_index
+
+    assert index is program.line_index
+    assert index.line_at(stmt.source.from_char) == stmt.source.from_line
+    assert index.line(stmt.source.from_line).strip() == 'perform second.'
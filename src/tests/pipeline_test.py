@@ -0,0 +1,87 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+import sys
+import threading
+import time
+
+import pytest
+
+from CobolSharp.pipeline import *
+
+
+class NumberJob(Job):
+    def __init__(self, number):
+        super(NumberJob, self).__init__()
+        self.number = number
+        self.lines = number
+        self.trace = []
+
+
+def make_stages():
+    def first(job):
+        # Make early jobs slow, so later ones would overtake them if
+        # the order wasn't kept
+        time.sleep(0.01 * (5 - job.number))
+        print('first', job.number)
+        job.trace.append(('first', threading.current_thread().name))
+        if job.number == 2:
+            job.error = 'two'
+
+    def second(job):
+        sys.stderr.write('second {}\n'.format(job.number))
+        job.trace.append(('second', threading.current_thread().name))
+
+    return [('first', first), ('second', second)]
+
+
+@pytest.mark.parametrize('threaded', [True, False])
+def test_pipeline(capsys, threaded):
+    pipeline = Pipeline(make_stages(), threaded=threaded)
+    jobs = list(pipeline.run(NumberJob(n) for n in range(5)))
+
+    assert [job.number for job in jobs] == list(range(5))
+
+    for job in jobs:
+        assert job.stdout.getvalue() == 'first {}\n'.format(job.number)
+
+        if job.number == 2:
+            assert job.error == 'two'
+            assert job.stderr.getvalue() == ''
+            assert [stage for stage, thread in job.trace] == ['first']
+        else:
+            assert job.stderr.getvalue() == 'second {}\n'.format(job.number)
+            assert [stage for stage, thread in job.trace] == ['first', 'second']
+
+        threads = set(thread for stage, thread in job.trace)
+        if threaded:
+            assert threading.current_thread().name not in threads
+        else:
+            assert threads == {threading.current_thread().name}
+
+    # Nothing leaked to the real streams
+    out, err = capsys.readouterr()
+    assert out == err == ''
+
+    first, second = pipeline.stats
+    assert (first.name, first.jobs, first.lines) == ('first', 5, 10)
+    assert (second.name, second.jobs, second.lines) == ('second', 4, 8)
+    assert first.seconds > 0
+    assert pipeline.elapsed >= first.seconds
+
+
+@pytest.mark.parametrize('threaded', [True, False])
+def test_pipeline_exception(threaded):
+    def fail(job):
+        if job.number == 1:
+            raise KeyError(job.number)
+
+    pipeline = Pipeline([('fail', fail), ('second', lambda job: None)], threaded=threaded)
+    results = pipeline.run(NumberJob(n) for n in range(10))
+
+    assert next(results).number == 0
+    with pytest.raises(KeyError):
+        next(results)
+
+    # All stage threads have been stopped
+    assert not [t for t in threading.enumerate() if t.name.startswith('pipeline-')]
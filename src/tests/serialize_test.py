@@ -0,0 +1,172 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+import io
+from array import array
+
+import pytest
+
+from CobolSharp import *
+from CobolSharp.syntax import *
+from CobolSharp.serialize import FormatError, ProgramObjects
+
+from .conftest import program_header
+
+code = program_header + """
+           perform first.
+       start-para.
+           if a = 1
+               perform second
+           else
+      * Nested if
+               if b = 2
+                   move 1 to c
+                   next sentence
+               end-if
+           end-if.
+           go to end-para.
+       end-para.
+           stop run.
+      * The first section
+       first section.
+       first-a.
+           move 1 to a
+           go to first-b.
+       first-b.
+           if a = 1 go to first-a.
+           exit.
+       second section.
+           perform third.
+           goback.
+       first section.
+           exit.
+"""
+
+
+def round_trip(program):
+    f = io.BytesIO()
+    program.dump(f)
+    f.seek(0)
+    return Program.load(f)
+
+
+def object_attrs(obj):
+    """Return the attributes of obj, which may use __slots__."""
+    if hasattr(obj, '__dict__'):
+        return list(vars(obj).items())
+
+    return [(attr, getattr(obj, attr))
+            for cls in type(obj).__mro__
+            for attr in getattr(cls, '__slots__', ())]
+
+
+def assert_same_program(a, b):
+    """Check that the programs have the same objects and links."""
+    mapping = {}
+    queue = [(a, b)]
+
+    while queue:
+        x, y = queue.pop()
+        if x is None or y is None:
+            assert x is None and y is None
+            continue
+
+        assert type(x) is type(y)
+        if x in mapping:
+            assert mapping[x] is y
+            continue
+
+        mapping[x] = y
+
+        for attr, value in object_attrs(x):
+            other = getattr(y, attr)
+            if isinstance(value, Source):
+                assert repr(value) == repr(other)
+                assert value.text is a.source.text
+                assert other.text is b.source.text
+            elif isinstance(value, set):
+                # Only used for sections, which are compared by name
+                assert sorted(v.name for v in value) == sorted(o.name for o in other)
+            elif isinstance(value, array):
+                assert value == other
+            elif isinstance(value, list):
+                assert len(value) == len(other)
+                queue.extend(zip(value, other))
+            elif isinstance(value, dict):
+                assert list(value) == list(other)
+                queue.extend((value[k], other[k]) for k in value)
+            elif isinstance(value, (str, int, bool)) or value is None:
+                assert value == other
+            else:
+                queue.append((value, other))
+
+    return mapping
+
+
+def test_round_trip():
+    program = parse(code)
+    program2 = round_trip(program)
+
+    assert program2.source.text == program.source.text
+    mapping = assert_same_program(program, program2)
+
+    # Every statement was carried over
+    stmts = [o for o in mapping if isinstance(o, CobolStatement)]
+    assert len(stmts) == 14
+    assert str(program2) == str(program)
+
+    proc_div = program2.proc_div
+    perform = proc_div.sections['__main'].get_first_stmt()
+    assert perform.section is proc_div.sections['first']
+    assert perform in proc_div.sections['first'].xref_stmts
+    assert proc_div.sections['first'] in proc_div.sections['__main'].used_sections
+
+    # The statement graph comes from the links recorded by the parser
+    section = proc_div.sections['first']
+    assert section.stmt_links is not None
+    graph = StmtGraph.from_section(section)
+    assert graph.succ is section.stmt_links.succ
+    assert graph.nodes[-1] is Entry
+
+
+def test_round_trip_is_stable():
+    program = parse(code)
+
+    f = io.BytesIO()
+    program.dump(f)
+
+    f2 = io.BytesIO()
+    round_trip(program).dump(f2)
+
+    assert f.getvalue() == f2.getvalue()
+
+
+def test_round_trip_undecoded_source():
+    program = parse(SourceBytes(code.encode('iso-8859-1'), 'iso-8859-1'))
+    program2 = round_trip(program)
+
+    # Neither copy has decoded the source
+    assert program.source.table.source_bytes is not None
+    assert program2.source.table.source_bytes.encoding == 'iso-8859-1'
+
+    assert program2.source.text == code
+    assert str(program2) == str(program)
+
+
+def test_load_bad_data():
+    with pytest.raises(FormatError):
+        Program.load(io.BytesIO(b'not a program at all'))
+
+    f = io.BytesIO()
+    parse(code).dump(f)
+
+    with pytest.raises(FormatError):
+        Program.load(io.BytesIO(f.getvalue()[:-10]))
+
+
+def test_model_uses_slots():
+    objects = ProgramObjects(parse(code))
+
+    for obj in objects.sections + objects.paras + objects.sentences + objects.stmts:
+        assert not hasattr(obj, '__dict__'), obj
+        assert not hasattr(obj.source, '__dict__'), obj
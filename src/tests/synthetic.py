@@ -0,0 +1,273 @@
+# Copyright 2016 Peter Liljenberg <peter.liljenberg@gmail.com>
+# Licensed under GPLv3, see file LICENSE in the top directory
+
+"""Build large synthetic programs directly from the syntax classes,
+without running Koopa.  Used by the tests and the benchmarks.
+"""
+
+from CobolSharp.syntax import *
+
+
+class ProgramBuilder(object):
+    """Build a Program by adding sections, paragraphs and sentences in
+    source code order, generating matching COBOL source text.  The
+    statements are linked like the Koopa parser does when build() is
+    called.
+    """
+
+    def __init__(self):
+        self._lines = []
+        self._pos = 0
+        self._table = SourceTable(None)
+        self._gotos = []
+        self._top_stmts = {}
+
+        self.proc_div = ProcedureDivision(self._source_lines('procedure division.'))
+        self._section = None
+        self._para = None
+        self._sentence = None
+
+    def section(self, name):
+        self._section = Section(name, self._source_lines('{} section.'.format(name)))
+        self.proc_div.sections[name] = self._section
+        if self.proc_div.first_section is None:
+            self.proc_div.first_section = self._section
+
+        self._para = None
+        return self._section
+
+    def para(self, name=None):
+        if name is not None:
+            source = self._source_lines('{}.'.format(name))
+        else:
+            source = self._source_lines('')
+
+        para = Paragraph(name, source, self._section)
+        if self._para is None:
+            self._section.first_para = para
+        else:
+            self._para.next_para = para
+
+        self._section.paras[name] = self._para = para
+        return para
+
+    def move(self, value='1', target='a'):
+        """Add a sentence with a MOVE statement."""
+        sentence = self._add_sentence()
+        self._add_stmt(sentence, MoveStatement(
+            self._source_lines('move {} to {}.'.format(value, target), 11), sentence))
+        return sentence
+
+    def if_else(self, condition='a = 1'):
+        """Add a sentence with an IF statement that has a MOVE in both
+        branches.
+        """
+        sentence = self._add_sentence()
+        branch = BranchStatement(self._source_lines('if {}'.format(condition), 11), sentence)
+        branch.condition = ConditionExpression(self._last_source)
+        self._add_stmt(sentence, branch)
+
+        branch.true_stmt = MoveStatement(self._source_lines('move 1 to b', 15), sentence)
+        self._source_lines('else', 11)
+        branch.false_stmt = MoveStatement(self._source_lines('move 2 to b', 15), sentence)
+        self._source_lines('end-if.', 11)
+        sentence.stmts.extend((branch.true_stmt, branch.false_stmt))
+        return sentence
+
+    def nested_if(self, depth):
+        """Add a sentence with 'depth' nested IF statements."""
+        sentence = self._add_sentence()
+        outer = None
+        for i in range(depth):
+            branch = BranchStatement(
+                self._source_lines('if a = {}'.format(i), 11 + 2 * (i % 20)), sentence)
+            branch.condition = ConditionExpression(self._last_source)
+            if outer is None:
+                self._add_stmt(sentence, branch)
+            else:
+                outer.true_stmt = branch
+                sentence.stmts.append(branch)
+            outer = branch
+
+        outer.true_stmt = MoveStatement(self._source_lines('move 1 to b', 11), sentence)
+        sentence.stmts.append(outer.true_stmt)
+        return sentence
+
+    def else_if(self, depth):
+        """Add a sentence with an IF/ELSE IF chain of 'depth' IF
+        statements, each with a MOVE in the true branch.
+        """
+        sentence = self._add_sentence()
+        outer = None
+        for i in range(depth):
+            if outer is not None:
+                self._source_lines('else', 11)
+
+            branch = BranchStatement(self._source_lines('if a = {}'.format(i), 11), sentence)
+            branch.condition = ConditionExpression(self._last_source)
+            if outer is None:
+                self._add_stmt(sentence, branch)
+            else:
+                outer.false_stmt = branch
+                sentence.stmts.append(branch)
+
+            branch.true_stmt = MoveStatement(
+                self._source_lines('move {} to b'.format(i), 15), sentence)
+            sentence.stmts.append(branch.true_stmt)
+            outer = branch
+
+        self._source_lines('end-if.', 11)
+        return sentence
+
+    def goto(self, para_name):
+        """Add a sentence with a GO TO statement."""
+        sentence = self._add_sentence()
+        stmt = GoToStatement(self._source_lines('go to {}.'.format(para_name), 11),
+                             sentence, para_name)
+        self._add_stmt(sentence, stmt)
+        self._gotos.append((self._section, stmt))
+        return sentence
+
+    def if_goto(self, para_name, condition='a = 1'):
+        """Add a sentence with an IF statement that has a GO TO in the
+        true branch.
+        """
+        sentence = self._add_sentence()
+        branch = BranchStatement(self._source_lines('if {}'.format(condition), 11), sentence)
+        branch.condition = ConditionExpression(self._last_source)
+        self._add_stmt(sentence, branch)
+
+        branch.true_stmt = GoToStatement(self._source_lines('go to {}'.format(para_name), 15),
+                                         sentence, para_name)
+        self._source_lines('end-if.', 11)
+        sentence.stmts.append(branch.true_stmt)
+        self._gotos.append((self._section, branch.true_stmt))
+        return sentence
+
+    def perform(self, section_name):
+        """Add a sentence with a PERFORM statement."""
+        sentence = self._add_sentence()
+        stmt = PerformSectionStatement(
+            self._source_lines('perform {}.'.format(section_name), 11), sentence, section_name)
+        self._add_stmt(sentence, stmt)
+        return sentence
+
+    def build(self, path='<synthetic>'):
+        text = self._table.text = '\n'.join(self._lines) + '\n'
+
+        for section in self.proc_div.sections.values():
+            self._link_section(section)
+
+        for section, stmt in self._gotos:
+            stmt.next_stmt = section.paras[stmt.para_name].get_first_stmt()
+
+        program_source = self._table.add(0, len(text) - 1, 1, len(self._lines), 1, 1)
+        return Program(program_source, path, self.proc_div)
+
+
+    def _add_sentence(self):
+        if self._para is None:
+            self.para()
+
+        sentence = Sentence(None, self._para)
+        self._para.sentences.append(sentence)
+        return sentence
+
+    def _add_stmt(self, sentence, stmt):
+        # Only used for the top-level statements in the sentence
+        sentence.stmts.append(stmt)
+        self._top_stmts.setdefault(sentence, []).append(stmt)
+        if sentence.first_stmt is None:
+            sentence.first_stmt = stmt
+            sentence.source = stmt.source
+
+    def _source_lines(self, code, indent=7):
+        line = ' ' * indent + code
+        self._lines.append(line)
+        self._last_source = self._table.add(self._pos, self._pos + len(line) - 1,
+                                            len(self._lines), len(self._lines), 1, len(line))
+        self._pos += len(line) + 1
+        return self._last_source
+
+    def _link_section(self, section):
+        sentences = [sentence for para in section.paras_in_order() for sentence in para.sentences]
+        for para in section.paras_in_order():
+            if para.sentences:
+                para.first_sentence = para.sentences[0]
+
+        next_stmt = None
+        for i in reversed(range(len(sentences))):
+            sentence = sentences[i]
+            if i + 1 < len(sentences):
+                sentence.next_sentence = sentences[i + 1]
+
+            for stmt in reversed(self._top_stmts.get(sentence, ())):
+                self._link_stmt(stmt, next_stmt)
+                next_stmt = stmt
+
+    def _link_stmt(self, stmt, next_stmt):
+        # Iterative, since IF statements may be nested very deep
+        queue = [stmt]
+        while queue:
+            stmt = queue.pop()
+
+            if isinstance(stmt, BranchStatement):
+                if stmt.false_stmt is None:
+                    stmt.false_stmt = next_stmt
+                else:
+                    queue.append(stmt.false_stmt)
+                queue.append(stmt.true_stmt)
+
+            elif isinstance(stmt, GoToStatement):
+                pass
+
+            elif isinstance(stmt, PerformSectionStatement):
+                stmt.section = self.proc_div.sections.get(stmt.section_name)
+                if stmt.section is not None:
+                    stmt.section.xref_stmts.append(stmt)
+                    stmt.sentence.para.section.used_sections.add(stmt.section)
+                stmt.next_stmt = next_stmt
+
+            elif isinstance(stmt, SequentialStatement):
+                stmt.next_stmt = next_stmt
+
+
+def build_program(num_stmts, stmts_per_para=30, paras_per_section=10, loops=False,
+                  nesting=1):
+    """Build a program with about num_stmts statements: a main section
+    performing a number of sections with paragraphs of MOVE and IF
+    sentences.
+
+    If loops is true, each paragraph ends with an IF that jumps back
+    to the start of the paragraph.  With a nesting above 1, the loops
+    are instead nested that deep in each group of nesting paragraphs,
+    with the IFs jumping back to them all at the end of the last one.
+    """
+    stmts_per_section = stmts_per_para * paras_per_section
+    num_sections = max(1, num_stmts // stmts_per_section)
+
+    builder = ProgramBuilder()
+    builder.section('main')
+    for s in range(num_sections):
+        builder.perform('s{}'.format(s))
+
+    for s in range(num_sections):
+        builder.section('s{}'.format(s))
+        for p in range(paras_per_section):
+            builder.para('s{}-p{}'.format(s, p))
+
+            # Every other sentence is an IF with two MOVEs
+            count = 0
+            while count < stmts_per_para:
+                if count % 2:
+                    builder.if_else('a = {}'.format(count))
+                    count += 3
+                else:
+                    builder.move(str(count))
+                    count += 1
+
+            if loops and (p % nesting == nesting - 1 or p == paras_per_section - 1):
+                for q in reversed(range(p - p % nesting, p + 1)):
+                    builder.if_goto('s{}-p{}'.format(s, q))
+
+    return builder.build()